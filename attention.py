@@ -18,8 +18,81 @@ except:
     raise Exception("Incompatible Diffusers version: " + diffusers.__file__)
 CURRENT_FORWARD = ORIGINAL_FORWARD
 
+class RegionalMask():
+    # per row spatial masks over equal length segments of the context, turned into an additive attention bias
+    def __init__(self, masks, size):
+        self.masks = masks
+        self.size = size
+        self.cache = {}
+
+    def get_bias(self, query_length, key_length, dtype, device):
+        key = (query_length, key_length, dtype, device)
+        if key in self.cache:
+            return self.cache[key]
+
+        # rows without masks attend normally, with none at all there is nothing to bias
+        if not any(self.masks):
+            self.cache[key] = None
+            return None
+
+        # follow the UNET downsampling to find the resolution of this layer
+        h, w = self.size
+        while h * w > query_length:
+            h, w = (h + 1) // 2, (w + 1) // 2
+        if h * w != query_length:
+            self.cache[key] = None
+            return None
+
+        segments = max(len(m) for m in self.masks) or 1
+        masks = torch.zeros((len(self.masks), segments, h, w), dtype=torch.float32, device=device)
+        for i, m in enumerate(self.masks):
+            if m:
+                m = torch.stack(m).to(device, torch.float32)[None]
+                masks[i, :len(m[0])] = torch.nn.functional.adaptive_avg_pool2d(m, (h, w))[0]
+            else:
+                masks[i, 0] = 1
+
+        bias = masks.log().flatten(2).transpose(1, 2)
+        bias = bias.repeat_interleave(key_length // segments, dim=2)
+        bias = bias[:, None].to(dtype)
+
+        self.cache[key] = bias
+        return bias
+
+def regional_attention_forward(self, x, encoder_hidden_states, bias, **cross_attention_kwargs):
+    batch_size, sequence_length, inner_dim = x.shape
+    h = self.heads
+    head_dim = inner_dim // h
+
+    q = self.to_q(x).view(batch_size, -1, h, head_dim).transpose(1, 2)
+    k = self.to_k(encoder_hidden_states).view(batch_size, -1, h, head_dim).transpose(1, 2)
+    v = self.to_v(encoder_hidden_states).view(batch_size, -1, h, head_dim).transpose(1, 2)
+
+    dtype = q.dtype
+
+    if cross_attention_kwargs.get('upcast_attention', False):
+        q, k, v = q.float(), k.float(), v.float()
+
+    if inv := cross_attention_kwargs.get("token_inversions", None):
+        for b, b_inv in enumerate(inv):
+            for i in b_inv:
+                v[b, :, i:i+1, :] = -v[b, :, i:i+1, :]
+
+    out = torch.nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=bias.to(q.dtype), dropout_p=0.0, is_causal=False)
+    out = out.transpose(1, 2).reshape(batch_size, -1, h * head_dim).to(dtype)
+
+    out = self.to_out[0](out)
+    out = self.to_out[1](out)
+    return out
+
 def do_attention(self, hidden_states, encoder_hidden_states=None, attention_mask=None, temb=None, **cross_attention_kwargs):
-    if CURRENT_FORWARD == ORIGINAL_FORWARD:
+    regional = cross_attention_kwargs.pop("regional_masks", None)
+    bias = None
+    if regional != None and encoder_hidden_states is not None:
+        query_length = hidden_states.shape[-2] * hidden_states.shape[-1] if hidden_states.ndim == 4 else hidden_states.shape[1]
+        bias = regional.get_bias(query_length, encoder_hidden_states.shape[1], hidden_states.dtype, hidden_states.device)
+
+    if CURRENT_FORWARD == ORIGINAL_FORWARD and bias == None:
         return ORIGINAL_FORWARD(self, hidden_states, encoder_hidden_states=encoder_hidden_states, attention_mask=attention_mask, temb=temb)
 
     residual = hidden_states
@@ -35,7 +108,10 @@ def do_attention(self, hidden_states, encoder_hidden_states=None, attention_mask
     if self.group_norm is not None:
         hidden_states = self.group_norm(hidden_states.transpose(1, 2)).transpose(1, 2)
 
-    hidden_states = CURRENT_FORWARD(self, hidden_states, encoder_hidden_states, attention_mask, **cross_attention_kwargs)
+    if bias != None:
+        hidden_states = regional_attention_forward(self, hidden_states, encoder_hidden_states, bias, **cross_attention_kwargs)
+    else:
+        hidden_states = CURRENT_FORWARD(self, hidden_states, encoder_hidden_states, attention_mask, **cross_attention_kwargs)
 
     if input_ndim == 4:
         hidden_states = hidden_states.transpose(-1, -2).reshape(batch_size, channel, height, width)
@@ -9,6 +9,7 @@ import warnings
 warnings.filterwarnings("ignore", category=UserWarning)
 
 import utils
+import attention
 from annotator import shuffle, canny, unpack_pose, draw_pose
 
 CONTROLNET_MODELS = {
@@ -125,6 +126,12 @@ class ControlledUNET:
     def __call__(self, latents, timestep, encoder_hidden_states, **kwargs):
         unet_type = self.unet.model_type
         down_samples, mid_sample = None, None
+
+        # the ControlNet sees the same regional context as the UNET, so it needs the same masking
+        cross_attention_kwargs = None
+        if any(masks := (kwargs.get("added_cross_kwargs") or {}).get("regional_masks") or []):
+            cross_attention_kwargs = {"regional_masks": attention.RegionalMask(masks, latents.shape[-2:])}
+
         for i in range(len(self.controlnets)):
             cn_type = self.controlnets[i].model_type
             if (unet_type, cn_type) not in [("SDv1", "CN-v1"), ("SDXL-Base", "CN-XL")]:
@@ -135,6 +142,10 @@ class ControlledUNET:
             if (1-cn_stop) * 1000 > timestep:
                 continue
 
+            # per item conditioning, each item spans the same number of rows
+            if cn_cond.shape[0] > 1 and cn_cond.shape[0] != latents.shape[0]:
+                cn_cond = cn_cond.repeat_interleave(latents.shape[0] // cn_cond.shape[0], dim=0)
+
             down, mid = self.controlnets[i](
                 latents, timestep,
                 encoder_hidden_states=encoder_hidden_states,
@@ -142,7 +153,8 @@ class ControlledUNET:
                 conditioning_scale=cn_scale,
                 return_dict=False,
                 guess_mode=cn_guess,
-                added_cond_kwargs = kwargs["added_cond_kwargs"]
+                added_cond_kwargs = kwargs["added_cond_kwargs"],
+                cross_attention_kwargs = cross_attention_kwargs
             )
             if down_samples == None or mid_sample == None:
                 down_samples, mid_sample = down, mid
@@ -26,15 +26,21 @@ class ADetailer(YOLO):
         return bboxs
 
     def predict_masks(self, image, confidence=0.5, mode="rectangle"):
+        return self.predict_masks_batch([image], confidence, mode)[0]
+
+    def predict_masks_batch(self, images, confidence=0.5, mode="rectangle"):
+        # one detection call for the whole batch, a (processed, preview) pair per image
         self.to(torch.float32)
-        pred = self(image, conf=confidence)
+        preds = self(images, conf=confidence)
+        return [self.process_prediction(pred, image, confidence, mode) for pred, image in zip(preds, images)]
 
-        preview = pred[0].plot()
+    def process_prediction(self, pred, image, confidence, mode):
+        preview = pred.plot()
         preview = PIL.Image.fromarray(preview[:, :, ::-1])
 
         masks = []
-        if pred[0].masks is None:
-            boxes = pred[0].boxes.xyxy.cpu().numpy().tolist()
+        if pred.masks is None:
+            boxes = pred.boxes.xyxy.cpu().numpy().tolist()
             #boxes = self.merge_bbox(boxes, max_overlap=0.5)
             for box in boxes:
                 mask = PIL.Image.new("L", image.size, 0)
@@ -45,13 +51,13 @@ class ADetailer(YOLO):
                     mask_draw.ellipse(box, fill=255)
                 masks.append(mask)
         else:
-            masks = pred[0].masks.data
+            masks = pred.masks.data
             masks = [to_pil_image(masks[i], mode="L").resize(image.size) for i in range(masks.shape[0])]
 
         processed = []
         for i in range(len(masks)):
-            conf = pred[0].boxes[i].conf.item()
-            cls = pred[0].names[pred[0].boxes[i].cls.item()]
+            conf = pred.boxes[i].conf.item()
+            cls = pred.names[pred.boxes[i].cls.item()]
             if conf < confidence:
                 continue
             processed += [(cls, masks[i])]
@@ -21,6 +21,17 @@ class GuidedDenoiser():
         self.cfg_pp = False
         self.uncond_pred = None
 
+        self.cfg_truncation = None
+        self.cfg_interval = None
+        self.uncond_delta = None
+        self.skip_uncond = False
+        self.total_steps = None
+
+        self.cache_interval = None
+        self.cache_depth = None
+        self.cache_start = None
+        self.cache_end = None
+
         self.predictions = None
 
         self.inpainting_input = None
@@ -41,6 +52,45 @@ class GuidedDenoiser():
 
     def get_conditioning(self):
         self.compositions = self.conditioning_schedule.get_compositions(self.dtype, self.device)
+        self.build_composition()
+
+    def build_composition(self):
+        # flatten the per-item compositions into gather/scatter indices so that
+        # expanding the latents and composing the predictions are batched ops
+        input_index, pos_index, pos_batch, pos_first, neg_index, neg_batch = [], [], [], [], [], []
+        masks, pos_weights, neg_weights, neg_totals, pos_counts = [], [], [], [], []
+
+        i = 0
+        for b, ((m, p), n) in enumerate(self.compositions):
+            pos_len, neg_len = len(p), len(n)
+            input_index += [b] * (pos_len + neg_len)
+            pos_first += [len(pos_index)]
+            pos_index += list(range(i, i+pos_len))
+            pos_batch += [b] * pos_len
+            neg_index += list(range(i+pos_len, i+pos_len+neg_len))
+            neg_batch += [b] * neg_len
+            masks += [m]
+            pos_weights += [p]
+            neg_weights += [n]
+            neg_totals += [torch.sum(n).reshape(1,1,1,1)]
+            pos_counts += [pos_len]
+            i += pos_len + neg_len
+
+        # text compositions have (P,1,1,1) masks, area compositions have spatial ones
+        mask_shape = max([m.shape[1:] for m in masks], key=lambda s: s.numel())
+        masks = [m.expand(m.shape[0], *mask_shape) for m in masks]
+
+        index = lambda idx: torch.tensor(idx, dtype=torch.long, device=self.device)
+        self.input_index = index(input_index)
+        self.pos_entries = pos_index
+        self.pos_index, self.pos_batch, self.pos_first = index(pos_index), index(pos_batch), index(pos_first)
+        self.neg_index, self.neg_batch = index(neg_index), index(neg_batch)
+        self.pos_counts = torch.tensor(pos_counts, dtype=torch.float32, device=self.device)
+
+        self.pos_masks = torch.cat(masks)
+        self.pos_weights = torch.cat(pos_weights)
+        self.neg_weights = torch.cat(neg_weights)
+        self.neg_totals = torch.cat(neg_totals)
 
     def set_unet(self, unet):
         self.unet = unet
@@ -61,6 +111,35 @@ class GuidedDenoiser():
     def set_cfg_pp(self, cfg_pp):
         self.cfg_pp = cfg_pp
 
+    def set_cfg_skipping(self, truncation, interval):
+        self.cfg_truncation = truncation
+        self.cfg_interval = interval
+
+    def set_feature_cache(self, interval, depth, start, end):
+        self.cache_interval = interval
+        self.cache_depth = depth
+        self.cache_start = start
+        self.cache_end = end
+
+    def set_total_steps(self, steps):
+        self.total_steps = steps
+        self.uncond_delta = None
+        self.skip_uncond = False
+
+        feature_cache = getattr(self.unet, "feature_cache", None)
+        if feature_cache:
+            if self.cache_interval and self.cache_interval > 1:
+                feature_cache.attach(self.cache_depth or 1)
+            else:
+                feature_cache.detach()
+
+    def finish(self):
+        self.uncond_delta = None
+        self.skip_uncond = False
+        feature_cache = getattr(self.unet, "feature_cache", None)
+        if feature_cache:
+            feature_cache.detach()
+
     def set_prediction_type(self, prediction_type):
         self.override_prediction_type = prediction_type
 
@@ -89,12 +168,9 @@ class GuidedDenoiser():
         return latents
     
     def get_model_inputs(self, latents):
-        model_input = []
-        for i, ((m, p), n) in enumerate(self.compositions):
-            model_input += [latents[i:i+1]]*(len(p) + len(n))
-        model_input = torch.cat(model_input)
-
-        return model_input
+        if self.skip_uncond:
+            return latents.index_select(0, self.pos_batch)
+        return latents.index_select(0, self.input_index)
     
     def get_additional_inputs(self, latents):
         if self.inpainting_input != None:
@@ -102,41 +178,49 @@ class GuidedDenoiser():
             latents = torch.cat([latents, inpainting_inputs], dim=1)
         return latents
     
+    def grouped_std(self, x, index, counts):
+        # torch.std over each group of rows, accumulated in at least fp32
+        x = x.flatten(1).to(torch.promote_types(x.dtype, torch.float32))
+        counts = counts.to(x.dtype) * x.shape[1]
+        mean = x.new_zeros(counts.shape).index_add_(0, index, x.sum(dim=1)) / counts
+        var = x.new_zeros(counts.shape).index_add_(0, index, ((x - mean[index, None])**2).sum(dim=1))
+        return (var / (counts - 1)).sqrt()
+
     def compose_predictions(self, pred):
-        composed_pred = []
-        composed_uncond_pred = [] if self.cfg_pp else None
-        i = 0
-        for (masks, pos_weights), neg_weights in self.compositions:
-            pos_len, neg_len = len(pos_weights), len(neg_weights)
-            pos = pred[i:i+pos_len]
-            neg = pred[i+pos_len:i+pos_len+neg_len]
-
-            # Apply composition
-            neg = (neg*neg_weights).sum(dim=0, keepdims=True) / torch.sum(neg_weights)
-            pos = pos * masks + (neg * (1 - masks))
-
-            scale = self.scale
-
-            # CFG++
-            if self.cfg_pp:
-                composed_uncond_pred += [neg]
-
-            # Apply CFG
-            cfg = neg + ((pos - neg) * (pos_weights * scale)).sum(dim=0, keepdims=True)
-
-            # Rescale CFG
-            if self.cfg_rescale:
-                std = (torch.std(pos)/torch.std(cfg))
-                factor = self.cfg_rescale*std + (1-self.cfg_rescale)
-                cfg = cfg * factor
-            
-            composed_pred += [cfg]
-            i += pos_len + neg_len
-        
+        batch_size = self.neg_totals.shape[0]
+        shape = (batch_size, *pred.shape[1:])
+
+        if self.skip_uncond:
+            # only the positives were evaluated, the first positive stands in for the negative
+            pos = pred
+            neg = pos[self.pos_first]
+            if self.uncond_delta != None:
+                neg = neg + self.uncond_delta
+        else:
+            pos = pred[self.pos_index]
+            neg = pred.new_zeros(shape).index_add_(0, self.neg_batch, pred[self.neg_index] * self.neg_weights) / self.neg_totals
+            if self.cfg_interval:
+                self.uncond_delta = neg - pos[self.pos_first]
+
+        # Apply composition
+        neg_expanded = neg[self.pos_batch]
+        pos = pos * self.pos_masks + (neg_expanded * (1 - self.pos_masks))
+
+        # CFG++
         if self.cfg_pp:
-            self.uncond_pred = torch.cat(composed_uncond_pred)
-        
-        return torch.cat(composed_pred)
+            self.uncond_pred = neg
+
+        # Apply CFG
+        cfg = neg + pred.new_zeros(shape).index_add_(0, self.pos_batch, (pos - neg_expanded) * (self.pos_weights * self.scale))
+
+        # Rescale CFG
+        if self.cfg_rescale:
+            pos_std = self.grouped_std(pos, self.pos_batch, self.pos_counts)
+            std = pos_std / cfg.flatten(1).to(pos_std.dtype).std(dim=1)
+            factor = self.cfg_rescale*std + (1-self.cfg_rescale)
+            cfg = cfg * factor.to(cfg.dtype).reshape(-1,1,1,1)
+
+        return cfg
 
     def predict_noise(self, latents, timestep, alpha):
         model_input = self.get_model_inputs(latents)
@@ -195,9 +279,47 @@ class GuidedDenoiser():
         self.additional_conditioning = self.conditioning_schedule.get_additional_conditioning_at_step(step, self.dtype, self.device)
         self.additional_kwargs = self.conditioning_schedule.get_additional_attention_kwargs_at_step(step)
         self.unet.additional.set_strength(self.conditioning_schedule.get_networks_at_step(step))
+
+        self.skip_uncond = self.get_skip_uncond(step)
+        if self.skip_uncond:
+            self.conditioning = self.conditioning[self.pos_index]
+            self.additional_conditioning = {k: v[self.pos_index] for k, v in self.additional_conditioning.items()}
+            self.additional_kwargs = {k: [v[i] for i in self.pos_entries] for k, v in self.additional_kwargs.items()}
+
+        feature_cache = getattr(self.unet, "feature_cache", None)
+        if feature_cache and feature_cache.depth:
+            feature_cache.set_mode(self.get_cache_mode(step))
+
+    def get_skip_uncond(self, step):
+        if not self.total_steps:
+            return False
+
+        # CFG truncation, guidance is dropped entirely for the remaining steps
+        if self.cfg_truncation and step >= int(self.total_steps * self.cfg_truncation):
+            self.uncond_delta = None
+            return True
+
+        # CFG interval, the negatives are evaluated every N steps and the delta reused in between
+        if self.cfg_interval and self.cfg_interval > 1 and self.uncond_delta != None:
+            return step % self.cfg_interval != 0
+
+        return False
+
+    def get_cache_mode(self, step):
+        if not self.total_steps or not self.cache_interval or self.cache_interval <= 1:
+            return None
+
+        # DeepCache, the deep features are computed every N steps within the window and reused in between
+        start = int(self.total_steps * (self.cache_start or 0.0))
+        end = int(self.total_steps * (self.cache_end or 1.0))
+        if step < start or step >= end:
+            return None
+        return "store" if (step - start) % self.cache_interval == 0 else "reuse"
         
     def reset(self):
         self.mask = None
         self.original = None
         self.conditioning = None
+        self.uncond_delta = None
+        self.skip_uncond = False
         self.get_conditioning()
\ No newline at end of file
@@ -2,16 +2,47 @@ import torch
 import tqdm
 import numpy as np
 
-def txt2img(denoiser, sampler, noise, steps, callback):
+def prediction_change(previous, current):
+    # relative RMS change of the predicted originals, worst case over the batch
+    dims = list(range(1, current.ndim))
+    difference = (current.float() - previous.float()).pow(2).mean(dims).sqrt()
+    scale = previous.float().pow(2).mean(dims).sqrt().clamp(min=1e-6)
+    return (difference / scale).max().item()
+
+def txt2img(denoiser, sampler, noise, steps, callback, tolerance=None, patience=3):
     schedule = sampler.scheduler.get_schedule(steps)
 
+    # samplers are reused across tiles, regions and images, multistep history must not carry over
+    sampler.reset()
     latents = sampler.prepare_noise(noise(), schedule)
+    denoiser.set_total_steps(steps)
+
+    previous, converged = None, 0
+
+    # an abort from the callback must not leave the feature cache attached
+    try:
+        iter = tqdm.trange(steps, disable=False)
+        for i in iter:
+            denoiser.set_step(i)
+            latents = sampler.step(latents, schedule, i, noise)
 
-    iter = tqdm.trange(steps, disable=False)
-    for i in iter:
-        denoiser.set_step(i)
-        latents = sampler.step(latents, schedule, i, noise)
-        callback(iter.format_dict, denoiser.predictions)
+            if tolerance and i < steps - 1:
+                # adaptive steps, once the predicted original stops changing jump straight to it
+                current = denoiser.predictions
+                if previous != None:
+                    converged = converged + 1 if prediction_change(previous, current) < tolerance else 0
+                previous = current
+                if converged >= patience:
+                    latents = current.to(latents.dtype)
+                    progress = dict(iter.format_dict)
+                    progress["saved"] = steps - i - 1
+                    callback(progress, denoiser.predictions)
+                    iter.close()
+                    break
+
+            callback(iter.format_dict, denoiser.predictions)
+    finally:
+        denoiser.finish()
     return latents
 
 def img2img(latents, denoiser, sampler, noise, steps, do_exact_steps, strength, callback):
@@ -27,10 +58,15 @@ def img2img(latents, denoiser, sampler, noise, steps, do_exact_steps, strength,
     latents = latents.to(denoiser.unet.dtype)
 
     if scheduled_steps != 0:
+        sampler.reset()
         latents = sampler.prepare_latents(latents, noise(), schedule)
-        iter = tqdm.trange(steps, disable=False)
-        for i in iter:
-            denoiser.set_step(i)
-            latents = sampler.step(latents, schedule, i, noise)
-            callback(iter.format_dict, denoiser.predictions)
+        denoiser.set_total_steps(steps)
+        try:
+            iter = tqdm.trange(steps, disable=False)
+            for i in iter:
+                denoiser.set_step(i)
+                latents = sampler.step(latents, schedule, i, noise)
+                callback(iter.format_dict, denoiser.predictions)
+        finally:
+            denoiser.finish()
     return latents
\ No newline at end of file
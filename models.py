@@ -1,6 +1,7 @@
 import os
 import torch
 import utils
+import attention
 
 from lora import LycorisNetwork
 from detailer import ADetailer
@@ -37,8 +38,12 @@ class UNET(UNet2DConditionModel):
         super().__init__(**UNET.get_config(model_type, model_variant))
         self.to(dtype)
         self.additional = None
+        self.feature_cache = FeatureCache(self)
 
     def __call__(self, *args, **kwargs):
+        if self.feature_cache.depth:
+            self.feature_cache.begin(args[0] if args else kwargs["sample"])
+
         if self.additional:
             if not 'added_cond_kwargs' in kwargs:
                 kwargs['added_cond_kwargs'] = {}
@@ -49,6 +54,12 @@ class UNET(UNet2DConditionModel):
                     kwargs['cross_attention_kwargs'][k] = v
                 del kwargs['added_cross_kwargs']
 
+            if 'regional_masks' in kwargs['cross_attention_kwargs']:
+                sample = args[0] if args else kwargs["sample"]
+                masks = kwargs['cross_attention_kwargs'].pop('regional_masks')
+                if any(masks):
+                    kwargs['cross_attention_kwargs']['regional_masks'] = attention.RegionalMask(masks, sample.shape[-2:])
+
         return super().__call__(*args, **kwargs)
         
     @staticmethod
@@ -140,6 +151,72 @@ class UNET(UNet2DConditionModel):
         self.prediction_type = "v" if is_v else "epsilon"
         #print("DETECTED", self.prediction_type, "PREDICTION")
 
+class FeatureCache():
+    # DeepCache style reuse of the deep UNET blocks across steps. on a reused step only
+    # the outer `depth` levels (and the ControlNet residuals added to them) are recomputed
+    def __init__(self, unet):
+        self.unet = unet
+        self.depth = 0
+        self.blocks = {}
+        self.outputs = {}
+        self.mode = None
+        self.key = None
+        self.reuse = False
+        self.store = False
+
+    def attach(self, depth):
+        depth = max(1, min(int(depth), len(self.unet.down_blocks) - 1))
+        if depth == self.depth:
+            return
+        self.detach()
+        self.depth = depth
+
+        deep = [(f"down_{i}", b) for i, b in enumerate(self.unet.down_blocks) if i >= depth]
+        deep += [("mid", self.unet.mid_block)]
+        deep += [(f"up_{i}", b) for i, b in enumerate(self.unet.up_blocks) if i < len(self.unet.up_blocks) - depth]
+
+        for name, block in deep:
+            self.blocks[name] = (block, block.forward)
+            block.forward = self.wrap(name, block.forward)
+
+    def detach(self):
+        for block, forward in self.blocks.values():
+            block.forward = forward
+        self.blocks = {}
+        self.depth = 0
+        self.clear()
+
+    def clear(self):
+        self.outputs = {}
+        self.mode = None
+        self.key = None
+        self.reuse = False
+        self.store = False
+
+    def set_mode(self, mode):
+        self.mode = mode
+        if mode == None:
+            self.outputs = {}
+            self.key = None
+
+    def begin(self, sample):
+        key = (tuple(sample.shape), sample.dtype, sample.device)
+        self.reuse = self.mode == "reuse" and self.key == key and len(self.outputs) == len(self.blocks)
+        self.store = self.mode != None and not self.reuse
+        if self.store:
+            self.outputs = {}
+            self.key = key
+
+    def wrap(self, name, forward):
+        def cached_forward(*args, **kwargs):
+            if self.reuse:
+                return self.outputs[name]
+            output = forward(*args, **kwargs)
+            if self.store:
+                self.outputs[name] = output
+            return output
+        return cached_forward
+
 class VAE(AutoencoderKL):
     def __init__(self, model_type, dtype):
         self.model_type = model_type
@@ -108,4 +108,5 @@ def model_preview(latents, vae):
     return outputs
 
 def full_preview(latents, vae):
-    return utils.postprocess_images(vae.decode(latents.to(vae.dtype)).sample / vae.scaling_factor)
\ No newline at end of file
+    with utils.VAE_LOCK:
+        return utils.postprocess_images(vae.decode(latents.to(vae.dtype)).sample / vae.scaling_factor)
\ No newline at end of file
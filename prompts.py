@@ -348,6 +348,7 @@ class ConditioningSchedule():
         self.areas = None
         self.HR = False
         self.model_type = None
+        self.area_mode = "Composition"
         self.parse()
 
     def switch_to_HR(self, hr, steps):
@@ -413,18 +414,26 @@ class ConditioningSchedule():
         
         return local_networks
     
+    def is_regional(self):
+        # regions are applied as attention masks over a single merged positive
+        return self.area_mode == "Attention" and bool(self.areas) and len(self.positives) > 1
+
     def get_conditioning_at_step(self, step):
-        return [p.get_encoding_at_step(step) for p in self.positives] + \
-               [n.get_encoding_at_step(step) for n in self.negatives]
+        if self.is_regional():
+            positives = [torch.cat([p.get_encoding_at_step(step) for p in self.positives], dim=1)]
+        else:
+            positives = [p.get_encoding_at_step(step) for p in self.positives]
+        return positives + [n.get_encoding_at_step(step) for n in self.negatives]
     
     def get_additional_conditioning_at_step(self, step):
         out = {}
 
         if self.model_type == "SDXL-Base":
-            text_embeds = [p.get_pooled_text_embed_at_step(step) for p in self.positives] + \
+            positives = self.positives[:1] if self.is_regional() else self.positives
+            text_embeds = [p.get_pooled_text_embed_at_step(step) for p in positives] + \
                         [n.get_pooled_text_embed_at_step(step) for n in self.negatives]
             z = 1024
-            time_ids = [torch.tensor([z, z, 0, 0, z, z]) for _ in self.positives + self.negatives]
+            time_ids = [torch.tensor([z, z, 0, 0, z, z]) for _ in positives + self.negatives]
             out["text_embeds"] = text_embeds
             out["time_ids"] = time_ids
         
@@ -432,8 +441,21 @@ class ConditioningSchedule():
 
     def get_additional_attention_kwargs_at_step(self, step):    
         out = {}
-        inversions = [p.get_inversions_at_step(step) for p in self.positives] + \
-                     [n.get_inversions_at_step(step) for n in self.negatives]
+        if self.is_regional():
+            length = self.positives[0].get_encoding_at_step(step).shape[1]
+            merged = []
+            for i, p in enumerate(self.positives):
+                merged += [t + i * length for t in p.get_inversions_at_step(step)]
+            inversions = [merged] + [n.get_inversions_at_step(step) for n in self.negatives]
+
+            shape = self.areas[0].shape[-2:]
+            masks = [torch.ones(shape)]
+            for i in range(1, len(self.positives)):
+                masks += [self.areas[i-1][0,0].float() if i-1 < len(self.areas) else torch.ones(shape)]
+            out["regional_masks"] = [masks] + [[] for _ in self.negatives]
+        else:
+            inversions = [p.get_inversions_at_step(step) for p in self.positives] + \
+                         [n.get_inversions_at_step(step) for n in self.negatives]
         out["token_inversions"] = inversions
         return out
     
@@ -444,7 +466,12 @@ class ConditioningSchedule():
 
         neg_w = [n.weight or 1.0 for n in self.negatives]
 
-        if self.areas:
+        if self.is_regional():
+            pos = torch.tensor(pos_w[:1], dtype=dtype, device=device).reshape(-1,1,1,1)
+            neg = torch.tensor(neg_w, dtype=dtype, device=device).reshape(-1,1,1,1)
+            mask = torch.ones((1,1,1,1), dtype=dtype, device=device)
+            return [(pos, mask), neg]
+        elif self.areas:
             weights = torch.tensor(pos_w, dtype=dtype, device=device).reshape(-1,1,1,1)
             shape = self.areas[0].shape
             pos = [torch.ones(shape, dtype=dtype, device=device)] * len(self.positives)
@@ -465,6 +492,7 @@ class BatchedConditioningSchedules():
         self.steps = steps
         self.clip_skip = clip_skip
         self.batch_size = len(prompts)
+        self.area_mode = "Composition"
         self.parse()
 
     def switch_to_HR(self, hr_steps):
@@ -475,6 +503,12 @@ class BatchedConditioningSchedules():
         self.batches = []
         for i, (positive, negative) in enumerate(self.prompts):
             self.batches += [ConditioningSchedule(positive, negative, self.steps, self.clip_skip)]
+        self.set_area_mode(self.area_mode)
+
+    def set_area_mode(self, area_mode):
+        self.area_mode = area_mode
+        for b in self.batches:
+            b.area_mode = area_mode
     
     def encode(self, clip, areas):
         max_chunks = 0
@@ -520,6 +554,9 @@ class BatchedConditioningSchedules():
         conditioning = []
         for b in self.batches:
             conditioning += b.get_conditioning_at_step(step)
+        # regional rows are longer, the rest are padded with zeros that the attention masks out
+        length = max(c.shape[1] for c in conditioning)
+        conditioning = [torch.nn.functional.pad(c, (0, 0, 0, length - c.shape[1])) for c in conditioning]
         cond = torch.cat(conditioning).to(device, dtype)
         return cond
     
@@ -541,8 +578,13 @@ class BatchedConditioningSchedules():
     def get_additional_attention_kwargs_at_step(self, step):
         add_kwargs = {}
 
+        # only regional schedules have masks, the other rows get empty ones to keep the rows aligned
+        regional = any(b.is_regional() for b in self.batches)
+
         for b in self.batches:
             b_add_kwargs = b.get_additional_attention_kwargs_at_step(step)
+            if regional and not "regional_masks" in b_add_kwargs:
+                b_add_kwargs["regional_masks"] = [[] for _ in b_add_kwargs["token_inversions"]]
             for k, v in b_add_kwargs.items():
                 if not k in add_kwargs:
                     add_kwargs[k] = []
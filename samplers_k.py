@@ -1,10 +1,18 @@
 import torch
 import numpy as np
-from k_diffusion.sampling import get_ancestral_step, to_d, BrownianTreeNoiseSampler, append_zero
+import math
+from k_diffusion.sampling import get_ancestral_step, to_d, append_zero
 from k_diffusion.sampling import get_sigmas_karras, get_sigmas_exponential
 
 MN, MX = 0.0312652550637722, 14.611639022827148
 
+# Align Your Steps noise levels for 10 steps (Sabour et al. 2024), SDv2 shares the SDv1 training schedule
+AYS_SCHEDULES = {
+    "SDv1": [14.615, 6.475, 3.861, 2.697, 1.886, 1.396, 0.963, 0.652, 0.399, 0.152, 0.029],
+    "SDv2": [14.615, 6.475, 3.861, 2.697, 1.886, 1.396, 0.963, 0.652, 0.399, 0.152, 0.029],
+    "SDXL-Base": [14.615, 6.315, 3.771, 2.181, 1.342, 0.862, 0.555, 0.380, 0.234, 0.113, 0.029],
+}
+
 class KScheduler():
     def __init__(self):
         self.sigmas, self.log_sigmas = self.get_sigmas()
@@ -97,41 +105,182 @@ class KSampler():
     def reset(self):
         pass
 
+# BrownianInterval and the tree walk in BatchedBrownianNoise are adapted from torchsde
+# (https://github.com/google-research/torchsde, torchsde/_brownian/brownian_interval.py),
+# modified to hold per-seed states for a whole batch.
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+class BrownianInterval():
+    __slots__ = ('start', 'end', 'parent', 'is_left', 'midway', 'spawn_key', 'depth', 'seeds', 'left', 'right')
+
+    def __init__(self, start, end, parent, is_left, tree):
+        self.start = tree.round(start)
+        self.end = tree.round(end)
+        self.parent = parent
+        self.is_left = is_left
+        self.midway = None
+
+class BatchedBrownianNoise():
+    # seed compatible batched version of the torchsde.BrownianTree used by k_diffusion's BrownianTreeNoiseSampler.
+    # the dyadic tree only depends on the query points, so one tree is walked for the whole batch and each node
+    # holds the per-seed SeedSequence states. the entropy is drawn from a private generator, never the global RNG
+    def __init__(self, x, sigma_min, sigma_max, seeds, tol=1e-6, pool_size=24, cache_size=45):
+        self.size = x[0][None,:].shape
+        self.dtype = x.dtype
+        self.device = x.device
+        self.pool_size = pool_size
+        self.cache_size = cache_size
+        self.generator = torch.Generator(self.device)
+
+        self.entropy = []
+        for seed in seeds:
+            generator = torch.Generator().manual_seed(seed)
+            self.entropy += [torch.randint(0, 2 ** 63 - 1, [], generator=generator).item()]
+
+        ndigits = -int(math.log10(tol))
+        self.round = lambda x: round(x, ndigits)
+
+        t0, t1 = torch.as_tensor(sigma_min), torch.as_tensor(sigma_max)
+        t0, t1, self.sign = (t0, t1, 1) if t0 < t1 else (t1, t0, -1)
+        t0, t1 = float(t0), float(t1)
+
+        self.top = BrownianInterval(t0, t1, None, None, self)
+        self.top.spawn_key, self.top.depth = 0, 0
+        seeds = [np.random.SeedSequence(entropy=e, pool_size=pool_size).generate_state(3)[0] for e in self.entropy]
+        self.top_W = self.randn(seeds) * math.sqrt(t1 - t0)
+        self.last = self.top
+        self.cache = {}
+
+    def randn(self, seeds):
+        noise = torch.empty((len(seeds), *self.size[1:]), dtype=self.dtype, device=self.device)
+        for i, seed in enumerate(seeds):
+            self.generator.manual_seed(int(seed))
+            torch.randn(self.size, generator=self.generator, out=noise[i:i+1])
+        return noise
+
+    def split(self, interval, midway):
+        # halfway tree, always split at the centre and descend until the requested point is a boundary
+        while True:
+            self.split_exact(interval, 0.5 * (interval.end + interval.start))
+            if midway > interval.midway:
+                interval = interval.right
+            elif midway < interval.midway:
+                interval = interval.left
+            else:
+                return
+
+    def split_exact(self, interval, midway):
+        interval.midway = self.round(midway)
+        if interval.parent != None:
+            interval.spawn_key = 2 * interval.parent.spawn_key + (0 if interval.is_left else 1)
+            interval.depth = interval.parent.depth + 1
+        key = (interval.spawn_key, interval.depth)
+        interval.seeds = [np.random.SeedSequence(entropy=e, spawn_key=key, pool_size=self.pool_size).generate_state(4)[0] for e in self.entropy]
+        interval.left = BrownianInterval(interval.start, midway, interval, True, self)
+        interval.right = BrownianInterval(midway, interval.end, interval, False, self)
+
+    def locate(self, interval, ta, tb, out):
+        while True:
+            if ta < interval.start or tb > interval.end:
+                interval = interval.parent
+                continue
+            if ta == interval.start and tb == interval.end:
+                out.append(interval)
+                return
+            if interval.midway == None:
+                if ta == interval.start:
+                    self.split(interval, tb)
+                    interval = interval.left
+                else:
+                    self.split(interval, ta)
+                    interval = interval.right
+                continue
+            if tb <= interval.midway:
+                interval = interval.left
+            elif ta >= interval.midway:
+                interval = interval.right
+            else:
+                self.locate(interval.left, ta, interval.midway, out)
+                interval, ta = interval.right, interval.midway
+
+    def increment(self, interval):
+        # walk up to the nearest known increment then bridge back down
+        chain = []
+        while interval != self.top and not interval in self.cache:
+            chain.append(interval)
+            interval = interval.parent
+        W = self.top_W if interval == self.top else self.cache[interval]
+
+        for interval in reversed(chain):
+            parent = interval.parent
+            h_reciprocal = 1 / (parent.end - parent.start)
+            left_diff = parent.midway - parent.start
+            right_diff = parent.end - parent.midway
+
+            mean = left_diff * W * h_reciprocal
+            var = left_diff * right_diff * h_reciprocal
+            left_W = mean + math.sqrt(var) * self.randn(parent.seeds)
+            W = left_W if interval.is_left else W - left_W
+
+            self.cache.pop(interval, None)
+            if len(self.cache) >= self.cache_size:
+                del self.cache[next(iter(self.cache))]
+            self.cache[interval] = W
+        return W
+
+    def brownian(self, ta, tb):
+        ta = min(max(float(ta), self.top.start), self.top.end)
+        tb = min(max(float(tb), self.top.start), self.top.end)
+        if ta == tb:
+            return torch.zeros((len(self.entropy), *self.size[1:]), dtype=self.dtype, device=self.device)
+
+        intervals = []
+        self.locate(self.last, self.round(ta), self.round(tb), intervals)
+        self.last = intervals[-1]
+
+        W = self.increment(intervals[0])
+        for interval in intervals[1:]:
+            W = W + self.increment(interval)
+        return W
+
+    def __call__(self, sigma, sigma_next):
+        t0, t1 = torch.as_tensor(sigma), torch.as_tensor(sigma_next)
+        ta, tb, sign = (t0, t1, 1) if t0 < t1 else (t1, t0, -1)
+        w = self.brownian(ta, tb) * (self.sign * sign)
+        return w / (t1 - t0).abs().sqrt()
+
 class DPM_SDE(KSampler):
     def __init__(self, model, eta=1.0, scheduler=None):
         super().__init__(model, scheduler, eta)
         self.reset()
 
     def reset(self):
-        self.noise_samplers = []
-        self.noise_states = []
+        self.noise_sampler = None
 
     def initialize_noise(self, x, sigma_min, sigma_max, noise):
-        seeds = noise.seeds
-        shape = x[0][None,:]
-
-        for i in range(len(seeds)):
-            torch.manual_seed(seeds[i])
-            noise_sampler = BrownianTreeNoiseSampler(shape, sigma_min, sigma_max)
-            self.noise_samplers += [noise_sampler]
-            self.noise_states += [torch.get_rng_state()]
+        self.noise_sampler = BatchedBrownianNoise(x, sigma_min, sigma_max, noise.seeds)
 
     def sample_noise(self, t0, t1):
-        noises = []
-        for i in range(len(self.noise_samplers)):
-            torch.set_rng_state(self.noise_states[i])
-            noise = self.noise_samplers[i](t0, t1)
-            noises += [noise]
-            self.noise_states[i] = torch.get_rng_state()
-        
-        noises = torch.cat(noises)
-        return noises
+        return self.noise_sampler(t0, t1)
 
     def step(self, x, sigmas, i, noise):
         """DPM-Solver++ (stochastic)."""
 
         sigma_min, sigma_max = sigmas[sigmas > 0].min(), sigmas.max()
-        if not self.noise_samplers:
+        if self.noise_sampler == None:
             self.initialize_noise(x, sigma_min, sigma_max, noise)
 
         sigma_fn = lambda t: t.neg().exp()
@@ -231,40 +380,24 @@ class DPM_2M_SDE(KSampler):
     def __init__(self, model, eta=1.0, scheduler=None):
         super().__init__(model, scheduler, eta)
         self.solver_type = 'midpoint'
-        self.old_denoised = None
-        self.h_last = None
         self.reset()
 
     def reset(self):
-        self.noise_samplers = []
-        self.noise_states = []
+        self.noise_sampler = None
+        self.old_denoised = None
+        self.h_last = None
 
     def initialize_noise(self, x, sigma_min, sigma_max, noise):
-        seeds = noise.seeds
-        shape = x[0][None,:]
-
-        for i in range(len(seeds)):
-            torch.manual_seed(seeds[i])
-            noise_sampler = BrownianTreeNoiseSampler(shape, sigma_min, sigma_max)
-            self.noise_samplers += [noise_sampler]
-            self.noise_states += [torch.get_rng_state()]
+        self.noise_sampler = BatchedBrownianNoise(x, sigma_min, sigma_max, noise.seeds)
 
     def sample_noise(self, t0, t1):
-        noises = []
-        for i in range(len(self.noise_samplers)):
-            torch.set_rng_state(self.noise_states[i])
-            noise = self.noise_samplers[i](t0, t1)
-            noises += [noise]
-            self.noise_states[i] = torch.get_rng_state()
-        
-        noises = torch.cat(noises)
-        return noises
+        return self.noise_sampler(t0, t1)
 
     def step(self, x, sigmas, i, noise):
         """DPM-Solver++(2M) SDE."""
 
         sigma_min, sigma_max = sigmas[sigmas > 0].min(), sigmas.max()
-        if not self.noise_samplers:
+        if self.noise_sampler == None:
             self.initialize_noise(x, sigma_min, sigma_max, noise)
 
         denoised = self.predict(x, sigmas[i])
@@ -298,40 +431,24 @@ class DPM_2M_SDE(KSampler):
 class DPM_3M_SDE(KSampler):
     def __init__(self, model, eta=1.0, scheduler=None):
         super().__init__(model, scheduler, eta)
-        self.old_denoised_1, self.old_denoised_2 = None, None
-        self.h_last_1, self.h_last_2 = None, None
         self.reset()
 
     def reset(self):
-        self.noise_samplers = []
-        self.noise_states = []
+        self.noise_sampler = None
+        self.old_denoised_1, self.old_denoised_2 = None, None
+        self.h_last_1, self.h_last_2 = None, None
 
     def initialize_noise(self, x, sigma_min, sigma_max, noise):
-        seeds = noise.seeds
-        shape = x[0][None,:]
-
-        for i in range(len(seeds)):
-            torch.manual_seed(seeds[i])
-            noise_sampler = BrownianTreeNoiseSampler(shape, sigma_min, sigma_max)
-            self.noise_samplers += [noise_sampler]
-            self.noise_states += [torch.get_rng_state()]
+        self.noise_sampler = BatchedBrownianNoise(x, sigma_min, sigma_max, noise.seeds)
 
     def sample_noise(self, t0, t1):
-        noises = []
-        for i in range(len(self.noise_samplers)):
-            torch.set_rng_state(self.noise_states[i])
-            noise = self.noise_samplers[i](t0, t1)
-            noises += [noise]
-            self.noise_states[i] = torch.get_rng_state()
-        
-        noises = torch.cat(noises)
-        return noises
+        return self.noise_sampler(t0, t1)
     
     def step(self, x, sigmas, i, noise):
         """DPM-Solver++(3M) SDE."""
 
         sigma_min, sigma_max = sigmas[sigmas > 0].min(), sigmas.max()
-        if not self.noise_samplers:
+        if self.noise_sampler == None:
             self.initialize_noise(x, sigma_min, sigma_max, noise)
 
         denoised_1, denoised_2 = self.old_denoised_1, self.old_denoised_2
@@ -375,6 +492,130 @@ class DPM_3M_SDE(KSampler):
         self.old_denoised_1, self.old_denoised_2 = denoised_1, denoised_2
         return x
 
+class DPM_3M(DPM_3M_SDE):
+    def __init__(self, model, eta=1.0, scheduler=None):
+        super().__init__(model, eta, scheduler)
+        self.eta = 0.0
+
+    def initialize_noise(self, x, sigma_min, sigma_max, noise):
+        pass
+
+class UniPC(KSampler):
+    variant = "bh2"
+    order = 3
+
+    def __init__(self, model, eta=1.0, scheduler=None):
+        super().__init__(model, scheduler, eta)
+        self.reset()
+
+    def reset(self):
+        self.history = []
+        self.last_x = None
+        self.last_order = 0
+
+    def get_coefficients(self, lambdas, s, t, order):
+        # UniPC-bh coefficients for an update from lambdas[s] to lambdas[t] using the `order-1` previous outputs
+        h = lambdas[t] - lambdas[s]
+        rks = [(lambdas[s - k] - lambdas[s]) / h for k in range(1, order)] + [1.0]
+
+        hh = -h
+        h_phi_1 = math.expm1(hh)
+        h_phi_k = h_phi_1 / hh - 1
+        B_h = hh if self.variant == "bh1" else math.expm1(hh)
+
+        R, b, factorial = [], [], 1
+        for k in range(1, order + 1):
+            R += [[rk ** (k - 1) for rk in rks]]
+            b += [h_phi_k * factorial / B_h]
+            factorial *= k + 1
+            h_phi_k = h_phi_k / hh - 1 / factorial
+        R, b = np.array(R), np.array(b)
+
+        if order == 1:
+            rhos_p, rhos_c = [], [0.5]
+        else:
+            rhos_p = [0.5] if order == 2 else np.linalg.solve(R[:-1, :-1], b[:-1]).tolist()
+            rhos_c = np.linalg.solve(R, b).tolist()
+        return rks, h_phi_1, B_h, rhos_p, rhos_c
+
+    def update(self, x, sigmas, lambdas, s, t, order, denoised_t=None):
+        # predictor when denoised_t is None, otherwise the corrector for the point at t
+        rks, h_phi_1, B_h, rhos_p, rhos_c = self.get_coefficients(lambdas, s, t, order)
+        m0 = self.history[-1]
+        D1s = [(self.history[-1 - k] - m0) / rks[k - 1] for k in range(1, order)]
+
+        x_t = (float(sigmas[t]) / float(sigmas[s])) * x - h_phi_1 * m0
+        if denoised_t == None:
+            res = sum(rho * d for rho, d in zip(rhos_p, D1s))
+        else:
+            res = sum(rho * d for rho, d in zip(rhos_c[:-1], D1s)) + rhos_c[-1] * (denoised_t - m0)
+        if torch.is_tensor(res):
+            x_t = x_t - B_h * res
+        return x_t
+
+    def step(self, x, sigmas, i, noise):
+        """UniPC multistep predictor-corrector with data prediction (Zhao et al. 2023)."""
+
+        denoised = self.predict(x, sigmas[i])
+
+        if sigmas[i + 1] == 0:
+            # Denoising step
+            return denoised
+
+        lambdas = [-math.log(float(sigma)) if sigma > 0 else math.inf for sigma in sigmas]
+
+        if self.last_x != None:
+            # UniC, refine the current sample with the output just computed, no extra evaluation
+            x = self.update(self.last_x, sigmas, lambdas, i - 1, i, self.last_order, denoised)
+
+        self.history = (self.history + [denoised])[-self.order:]
+
+        steps = len(sigmas) - 1
+        order = min(self.order, len(self.history), steps - i)
+        x_next = self.update(x, sigmas, lambdas, i, i + 1, order)
+
+        self.last_x, self.last_order = x, order
+        return x_next
+
+class UniPC_BH1(UniPC):
+    variant = "bh1"
+
+class DEIS(KSampler):
+    order = 3
+
+    def __init__(self, model, eta=1.0, scheduler=None):
+        super().__init__(model, scheduler, eta)
+        self.reset()
+
+    def reset(self):
+        self.history = []
+
+    def get_coefficients(self, points, start, end):
+        # exact integrals over [start, end] of the Lagrange basis through the previous sigmas
+        coefficients = []
+        for j in range(len(points)):
+            basis = np.poly1d([1.0])
+            for k in range(len(points)):
+                if k != j:
+                    basis *= np.poly1d([1.0, -points[k]]) / (points[j] - points[k])
+            integral = np.polyint(basis)
+            coefficients += [float(integral(end) - integral(start))]
+        return coefficients
+
+    def step(self, x, sigmas, i, noise):
+        """DEIS, multistep exponential integrator with a polynomial fit of the noise prediction (Zhang & Chen 2022)."""
+
+        denoised = self.predict(x, sigmas[i])
+        d = to_d(x, sigmas[i], denoised)
+
+        self.history = (self.history + [(float(sigmas[i]), d)])[-self.order:]
+        points = [p for p, _ in self.history]
+        coefficients = self.get_coefficients(points, float(sigmas[i]), float(sigmas[i + 1]))
+
+        for c, (_, d) in zip(coefficients, self.history):
+            x = x + c * d
+        return x
+
 class Euler(KSampler):
     def __init__(self, model, eta=1.0, scheduler=None):
         super().__init__(model, scheduler, eta)
@@ -467,6 +708,20 @@ class SchedulerUniform(KScheduler):
         sigs += [0.0]
         return torch.FloatTensor(sigs).to(self.sigmas.device, self.dtype)
 
+class SchedulerAYS(KScheduler):
+    def __init__(self, model_type):
+        super().__init__()
+        self.model_type = model_type if model_type in AYS_SCHEDULES else "SDv1"
+
+    def get_schedule(self, steps):
+        # log-linear interpolation of the table to any number of steps, the final level is replaced with 0
+        table = np.array(AYS_SCHEDULES[self.model_type])
+        xs = np.linspace(0, 1, len(table))
+        ys = np.log(table[::-1])
+        sigmas = np.exp(np.interp(np.linspace(0, 1, steps + 1), xs, ys))[::-1].copy()
+        sigmas[-1] = 0.0
+        return torch.tensor(sigmas, dtype=torch.float32, device=self.sigmas.device).to(self.dtype)
+
 class Euler_Karras(Euler):
     def __init__(self, model, eta=1, scheduler=None):
         scheduler = scheduler or SchedulerKarras().to(model.device, model.dtype)
@@ -585,6 +840,66 @@ class DPM_3M_SDE_Uniform(DPM_2M):
         scheduler = scheduler or SchedulerUniform().to(model.device, model.dtype)
         super().__init__(model, eta, scheduler)
 
+class DPM_3M_Karras(DPM_3M):
+    def __init__(self, model, eta=1, scheduler=None):
+        scheduler = scheduler or SchedulerKarras().to(model.device, model.dtype)
+        super().__init__(model, eta, scheduler)
+
+class DPM_3M_Exponential(DPM_3M):
+    def __init__(self, model, eta=1, scheduler=None):
+        scheduler = scheduler or SchedulerExponential().to(model.device, model.dtype)
+        super().__init__(model, eta, scheduler)
+
+class DPM_3M_Uniform(DPM_3M):
+    def __init__(self, model, eta=1, scheduler=None):
+        scheduler = scheduler or SchedulerUniform().to(model.device, model.dtype)
+        super().__init__(model, eta, scheduler)
+
+class UniPC_Karras(UniPC):
+    def __init__(self, model, eta=1, scheduler=None):
+        scheduler = scheduler or SchedulerKarras().to(model.device, model.dtype)
+        super().__init__(model, eta, scheduler)
+
+class UniPC_Exponential(UniPC):
+    def __init__(self, model, eta=1, scheduler=None):
+        scheduler = scheduler or SchedulerExponential().to(model.device, model.dtype)
+        super().__init__(model, eta, scheduler)
+
+class UniPC_Uniform(UniPC):
+    def __init__(self, model, eta=1, scheduler=None):
+        scheduler = scheduler or SchedulerUniform().to(model.device, model.dtype)
+        super().__init__(model, eta, scheduler)
+
+class UniPC_BH1_Karras(UniPC_BH1):
+    def __init__(self, model, eta=1, scheduler=None):
+        scheduler = scheduler or SchedulerKarras().to(model.device, model.dtype)
+        super().__init__(model, eta, scheduler)
+
+class UniPC_BH1_Exponential(UniPC_BH1):
+    def __init__(self, model, eta=1, scheduler=None):
+        scheduler = scheduler or SchedulerExponential().to(model.device, model.dtype)
+        super().__init__(model, eta, scheduler)
+
+class UniPC_BH1_Uniform(UniPC_BH1):
+    def __init__(self, model, eta=1, scheduler=None):
+        scheduler = scheduler or SchedulerUniform().to(model.device, model.dtype)
+        super().__init__(model, eta, scheduler)
+
+class DEIS_Karras(DEIS):
+    def __init__(self, model, eta=1, scheduler=None):
+        scheduler = scheduler or SchedulerKarras().to(model.device, model.dtype)
+        super().__init__(model, eta, scheduler)
+
+class DEIS_Exponential(DEIS):
+    def __init__(self, model, eta=1, scheduler=None):
+        scheduler = scheduler or SchedulerExponential().to(model.device, model.dtype)
+        super().__init__(model, eta, scheduler)
+
+class DEIS_Uniform(DEIS):
+    def __init__(self, model, eta=1, scheduler=None):
+        scheduler = scheduler or SchedulerUniform().to(model.device, model.dtype)
+        super().__init__(model, eta, scheduler)
+
 class LCM_Karras(LCM):
     def __init__(self, model, eta=1, scheduler=None):
         scheduler = scheduler or SchedulerKarras().to(model.device, model.dtype)
@@ -598,4 +913,69 @@ class LCM_Exponential(LCM):
 class LCM_Uniform(LCM):
     def __init__(self, model, eta=1, scheduler=None):
         scheduler = scheduler or SchedulerUniform().to(model.device, model.dtype)
-        super().__init__(model, eta, scheduler)
\ No newline at end of file
+        super().__init__(model, eta, scheduler)
+
+class Euler_AYS(Euler):
+    def __init__(self, model, eta=1, scheduler=None):
+        scheduler = scheduler or SchedulerAYS(model.unet.model_type).to(model.device, model.dtype)
+        super().__init__(model, eta, scheduler)
+
+class Euler_a_AYS(Euler_a):
+    def __init__(self, model, eta=1, scheduler=None):
+        scheduler = scheduler or SchedulerAYS(model.unet.model_type).to(model.device, model.dtype)
+        super().__init__(model, eta, scheduler)
+
+class Euler_a_CFG_PP_AYS(Euler_a_CFG_PP):
+    def __init__(self, model, eta=1, scheduler=None):
+        scheduler = scheduler or SchedulerAYS(model.unet.model_type).to(model.device, model.dtype)
+        super().__init__(model, eta, scheduler)
+
+class DPM_2M_AYS(DPM_2M):
+    def __init__(self, model, eta=1, scheduler=None):
+        scheduler = scheduler or SchedulerAYS(model.unet.model_type).to(model.device, model.dtype)
+        super().__init__(model, eta, scheduler)
+
+class DPM_2S_a_AYS(DPM_2S_a):
+    def __init__(self, model, eta=1, scheduler=None):
+        scheduler = scheduler or SchedulerAYS(model.unet.model_type).to(model.device, model.dtype)
+        super().__init__(model, eta, scheduler)
+
+class DPM_SDE_AYS(DPM_SDE):
+    def __init__(self, model, eta=1, scheduler=None):
+        scheduler = scheduler or SchedulerAYS(model.unet.model_type).to(model.device, model.dtype)
+        super().__init__(model, eta, scheduler)
+
+class DPM_2M_SDE_AYS(DPM_2M_SDE):
+    def __init__(self, model, eta=1, scheduler=None):
+        scheduler = scheduler or SchedulerAYS(model.unet.model_type).to(model.device, model.dtype)
+        super().__init__(model, eta, scheduler)
+
+class DPM_3M_SDE_AYS(DPM_3M_SDE):
+    def __init__(self, model, eta=1, scheduler=None):
+        scheduler = scheduler or SchedulerAYS(model.unet.model_type).to(model.device, model.dtype)
+        super().__init__(model, eta, scheduler)
+
+class DPM_3M_AYS(DPM_3M):
+    def __init__(self, model, eta=1, scheduler=None):
+        scheduler = scheduler or SchedulerAYS(model.unet.model_type).to(model.device, model.dtype)
+        super().__init__(model, eta, scheduler)
+
+class UniPC_AYS(UniPC):
+    def __init__(self, model, eta=1, scheduler=None):
+        scheduler = scheduler or SchedulerAYS(model.unet.model_type).to(model.device, model.dtype)
+        super().__init__(model, eta, scheduler)
+
+class UniPC_BH1_AYS(UniPC_BH1):
+    def __init__(self, model, eta=1, scheduler=None):
+        scheduler = scheduler or SchedulerAYS(model.unet.model_type).to(model.device, model.dtype)
+        super().__init__(model, eta, scheduler)
+
+class DEIS_AYS(DEIS):
+    def __init__(self, model, eta=1, scheduler=None):
+        scheduler = scheduler or SchedulerAYS(model.unet.model_type).to(model.device, model.dtype)
+        super().__init__(model, eta, scheduler)
+
+class LCM_AYS(LCM):
+    def __init__(self, model, eta=1, scheduler=None):
+        scheduler = scheduler or SchedulerAYS(model.unet.model_type).to(model.device, model.dtype)
+        super().__init__(model, eta, scheduler)
@@ -0,0 +1,1067 @@
+#!/usr/bin/env python3
+"""
+CPU benchmarks for the sampling pipeline, run against small stand-in models
+Usage: python benchmark.py <benchmark> [--steps 20] [--batch 4] ...
+"""
+
+import io
+import os
+import sys
+import time
+import argparse
+import types
+
+import numpy as np
+import PIL.Image
+import torch
+
+# Add parent directory to path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import guidance
+import inference
+import samplers_k
+import samplers_ddpm
+import utils
+
+SAMPLERS = {
+    "Euler": samplers_k.Euler,
+    "Euler a": samplers_k.Euler_a,
+    "DDIM": samplers_ddpm.DDIM,
+    "DPM++ 2M": samplers_k.DPM_2M,
+    "DPM++ 2M Karras": samplers_k.DPM_2M_Karras,
+    "DPM++ SDE Karras": samplers_k.DPM_SDE_Karras,
+    "DPM++ 2M SDE Karras": samplers_k.DPM_2M_SDE_Karras,
+}
+
+class ToyNetworks():
+    def set_strength(self, strength):
+        pass
+
+class ToyUNET(torch.nn.Module):
+    # tiny conditional denoiser with the calling convention of models.UNET
+    def __init__(self, context_dim=64, hidden=32, dtype=torch.float32):
+        super().__init__()
+        generator = torch.Generator().manual_seed(0)
+        self.conv_in = torch.nn.Conv2d(4, hidden, 3, padding=1)
+        self.context = torch.nn.Linear(context_dim, hidden)
+        self.conv_mid = torch.nn.Conv2d(hidden, hidden, 3, padding=1)
+        self.conv_out = torch.nn.Conv2d(hidden, 4, 3, padding=1)
+        for p in self.parameters():
+            p.data = torch.randn(p.shape, generator=generator) * 0.05
+        self.to(dtype)
+
+        self.model_type = "SDv1"
+        self.prediction_type = "epsilon"
+        self.inpainting = False
+        self.additional = ToyNetworks()
+        self.evaluations = 0
+        self.calls = 0
+
+    @property
+    def device(self):
+        return next(self.parameters()).device
+
+    @property
+    def dtype(self):
+        return next(self.parameters()).dtype
+
+    def determine_type(self):
+        pass
+
+    def forward(self, latents, timestep, encoder_hidden_states, **kwargs):
+        self.calls += 1
+        self.evaluations += latents.shape[0]
+        t = (timestep.reshape(-1, 1, 1, 1).to(latents.dtype) / 1000)
+        h = torch.nn.functional.silu(self.conv_in(latents))
+        h = h + self.context(encoder_hidden_states.mean(dim=1))[:, :, None, None] * (1 + t)
+        h = torch.nn.functional.silu(self.conv_mid(h))
+        return types.SimpleNamespace(sample=latents * 0.1 + self.conv_out(h))
+
+class ToyConditioning():
+    # stands in for prompts.BatchedConditioningSchedules with fixed random encodings
+    def __init__(self, batch_size, positives=1, negatives=1, context_dim=64, tokens=77, seed=0):
+        generator = torch.Generator().manual_seed(seed)
+        self.batch_size = batch_size
+        self.positives = positives
+        self.negatives = negatives
+        self.encodings = [torch.randn((1, tokens, context_dim), generator=generator) for _ in range(batch_size * (positives + negatives))]
+
+    def get_compositions(self, dtype, device):
+        compositions = []
+        for _ in range(self.batch_size):
+            pos_w = [1.0] + [0.8] * (self.positives - 1)
+            pos = torch.tensor(pos_w, dtype=dtype, device=device).reshape(-1,1,1,1)
+            neg = torch.tensor([1.0] * self.negatives, dtype=dtype, device=device).reshape(-1,1,1,1)
+            mask = torch.tensor([1] * self.positives, dtype=dtype, device=device).reshape(-1,1,1,1)
+            compositions += [[(pos, mask), neg]]
+        return compositions
+
+    def get_conditioning_at_step(self, step, dtype, device):
+        return torch.cat(self.encodings).to(device, dtype)
+
+    def get_additional_conditioning_at_step(self, step, dtype, device):
+        return {}
+
+    def get_additional_attention_kwargs_at_step(self, step):
+        return {}
+
+    def get_networks_at_step(self, step, idx=0):
+        return [{}]
+
+def tiny_unet(context_dim=64, dtype=torch.float32):
+    # a small randomly initialized models.UNET, so block level features are real
+    import models
+    import attention
+    from diffusers import UNet2DConditionModel
+
+    class TinyUNET(models.UNET):
+        def __init__(self):
+            self.model_type = "SDv1"
+            self.model_variant = ""
+            self.inpainting = False
+            self.prediction_type = "epsilon"
+            self.upcast_attention = False
+            self.determined = True
+            UNet2DConditionModel.__init__(self,
+                block_out_channels=(32, 64, 64, 64), layers_per_block=1, attention_head_dim=8,
+                down_block_types=("CrossAttnDownBlock2D",)*3 + ("DownBlock2D",),
+                up_block_types=("UpBlock2D",) + ("CrossAttnUpBlock2D",)*3,
+                cross_attention_dim=context_dim, norm_num_groups=8)
+            self.additional = None
+            self.feature_cache = models.FeatureCache(self)
+            self.evaluations = 0
+            self.calls = 0
+
+        def __call__(self, latents, *args, **kwargs):
+            self.calls += 1
+            self.evaluations += latents.shape[0]
+            return super().__call__(latents, *args, **kwargs)
+
+    torch.manual_seed(0)
+    unet = TinyUNET().to(dtype)
+    unet.additional = ToyNetworks()
+    attention.use_optimized_attention(unet.device)
+    return unet.eval()
+
+class MixtureDenoiser():
+    # exact posterior mean of a per-element gaussian mixture, a nonlinear denoiser with no network noise
+    def __init__(self, means=(-1.0, 0.3, 1.5), stds=(0.15, 0.1, 0.3), weights=(0.3, 0.4, 0.3)):
+        self.device = torch.device("cpu")
+        self.dtype = torch.float32
+        self.means = torch.tensor(means, dtype=torch.float64)
+        self.variances = torch.tensor(stds, dtype=torch.float64) ** 2
+        self.log_weights = torch.tensor(weights, dtype=torch.float64).log()
+        self.unet = types.SimpleNamespace(model_type="SDv1")
+        self.evaluations = 0
+
+    def predict_original(self, latents, timestep, sigma):
+        self.evaluations += 1
+        x, sigma = latents.double()[..., None], float(sigma)
+        total = self.variances + sigma ** 2
+        log_p = self.log_weights - 0.5 * (total.log() + (x - self.means) ** 2 / total)
+        posterior = torch.softmax(log_p, dim=-1)
+        original = self.means + self.variances / total * (x - self.means)
+        return (posterior * original).sum(-1).to(latents.dtype)
+
+    def set_predictions(self, predictions):
+        pass
+
+def run_txt2img(unet, conditioning, sampler_name, steps, size, seeds, scale=7.0, configure=None, callback=None, **kwargs):
+    device, dtype = unet.device, unet.dtype
+    denoiser = guidance.GuidedDenoiser(unet, device, conditioning, scale, 0.0)
+    if configure:
+        configure(denoiser)
+    sampler = SAMPLERS[sampler_name](denoiser, 1.0)
+    noise = utils.NoiseSchedule(seeds, [(0, 0)] * len(seeds), size // 8, size // 8, device, dtype)
+
+    unet.evaluations, unet.calls = 0, 0
+    start = time.perf_counter()
+    with torch.inference_mode():
+        latents = inference.txt2img(denoiser, sampler, noise, steps, callback or (lambda *args: None), **kwargs)
+    elapsed = time.perf_counter() - start
+    return latents.float(), elapsed, unet.evaluations, unet.calls
+
+def difference(a, b):
+    mse = ((a - b) ** 2).mean().item()
+    peak = (b.max() - b.min()).item()
+    psnr = 10 * torch.log10(torch.tensor(peak ** 2 / mse)).item() if mse > 0 else float("inf")
+    return mse ** 0.5, psnr
+
+def benchmark_cfg(args):
+    unet = ToyUNET()
+    conditioning = ToyConditioning(args.batch, args.positives, args.negatives)
+    seeds = list(range(args.batch))
+
+    settings = [("baseline", None, None)]
+    settings += [(f"truncation {t}", t, None) for t in [0.8, 0.6, 0.4]]
+    settings += [(f"interval {i}", None, i) for i in [2, 3, 4]]
+
+    print(f"{'sampler':<20} {'setting':<16} {'evals':>6} {'saved':>7} {'time':>8} {'rmse':>8} {'psnr':>7}")
+    for sampler_name in args.samplers:
+        reference, base_evals = None, None
+        for label, truncation, interval in settings:
+            configure = lambda d: d.set_cfg_skipping(truncation, interval)
+            latents, elapsed, evals, _ = run_txt2img(unet, conditioning, sampler_name, args.steps, args.size, seeds, configure=configure)
+            if reference == None:
+                reference, base_evals = latents, evals
+            rmse, psnr = difference(latents, reference)
+            saved = 1 - evals / base_evals
+            print(f"{sampler_name:<20} {label:<16} {evals:>6} {saved:>6.1%} {elapsed:>7.3f}s {rmse:>8.4f} {psnr:>7.2f}")
+
+def benchmark_deepcache(args):
+    unet = tiny_unet()
+    conditioning = ToyConditioning(args.batch, args.positives, args.negatives)
+    seeds = list(range(args.batch))
+
+    settings = [("baseline", None, None, None, None)]
+    settings += [(f"interval {i} depth {d}", i, d, None, None) for i, d in [(2, 1), (3, 1), (5, 1), (3, 2)]]
+    settings += [("interval 3 0.1-0.9", 3, 1, 0.1, 0.9)]
+
+    print(f"{'sampler':<20} {'setting':<22} {'time':>8} {'speedup':>8} {'rmse':>8} {'psnr':>7}")
+    for sampler_name in args.samplers:
+        run_txt2img(unet, conditioning, sampler_name, 2, args.size, seeds) # warmup
+        reference, base_elapsed = None, None
+        for label, interval, depth, start, end in settings:
+            configure = lambda d: d.set_feature_cache(interval, depth, start, end)
+            latents, elapsed, _, _ = run_txt2img(unet, conditioning, sampler_name, args.steps, args.size, seeds, configure=configure)
+            if reference == None:
+                reference, base_elapsed = latents, elapsed
+            rmse, psnr = difference(latents, reference)
+            print(f"{sampler_name:<20} {label:<22} {elapsed:>7.3f}s {base_elapsed/elapsed:>7.2f}x {rmse:>8.4f} {psnr:>7.2f}")
+
+def legacy_brownian_noise(x, sigma_min, sigma_max, seeds):
+    # the previous per-seed noise sampling, swapping the global RNG state around every tree
+    from k_diffusion.sampling import BrownianTreeNoiseSampler
+    samplers, states = [], []
+    for seed in seeds:
+        torch.manual_seed(seed)
+        samplers += [BrownianTreeNoiseSampler(x[0][None,:], sigma_min, sigma_max)]
+        states += [torch.get_rng_state()]
+
+    def sample(t0, t1):
+        noises = []
+        for i in range(len(samplers)):
+            torch.set_rng_state(states[i])
+            noises += [samplers[i](t0, t1)]
+            states[i] = torch.get_rng_state()
+        return torch.cat(noises)
+    return sample
+
+def benchmark_brownian(args):
+    scheduler = samplers_k.SchedulerKarras()
+    sigmas = scheduler.get_schedule(args.steps)
+    sigma_min, sigma_max = sigmas[sigmas > 0].min(), sigmas.max()
+    queries = [(sigmas[i], sigmas[i + 1]) for i in range(args.steps - 1)]
+
+    print(f"{'batch':>5} {'legacy':>12} {'batched':>12} {'speedup':>8} {'identical':>10}")
+    for batch in [1, 2, 4, 8, 16]:
+        x = torch.zeros((batch, 4, args.size // 8, args.size // 8))
+        seeds = list(range(batch))
+        results, timings = [], []
+        for create in [legacy_brownian_noise, samplers_k.BatchedBrownianNoise]:
+            start = time.perf_counter()
+            sample = create(x, sigma_min, sigma_max, seeds)
+            results += [[sample(t0, t1) for t0, t1 in queries]]
+            timings += [(time.perf_counter() - start) / len(queries)]
+        identical = all(torch.equal(a, b) for a, b in zip(*results))
+        print(f"{batch:>5} {timings[0]*1000:>10.2f}ms {timings[1]*1000:>10.2f}ms {timings[0]/timings[1]:>7.2f}x {str(identical):>10}")
+
+def solve_toy(sampler_class, steps, latents):
+    model = MixtureDenoiser()
+    sampler = sampler_class(model, 0.0)
+    sigmas = sampler.scheduler.get_schedule(steps)
+    x = latents * sigmas[0]
+    noise = lambda: torch.zeros_like(latents) # deterministic solvers only
+    for i in range(steps):
+        x = sampler.step(x, sigmas, i, noise)
+    return x, model.evaluations
+
+def benchmark_solvers(args):
+    latents = torch.randn((args.batch, 4, 16, 16), generator=torch.Generator().manual_seed(0))
+    step_counts = [5, 8, 10, 12, 15, 20, 30]
+
+    families = {
+        "": [("Euler", samplers_k.Euler), ("DPM++ 2M", samplers_k.DPM_2M), ("DPM++ 3M", samplers_k.DPM_3M),
+             ("UniPC BH1", samplers_k.UniPC_BH1), ("UniPC", samplers_k.UniPC), ("DEIS", samplers_k.DEIS)],
+        " Karras": [("Euler Karras", samplers_k.Euler_Karras), ("DPM++ 2M Karras", samplers_k.DPM_2M_Karras),
+                    ("DPM++ 3M Karras", samplers_k.DPM_3M_Karras), ("UniPC BH1 Karras", samplers_k.UniPC_BH1_Karras),
+                    ("UniPC Karras", samplers_k.UniPC_Karras), ("DEIS Karras", samplers_k.DEIS_Karras)],
+        " AYS": [("Euler AYS", samplers_k.Euler_AYS), ("DPM++ 2M AYS", samplers_k.DPM_2M_AYS),
+                 ("DPM++ 3M AYS", samplers_k.DPM_3M_AYS), ("UniPC BH1 AYS", samplers_k.UniPC_BH1_AYS),
+                 ("UniPC AYS", samplers_k.UniPC_AYS), ("DEIS AYS", samplers_k.DEIS_AYS)],
+    }
+
+    for schedule, samplers in families.items():
+        # reference trajectory endpoint from a long run of a second order solver on the same schedule
+        reference, _ = solve_toy(samplers[1][1], 1000, latents)
+        target = difference(solve_toy(samplers[1][1], 20, latents)[0], reference)[0]
+
+        print(f"\nschedule{schedule or ' Default'}, rmse against 1000 step reference, target {target:.5f} (DPM++ 2M at 20 steps)")
+        print(f"{'sampler':<20} " + " ".join(f"{n:>8}" for n in step_counts) + f" {'steps to target':>16}")
+        for name, sampler_class in samplers:
+            errors = [difference(solve_toy(sampler_class, n, latents)[0], reference)[0] for n in step_counts]
+            reached = next((n for n in range(2, 41) if difference(solve_toy(sampler_class, n, latents)[0], reference)[0] <= target), None)
+            print(f"{name:<20} " + " ".join(f"{e:>8.5f}" for e in errors) + f" {str(reached or '>40'):>16}")
+
+def benchmark_adaptive(args):
+    unet = tiny_unet()
+    conditioning = ToyConditioning(args.batch, args.positives, args.negatives)
+    seeds = list(range(args.batch))
+
+    settings = [("baseline", None, 3)]
+    settings += [(f"tol {t} patience {p}", t, p) for t in [0.05, 0.02, 0.01, 0.005] for p in [2, 3]]
+
+    print(f"{'sampler':<20} {'setting':<22} {'steps':>6} {'saved':>7} {'time':>8} {'rmse':>8} {'psnr':>7}")
+    for sampler_name in args.samplers:
+        reference = None
+        for label, tolerance, patience in settings:
+            saved = [0]
+            callback = lambda progress, _: saved.__setitem__(0, progress.get("saved", saved[0]))
+            latents, elapsed, _, _ = run_txt2img(unet, conditioning, sampler_name, args.steps, args.size, seeds,
+                                                 callback=callback, tolerance=tolerance, patience=patience)
+            if reference == None:
+                reference = latents
+            rmse, psnr = difference(latents, reference)
+            print(f"{sampler_name:<20} {label:<22} {args.steps - saved[0]:>6} {saved[0]/args.steps:>6.1%} {elapsed:>7.3f}s {rmse:>8.4f} {psnr:>7.2f}")
+
+def regional_conditioning(batch_size, regions, size, context_dim=64, tokens=77, seed=0):
+    # real prompt schedules with random encodings and side by side region masks
+    import prompts
+    generator = torch.Generator().manual_seed(seed)
+    positives = ["base"] + [f"region {i}" for i in range(regions)]
+    conditioning = prompts.BatchedConditioningSchedules([(positives, ["negative"])] * batch_size, 1, 1)
+    h, w = size // 8, size // 8
+    areas = []
+    for i in range(regions):
+        area = torch.zeros((1, 4, h, w))
+        area[..., i * w // regions:(i + 1) * w // regions] = 1
+        areas += [area]
+    for b in conditioning.batches:
+        b.areas = areas
+        b.model_type = "SDv1"
+        for p in b.positives + b.negatives:
+            p.encoded = [(1, torch.randn((1, tokens, context_dim), generator=generator), None, [])]
+    return conditioning
+
+def benchmark_regional(args):
+    unet = tiny_unet()
+    seeds = list(range(args.batch))
+
+    print(f"{'sampler':<20} {'regions':>7} {'mode':<12} {'evals':>6} {'time':>8} {'speedup':>8} {'rmse':>8} {'psnr':>7}")
+    for sampler_name in args.samplers:
+        for regions in [1, 2, 4]:
+            conditioning = regional_conditioning(args.batch, regions, args.size)
+            run_txt2img(unet, conditioning, sampler_name, 2, args.size, seeds) # warmup
+            reference, base_elapsed = None, None
+            for mode in ["Composition", "Attention"]:
+                conditioning.set_area_mode(mode)
+                latents, elapsed, evals, _ = run_txt2img(unet, conditioning, sampler_name, args.steps, args.size, seeds)
+                if reference == None:
+                    reference, base_elapsed = latents, elapsed
+                rmse, psnr = difference(latents, reference)
+                print(f"{sampler_name:<20} {regions:>7} {mode:<12} {evals:>6} {elapsed:>7.3f}s {base_elapsed/elapsed:>7.2f}x {rmse:>8.4f} {psnr:>7.2f}")
+
+def seam_ratio(latents, positions):
+    # mean step across the window edges relative to the mean step elsewhere
+    steps = (latents[..., 1:] - latents[..., :-1]).abs().mean(dim=(0, 1, 2))
+    edges = sorted(set(x1 - 1 for _, x1, _, _ in positions if x1 > 0) | set(x2 - 1 for _, _, _, x2 in positions if x2 < latents.shape[-1]))
+    inner = [i for i in range(len(steps)) if not i in edges]
+    return (steps[edges].mean() / steps[inner].mean()).item()
+
+def benchmark_tiled(args):
+    import tiling
+    unet = tiny_unet()
+    conditioning = ToyConditioning(1, args.positives, args.negatives)
+    window, size = args.tile // 8, args.size // 8
+    seeds = [0]
+
+    run_txt2img(unet, conditioning, args.samplers[0], 2, args.tile, seeds) # warmup
+    print(f"{'sampler':<20} {'setting':<18} {'windows':>7} {'calls':>6} {'time':>8} {'speedup':>8} {'seam':>6}")
+    for sampler_name in args.samplers:
+        tiled = tiling.TiledUNET(unet, window, window // 4, 1)
+        positions, weight, total = tiled.get_windows(size, size, unet.device, unet.dtype)
+
+        # every window sampled on its own and blended afterwards, like the pixel tiles
+        start, calls = time.perf_counter(), 0
+        blended = torch.zeros((1, 4, size, size))
+        for y1, x1, y2, x2 in positions:
+            latents, _, _, c = run_txt2img(unet, conditioning, sampler_name, args.steps, args.tile, seeds)
+            blended[:, :, y1:y2, x1:x2] += latents * weight
+            calls += c
+        base_elapsed = time.perf_counter() - start
+        print(f"{sampler_name:<20} {'separate':<18} {len(positions):>7} {calls:>6} {base_elapsed:>7.3f}s {1.0:>7.2f}x {seam_ratio(blended / total, positions):>6.2f}")
+
+        for batch in [1, 4, 8]:
+            tiled = tiling.TiledUNET(unet, window, window // 4, batch)
+            unet.calls = 0
+            latents, elapsed, _, _ = run_txt2img(tiled, conditioning, sampler_name, args.steps, args.size, seeds)
+            calls = unet.calls
+            print(f"{sampler_name:<20} {f'multidiffusion {batch}':<18} {len(positions):>7} {calls:>6} {elapsed:>7.3f}s {base_elapsed/elapsed:>7.2f}x {seam_ratio(latents, positions):>6.2f}")
+
+def run_tiles(unet, tiles, batch, sampler_name, steps, strength):
+    # the tiled img2img loop, tiles share the seed and are sampled in groups
+    device, dtype = unet.device, unet.dtype
+    samplers, outputs = {}, []
+    unet.calls = 0
+    start = time.perf_counter()
+    with torch.inference_mode():
+        for j in range(0, len(tiles), batch):
+            group = tiles[j:j+batch]
+            if not len(group) in samplers:
+                conditioning = ToyConditioning(len(group))
+                conditioning.encodings = ToyConditioning(1).encodings * len(group) # every tile has the same prompt
+                denoiser = guidance.GuidedDenoiser(unet, device, conditioning, 7.0, 0.0)
+                samplers[len(group)] = (denoiser, SAMPLERS[sampler_name](denoiser, 1.0))
+            denoiser, sampler = samplers[len(group)]
+            noise = utils.NoiseSchedule([0] * len(group), [(0, 0)] * len(group), tiles.shape[-1], tiles.shape[-2], device, dtype)
+            outputs += [inference.img2img(group, denoiser, sampler, noise, steps, False, strength, lambda *args: None)]
+    elapsed = time.perf_counter() - start
+    return torch.cat(outputs).float(), elapsed, unet.calls
+
+def benchmark_tiles(args):
+    unet = tiny_unet()
+    generator = torch.Generator().manual_seed(0)
+    run_tiles(unet, torch.randn((2, 4, args.tile // 8, args.tile // 8), generator=generator), 2, args.samplers[0], 2, 0.5) # warmup
+
+    print(f"{'sampler':<20} {'tiles':>6} {'batch':>6} {'calls':>6} {'time':>8} {'tiles/s':>8} {'speedup':>8} {'rmse':>8}")
+    for sampler_name in args.samplers:
+        for count in [16, 48, 96]:
+            tiles = torch.randn((count, 4, args.tile // 8, args.tile // 8), generator=generator)
+            reference, base_elapsed = None, None
+            for batch in [1, 4, 8, 16]:
+                latents, elapsed, calls = run_tiles(unet, tiles, batch, sampler_name, args.steps, 0.5)
+                if reference == None:
+                    reference, base_elapsed = latents, elapsed
+                rmse, _ = difference(latents, reference)
+                print(f"{sampler_name:<20} {count:>6} {batch:>6} {calls:>6} {elapsed:>7.3f}s {count/elapsed:>8.2f} {base_elapsed/elapsed:>7.2f}x {rmse:>8.5f}")
+
+def legacy_tile_mask(size, radius):
+    width, height = int(size[0]), int(size[1])
+    radius_x, radius_y = radius
+    mask = np.ones((height, width), dtype=np.float32)
+    for i in range(height//2):
+        for j in range(width//2):
+            weight_x, weight_y = 1, 1
+            if i < radius_y:
+                weight_y = (i / radius_y)
+            if j < radius_x:
+                weight_x = (j / radius_x)
+            weight = min(weight_x, weight_y) ** 2
+            if weight == 1:
+                continue
+            mask[i, j] = weight
+            mask[i, width-j-1] = weight
+            mask[height-i-1, j] = weight
+            mask[height-i-1, width-j-1] = weight
+    return PIL.Image.fromarray(np.uint8(mask*255), mode="L")
+
+def legacy_assemble_tiles(original_images, tile_images, tile_positions, tile_masks):
+    assembled = []
+    for img, tiles, positions, mask in zip(original_images, tile_images, tile_positions, tile_masks):
+        img_width, img_height = img.size
+        img_tensor = utils.TO_TENSOR(img)
+        mask_tensor = utils.TO_TENSOR(mask)
+        inv_mask = torch.zeros((1, img_height, img_width))
+        for (x1, y1, x2, y2) in positions:
+            inv_mask[:,y1:y2,x1:x2] += mask_tensor
+        inv_mask = 1 - inv_mask.clamp(0,1)
+        over_mask = torch.zeros((1, img_height, img_width))
+        for (x1, y1, x2, y2) in positions:
+            over_mask[:,y1:y2,x1:x2] += mask_tensor + inv_mask[:,y1:y2,x1:x2]
+        over_mask = 1 / over_mask.clamp(1,None)
+        output = torch.zeros_like(img_tensor)
+        for (x1, y1, x2, y2), tile in zip(positions, tiles):
+            tile_tensor = utils.TO_TENSOR(tile.resize((x2-x1, y2-y1)))
+            mask = (mask_tensor + inv_mask[:,y1:y2,x1:x2]) * over_mask[:,y1:y2,x1:x2]
+            output[:,y1:y2,x1:x2] += tile_tensor * mask
+        assembled += [utils.FROM_TENSOR(output)]
+    return assembled
+
+def benchmark_tilemask(args):
+    rng = np.random.default_rng(0)
+
+    print(f"{'mask':>6} {'radius':>7} {'legacy':>9} {'mask':>9} {'cached':>9} {'identical':>10}")
+    for size in [256, 512, 768, 1024]:
+        radius = (size // 8, size // 6)
+        start = time.perf_counter()
+        legacy = legacy_tile_mask((size, size), radius)
+        legacy_time = time.perf_counter() - start
+        utils.TILE_MASKS.clear()
+        start = time.perf_counter()
+        mask = utils.get_tile_mask((size, size), radius)
+        mask_time = time.perf_counter() - start
+        start = time.perf_counter()
+        utils.get_tile_mask((size, size), radius)
+        cached_time = time.perf_counter() - start
+        identical = np.array_equal(np.asarray(legacy), np.asarray(mask))
+        print(f"{size:>6} {str(radius[0]):>7} {legacy_time:>8.4f}s {mask_time:>8.4f}s {cached_time:>8.5f}s {str(identical):>10}")
+
+    print(f"\n{'image':>6} {'upscale':>7} {'tiles':>6} {'legacy':>9} {'blend':>9} {'speedup':>8} {'identical':>10}")
+    for image_size, upscale in [(1024, 1.0), (2048, 1.0), (2048, 2.0), (4096, 2.0)]:
+        image = PIL.Image.fromarray(rng.integers(0, 256, (image_size, image_size, 3), dtype=np.uint8))
+        tile_images, tile_positions, tile_masks = utils.get_tiles([image], args.tile, upscale)
+        tile_images = [[PIL.Image.fromarray(rng.integers(0, 256, (t.size[1], t.size[0], 3), dtype=np.uint8)) for t in tiles] for tiles in tile_images]
+
+        start = time.perf_counter()
+        legacy = legacy_assemble_tiles([image], tile_images, tile_positions, tile_masks)[0]
+        legacy_time = time.perf_counter() - start
+        start = time.perf_counter()
+        assembled = utils.assemble_tiles([image], tile_images, tile_positions, tile_masks)[0]
+        blend_time = time.perf_counter() - start
+
+        identical = np.array_equal(np.asarray(legacy), np.asarray(assembled))
+        print(f"{image_size:>6} {upscale:>7} {len(tile_positions[0]):>6} {legacy_time:>8.4f}s {blend_time:>8.4f}s {legacy_time/blend_time:>7.2f}x {str(identical):>10}")
+
+def tiny_vae(dtype=torch.float32):
+    # a small randomly initialized models.VAE with the full 8x downsampling
+    import models
+    from diffusers import AutoencoderKL
+
+    class TinyVAE(models.VAE):
+        def __init__(self):
+            self.model_type = "SDv1"
+            AutoencoderKL.__init__(self, in_channels=3, out_channels=3, latent_channels=4, layers_per_block=1,
+                down_block_types=("DownEncoderBlock2D",)*4, up_block_types=("UpDecoderBlock2D",)*4,
+                block_out_channels=(32, 64, 64, 64), norm_num_groups=16, sample_size=256)
+            self.scaling_factor = 0.18215
+
+    torch.manual_seed(0)
+    vae = TinyVAE().to(dtype)
+    vae.enable_slicing()
+    return vae.eval()
+
+def legacy_decode_images(vae, latents):
+    latents = latents.clone().detach().to(vae.device, vae.dtype) / vae.scaling_factor
+    return utils.postprocess_images(vae.decode(latents).sample)
+
+def benchmark_vae(args):
+    vae = tiny_vae()
+    generator = torch.Generator().manual_seed(0)
+    element_size = torch.finfo(vae.dtype).bits // 8
+
+    print(f"{'decode':<10} {'batch':>6} {'micro':>6} {'time':>8} {'speedup':>8} {'identical':>10}")
+    with torch.inference_mode():
+        latents = torch.randn((args.batch, 4, args.size // 8, args.size // 8), generator=generator)
+        legacy_decode_images(vae, latents[:1]) # warmup
+        start = time.perf_counter()
+        reference = legacy_decode_images(vae, latents)
+        base_elapsed = time.perf_counter() - start
+        print(f"{'legacy':<10} {args.batch:>6} {args.batch:>6} {base_elapsed:>7.3f}s {1.0:>7.2f}x {'True':>10}")
+        for micro in [1, 2, 4]:
+            utils.VAE_BUDGET = utils.VAE_MEMORY["decode"] * args.size ** 2 * element_size * micro
+            start = time.perf_counter()
+            images = utils.decode_images(vae, latents)
+            elapsed = time.perf_counter() - start
+            identical = all(np.array_equal(np.asarray(a), np.asarray(b)) for a, b in zip(images, reference))
+            print(f"{'budgeted':<10} {args.batch:>6} {micro:>6} {elapsed:>7.3f}s {base_elapsed/elapsed:>7.2f}x {str(identical):>10}")
+        utils.VAE_BUDGET = None
+
+        # mixed sizes, previously encoded one image at a time
+        sizes = [args.size, args.size // 2, args.size, args.size // 2] * max(1, args.batch // 4)
+        images = [PIL.Image.fromarray(np.random.default_rng(i).integers(0, 256, (s, s, 3), dtype=np.uint8)) for i, s in enumerate(sizes)]
+        seeds = list(range(len(images)))
+
+        start = time.perf_counter()
+        reference = [utils.encode_images(vae, [seed], [images[i]]) for i, seed in enumerate(seeds)]
+        base_elapsed = time.perf_counter() - start
+        start = time.perf_counter()
+        latents = utils.encode_images_disjointed(vae, seeds, images)
+        elapsed = time.perf_counter() - start
+        error = max((a - b).abs().max().item() for a, b in zip(latents, reference))
+        print(f"\n{'encode':<10} {'images':>6} {'sizes':>6} {'legacy':>8} {'grouped':>8} {'speedup':>8} {'max diff':>10}")
+        print(f"{'mixed':<10} {len(images):>6} {len(set(sizes)):>6} {base_elapsed:>7.3f}s {elapsed:>7.3f}s {base_elapsed/elapsed:>7.2f}x {error:>10.2e}")
+
+def benchmark_vaeprecision(args):
+    generator = torch.Generator().manual_seed(0)
+    latents = torch.randn((args.batch, 4, args.size // 8, args.size // 8), generator=generator)
+    latents[0] *= 2e4 # overflows a half precision decoder
+
+    reference = None
+    print(f"{'precision':<10} {'time':>8} {'fallbacks':>10} {'broken':>7} {'max diff':>9}")
+    for name, dtype, fallback in [("FP32", torch.float32, False), ("FP16", torch.float16, False), ("BF16", torch.bfloat16, False), ("Auto", torch.float16, True)]:
+        vae = tiny_vae(torch.float16).to(dtype)
+        vae.precision_fallback = fallback
+        utils.VAE_STATS.update({k: 0 for k in utils.VAE_STATS})
+        with torch.inference_mode():
+            start = time.perf_counter()
+            images = np.stack([np.asarray(i) for i in utils.decode_images(vae, latents)]).astype(np.int32)
+            elapsed = time.perf_counter() - start
+        if reference is None:
+            reference = images
+        error = np.abs(images - reference).reshape(len(images), -1).max(axis=1)
+        broken = int((error > 32).sum())
+        print(f"{name:<10} {elapsed:>7.3f}s {utils.VAE_STATS['decode_fallback']:>10} {broken:>7} {error.max():>9}")
+
+def run_stages(unet, vae, requests, batch, steps, size, overlap):
+    # back to back txt2img requests, decode and PNG encoding either inline or on the stage worker
+    import wrapper
+    params = wrapper.GenerationParameters(types.SimpleNamespace(do_gc=lambda: None), torch.device("cpu"))
+    params.vae = vae
+    params.vram_mode = "Default" if overlap else "Minimal"
+    params.need_models = lambda **kwargs: None
+
+    results = []
+    conditioning = ToyConditioning(batch)
+    start = time.perf_counter()
+    for r in range(requests):
+        params.callback = lambda response, r=r: results.append((r, response)) or True
+        seeds = [r * batch + i for i in range(batch)]
+        latents, _, _, _ = run_txt2img(unet, conditioning, "Euler", steps, size, seeds)
+        with torch.inference_mode():
+            params.finish(latents, [{"seed": s} for s in seeds])
+    params.wait_stages()
+    elapsed = time.perf_counter() - start
+    return [(r, response["data"]["images"]) for r, response in results if response["type"] == "result"], elapsed
+
+def benchmark_stages(args):
+    unet, vae = tiny_unet(), tiny_vae()
+    requests = 4
+
+    print(f"{'pipeline':<10} {'requests':>8} {'time':>8} {'speedup':>8} {'ordered':>8} {'identical':>10}")
+    run_stages(unet, vae, 1, 1, 2, args.size, False) # warmup
+    reference, base_elapsed = run_stages(unet, vae, requests, args.batch, args.steps, args.size, False)
+    print(f"{'serial':<10} {requests:>8} {base_elapsed:>7.3f}s {1.0:>7.2f}x {'True':>8} {'True':>10}")
+    results, elapsed = run_stages(unet, vae, requests, args.batch, args.steps, args.size, True)
+    ordered = [r for r, _ in results] == list(range(requests))
+    identical = results == reference
+    print(f"{'overlap':<10} {requests:>8} {elapsed:>7.3f}s {base_elapsed/elapsed:>7.2f}x {str(ordered):>8} {str(identical):>10}")
+
+def benchmark_encode(args):
+    # smooth noise compresses roughly like a generated image, pure noise would not
+    rng = np.random.default_rng(0)
+    small = rng.integers(0, 256, (args.batch, args.size // 16, args.size // 16, 3), dtype=np.uint8)
+    images = [PIL.Image.fromarray(i).resize((args.size, args.size), PIL.Image.Resampling.BICUBIC) for i in small]
+
+    start = time.perf_counter()
+    reference = []
+    for i in images:
+        bytesio = io.BytesIO()
+        i.save(bytesio, format="PNG")
+        reference += [bytesio.getvalue()]
+    base_elapsed = time.perf_counter() - start
+    base_size = sum(len(r) for r in reference)
+
+    print(f"{'format':<16} {'images':>6} {'time':>8} {'speedup':>8} {'size':>7} {'lossless':>9}")
+    print(f"{'legacy PNG':<16} {len(images):>6} {base_elapsed:>7.3f}s {1.0:>7.2f}x {1.0:>6.2f}x {'True':>9}")
+    for format in utils.IMAGE_FORMATS:
+        utils.save_images(images[:1], format) # warmup
+        start = time.perf_counter()
+        data = utils.save_images(images, format)
+        elapsed = time.perf_counter() - start
+        size = sum(len(d) for d in data) / base_size
+        lossless = all(np.array_equal(np.asarray(PIL.Image.open(io.BytesIO(d)).convert("RGB")), np.asarray(i)) for d, i in zip(data, images))
+        print(f"{format:<16} {len(images):>6} {elapsed:>7.3f}s {base_elapsed/elapsed:>7.2f}x {size:>6.2f}x {str(lossless):>9}")
+
+def benchmark_stream(args):
+    import wrapper
+    vae = tiny_vae()
+    latents = torch.randn((args.batch, 4, args.size // 8, args.size // 8), generator=torch.Generator().manual_seed(0))
+    utils.VAE_BUDGET = utils.VAE_MEMORY["decode"] * args.size ** 2 * (torch.finfo(vae.dtype).bits // 8)
+
+    print(f"{'delivery':<10} {'images':>6} {'first':>8} {'total':>8} {'identical':>10}")
+    reference = None
+    for stream in [False, True]:
+        params = wrapper.GenerationParameters(types.SimpleNamespace(do_gc=lambda: None), torch.device("cpu"))
+        params.vae, params.vram_mode, params.stream_results = vae, "Minimal", stream
+        params.need_models = lambda **kwargs: None
+        images, first = [], None
+        def callback(response):
+            nonlocal first
+            if response["type"] in {"result", "result_image"}:
+                first = first or time.perf_counter() - start
+                images.extend(response["data"]["images"] if response["type"] == "result" else [response["data"]["image"]])
+            return True
+        params.callback = callback
+        with torch.inference_mode():
+            start = time.perf_counter()
+            params.finish(latents, [{"seed": i} for i in range(args.batch)])
+            elapsed = time.perf_counter() - start
+        reference = reference or images
+        print(f"{'stream' if stream else 'single':<10} {len(images):>6} {first:>7.3f}s {elapsed:>7.3f}s {str(images == reference):>10}")
+    utils.VAE_BUDGET = None
+
+def benchmark_previews(args):
+    import wrapper
+    import preview
+    unet, vae = tiny_unet(), tiny_vae()
+    conditioning = ToyConditioning(args.batch)
+    seeds = list(range(args.batch))
+
+    def legacy(counter):
+        def on_step(progress, latents):
+            for i in preview.full_preview(latents, vae):
+                i.save(io.BytesIO(), format="JPEG", quality=80)
+            counter[0] += 1
+        return on_step
+
+    def budgeted(counter, backlog):
+        params = wrapper.GenerationParameters(types.SimpleNamespace(do_gc=lambda: None), torch.device("cpu"))
+        params.set(show_preview="Full", preview_interval=1, **{k: v for k, v in wrapper.DEFAULTS.items() if k.startswith("preview")})
+        params.vae, params.backlog = vae, lambda: backlog
+        params.current_step, params.total_steps, params.saved_steps = 0, args.steps, 0
+        params.callback = lambda response: counter.__setitem__(0, counter[0] + ("previews" in response["data"])) or True
+        return params.on_step
+
+    print(f"{'previews':<16} {'shown':>6} {'time':>8} {'overhead':>9}")
+    _, base_elapsed, _, _ = run_txt2img(unet, conditioning, "Euler", args.steps, args.size, seeds)
+    print(f"{'none':<16} {0:>6} {base_elapsed:>7.3f}s {0:>8.1%}")
+    for label, make in [("every step", lambda c: legacy(c)), ("budgeted", lambda c: budgeted(c, 0)), ("backlogged", lambda c: budgeted(c, 10))]:
+        counter = [0]
+        _, elapsed, _, _ = run_txt2img(unet, conditioning, "Euler", args.steps, args.size, seeds, callback=make(counter))
+        print(f"{label:<16} {counter[0]:>6} {elapsed:>7.3f}s {elapsed/base_elapsed-1:>8.1%}")
+
+def benchmark_handles(args):
+    # one hop of a txt2img -> img2img chain, through the client as PNG or through a latent handle
+    import wrapper
+    vae = tiny_vae()
+    latents = torch.randn((args.batch, 4, args.size // 8, args.size // 8), generator=torch.Generator().manual_seed(0))
+    seeds = list(range(args.batch))
+
+    params = wrapper.GenerationParameters(types.SimpleNamespace(do_gc=lambda: None), torch.device("cpu"))
+    params.vae, params.vram_mode, params.keep_latents = vae, "Minimal", True
+    params.need_models = lambda **kwargs: None
+    results = []
+    params.callback = lambda response: results.append(response) or True
+
+    with torch.inference_mode():
+        params.finish(latents, [{"seed": s} for s in seeds])
+        result = [r for r in results if r["type"] == "result"][0]["data"]
+
+        start = time.perf_counter()
+        images = [PIL.Image.open(io.BytesIO(i)).convert("RGB") for i in result["images"]]
+        encoded = utils.encode_images(vae, seeds, images)
+        base_elapsed = time.perf_counter() - start
+
+        start = time.perf_counter()
+        params.latent_id = result["latent_ids"]
+        handles = torch.cat(params.get_handle_latents())
+        elapsed = time.perf_counter() - start
+
+    print(f"{'input':<8} {'images':>6} {'time':>8} {'speedup':>8} {'latent rmse':>12}")
+    print(f"{'PNG':<8} {args.batch:>6} {base_elapsed:>7.3f}s {1.0:>7.2f}x {difference(encoded, latents)[0]:>12.4f}")
+    print(f"{'handle':<8} {args.batch:>6} {elapsed:>7.4f}s {base_elapsed/elapsed:>7.0f}x {difference(handles, latents)[0]:>12.4f}")
+    print(f"cache {params.latent_cache.get_stats()}")
+
+def benchmark_encodecache(args):
+    # repeated inpainting of the same source, only the seed changes between requests
+    vae = tiny_vae()
+    rng = np.random.default_rng(0)
+    images = [PIL.Image.fromarray(rng.integers(0, 256, (args.size, args.size, 3), dtype=np.uint8)) for _ in range(args.batch)]
+
+    print(f"{'encode':<8} {'request':>8} {'time':>8} {'speedup':>8} {'cached':>7} {'identical':>10}")
+    references = []
+    with torch.inference_mode():
+        for cached in [False, True]:
+            utils.ENCODE_CACHE = utils.LatentCache(utils.ENCODE_CACHE_LIMIT if cached else 0)
+            utils.VAE_STATS["encode_cached"] = 0
+            for request in range(3):
+                seeds = [request * args.batch + i for i in range(args.batch)]
+                start = time.perf_counter()
+                latents = utils.encode_images(vae, seeds, images)
+                elapsed = time.perf_counter() - start
+                if not cached:
+                    references += [(latents, elapsed)]
+                reference, base_elapsed = references[request]
+                print(f"{'cached' if cached else 'always':<8} {request:>8} {elapsed:>7.4f}s {base_elapsed/elapsed:>7.1f}x {utils.VAE_STATS['encode_cached']:>7} {str(torch.equal(latents, reference)):>10}")
+    utils.ENCODE_CACHE = utils.LatentCache(utils.ENCODE_CACHE_LIMIT)
+
+def benchmark_inputs(args):
+    # request image payloads, decoded one by one at dequeue time before, all at once on arrival now
+    import wrapper
+    rng = np.random.default_rng(0)
+    payloads = []
+    for i in range(args.batch):
+        small = rng.integers(0, 256, (args.size // 16, args.size // 16, 4), dtype=np.uint8)
+        bytesio = io.BytesIO()
+        PIL.Image.fromarray(small).resize((args.size, args.size), PIL.Image.Resampling.BICUBIC).save(bytesio, format="PNG")
+        payloads += [bytesio.getvalue()]
+
+    start = time.perf_counter()
+    reference = [wrapper.decode_input(p, "image") for p in payloads]
+    base_elapsed = time.perf_counter() - start
+
+    data = {"image": list(payloads), "mask": [None] * len(payloads)}
+    start = time.perf_counter()
+    memory = wrapper.prepare_inputs(data)
+    elapsed = time.perf_counter() - start
+    identical = all(np.array_equal(np.asarray(a), np.asarray(b)) for a, b in zip(data["image"], reference))
+
+    print(f"{'decode':<10} {'images':>6} {'time':>8} {'speedup':>8} {'memory':>9} {'identical':>10}")
+    print(f"{'serial':<10} {args.batch:>6} {base_elapsed:>7.3f}s {1.0:>7.2f}x {'':>9} {'True':>10}")
+    print(f"{'pool':<10} {args.batch:>6} {elapsed:>7.3f}s {base_elapsed/elapsed:>7.2f}x {memory/2**20:>6.1f}MiB {str(identical):>10}")
+
+    try:
+        wrapper.prepare_inputs({"image": [payloads[0][:len(payloads[0])//2]]})
+        print("truncated image accepted")
+    except ValueError as e:
+        print(f"truncated image rejected: {e}")
+
+class ToyDetector():
+    # stands in for detailer.ADetailer, a fixed grid of square regions per image
+    def __init__(self, regions):
+        self.regions = regions
+
+    def predict_masks_batch(self, images, confidence=0.5, mode="rectangle"):
+        import PIL.ImageDraw
+        detections = []
+        for image in images:
+            detected = []
+            for k in range(self.regions):
+                mask = PIL.Image.new("L", image.size, 0)
+                x = k * image.width // self.regions
+                PIL.ImageDraw.Draw(mask).rectangle((x + 8, 8, x + image.width // self.regions - 8, image.height // 3), fill=255)
+                detected += [("face", mask)]
+            detections += [(detected, image)]
+        return detections
+
+def benchmark_detailer(args):
+    import wrapper
+    import prompts
+
+    class Conditioning(ToyConditioning):
+        def __init__(self, prompts, steps, clip_skip):
+            super().__init__(1)
+            self.batch_size, self.encodings = len(prompts), self.encodings * len(prompts)
+
+        def encode(self, clip, areas):
+            pass
+
+    schedules, prompts.BatchedConditioningSchedules = prompts.BatchedConditioningSchedules, Conditioning
+    unet, vae = tiny_unet(), tiny_vae()
+    regions = 3
+    images = [PIL.Image.fromarray(np.random.default_rng(i).integers(0, 256, (args.size, args.size, 3), dtype=np.uint8)) for i in range(args.batch)]
+    seeds = list(range(args.batch))
+
+    print(f"{'detailer':<10} {'images':>6} {'regions':>8} {'batch':>6} {'time':>8} {'speedup':>8} {'max diff':>9}")
+    reference = None
+    for batch in [1, 4]:
+        storage = types.SimpleNamespace(do_gc=lambda: None, get_detailer=lambda name, device: ToyDetector(regions), dtype=torch.float32)
+        params = wrapper.GenerationParameters(storage, torch.device("cpu"))
+        params.set(prompt=[(["portrait"], [""])], steps=args.steps, scale=7.0, sampler="Euler", eta=1.0, tile_batch=batch,
+                   detailers=["face"], detailer_parameters=[{"resolution": 64, "strength": 0.5, "padding": 16, "mask_blur": 2,
+                   "mask_expand": 2, "threshold": 0.5, "box_mode": "Rectangle", "prompt": "PROMPT"}])
+        params.unet, params.vae, params.callback = unet, vae, lambda response: True
+        params.current_step, params.saved_steps = 0, 0
+        with torch.inference_mode():
+            start = time.perf_counter()
+            outputs = params.detailing(0, images, None, seeds, [(0, 0)] * len(seeds), torch.device("cpu"))
+            elapsed = time.perf_counter() - start
+        outputs = [np.asarray(o) for o in outputs]
+        if reference is None:
+            reference, base_elapsed = outputs, elapsed
+        error = max(np.abs(a.astype(np.int32) - b).max() for a, b in zip(outputs, reference))
+        print(f"{'batched' if batch > 1 else 'serial':<10} {len(outputs):>6} {regions * len(images):>8} {batch:>6} {elapsed:>7.3f}s {base_elapsed/elapsed:>7.2f}x {error:>9}")
+    prompts.BatchedConditioningSchedules = schedules
+
+def tiny_sr(upscale=2):
+    import importlib
+    import upscalers
+    srvgg = importlib.import_module("spandrel.architectures.Compact.__arch.SRVGG")
+    torch.manual_seed(0)
+    model = srvgg.SRVGGNetCompact(num_feat=16, num_conv=4, upscale=upscale)
+    return upscalers.SR.from_model("tiny", model.state_dict())
+
+def legacy_upscale_tiled(img, model, tile_size, tile_overlap, scale):
+    b, c, h, w = img.size()
+    tile_size = min(tile_size, h, w)
+    stride = tile_size - tile_overlap
+    h_idx_list = list(range(0, h - tile_size, stride)) + [h - tile_size]
+    w_idx_list = list(range(0, w - tile_size, stride)) + [w - tile_size]
+    result = torch.zeros(b, c, h * scale, w * scale, dtype=img.dtype)
+    weights = torch.zeros_like(result)
+    for h_idx in h_idx_list:
+        for w_idx in w_idx_list:
+            out_patch = model(img[..., h_idx : h_idx + tile_size, w_idx : w_idx + tile_size])
+            result[..., h_idx * scale : (h_idx + tile_size) * scale, w_idx * scale : (w_idx + tile_size) * scale].add_(out_patch)
+            weights[..., h_idx * scale : (h_idx + tile_size) * scale, w_idx * scale : (w_idx + tile_size) * scale].add_(1)
+    return result.div_(weights)
+
+def legacy_upscale_super_resolution(images, model, width, height):
+    import upscalers
+    outputs = []
+    with torch.inference_mode():
+        for image in images:
+            while True:
+                last = image.size[0]
+                img = utils.TO_TENSOR(image).unsqueeze(0)[:, [2, 1, 0]]
+                out = legacy_upscale_tiled(img, model, upscalers.TILE_SIZE, upscalers.TILE_OVERLAP, model.scale).clamp_(0, 1)
+                image = utils.FROM_TENSOR(out[:, [2, 1, 0]].squeeze(0))
+                if last >= image.size[0] or (image.size[0] >= width and image.size[1] >= height):
+                    break
+            outputs += [upscalers.upscale_single(image, upscalers.transforms.InterpolationMode.LANCZOS, width, height)]
+    return outputs
+
+def benchmark_sr(args):
+    import upscalers
+    model = tiny_sr()
+    images = [PIL.Image.fromarray(np.random.default_rng(i).integers(0, 256, (args.size, args.size, 3), dtype=np.uint8)) for i in range(args.batch)]
+
+    print(f"{'upscale':<9} {'images':>6} {'passes':>7} {'legacy':>9} {'batched':>9} {'speedup':>8} {'legacy err':>11} {'batched err':>12}")
+    for passes in [1, 2]:
+        size = args.size * model.scale ** passes
+
+        # untiled references, tile seams show up as error against them
+        tile_size = upscalers.TILE_SIZE
+        upscalers.TILE_SIZE = size
+        legacy_reference = [np.asarray(i).astype(np.int32) for i in legacy_upscale_super_resolution(images, model, size, size)]
+        batched_reference = [np.asarray(i).astype(np.int32) for i in upscalers.upscale_super_resolution(images, model, size, size)]
+        upscalers.TILE_SIZE = tile_size
+
+        start = time.perf_counter()
+        legacy = legacy_upscale_super_resolution(images, model, size, size)
+        legacy_time = time.perf_counter() - start
+        upscalers.TILE_WEIGHTS.clear()
+        start = time.perf_counter()
+        batched = upscalers.upscale_super_resolution(images, model, size, size)
+        batched_time = time.perf_counter() - start
+
+        legacy_error = np.mean([np.abs(np.asarray(a) - r).mean() for a, r in zip(legacy, legacy_reference)])
+        batched_error = np.mean([np.abs(np.asarray(a) - r).mean() for a, r in zip(batched, batched_reference)])
+        print(f"{f'{args.size}->{size}':<9} {len(images):>6} {passes:>7} {legacy_time:>8.3f}s {batched_time:>8.3f}s {legacy_time/batched_time:>7.2f}x {legacy_error:>11.4f} {batched_error:>12.4f}")
+
+def benchmark_resize(args):
+    import upscalers
+    modes = upscalers.transforms.InterpolationMode
+    devices = [torch.device("cpu")] + ([torch.device("cuda")] if torch.cuda.is_available() else [])
+    images = [PIL.Image.fromarray(np.random.default_rng(i).integers(0, 256, (args.size, args.size, 3), dtype=np.uint8)) for i in range(args.batch)]
+
+    print(f"{'mode':<9} {'target':>11} {'device':>7} {'PIL':>9} {'batched':>9} {'tensor':>9} {'speedup':>8} {'max diff':>9}")
+    for mode in [modes.LANCZOS, modes.BICUBIC, modes.NEAREST]:
+        for width, height in [(args.size * 2, args.size * 2), (args.size // 2, args.size // 2), (args.size, args.size * 3 // 2)]:
+            start = time.perf_counter()
+            reference = [upscalers.upscale_single(i, mode, width, height) for i in images]
+            pil_time = time.perf_counter() - start
+            for device in devices:
+                pixels = utils.stack_images(images, device)
+                upscalers.resize(pixels, mode, width, height)
+                synchronize = torch.cuda.synchronize if device.type == "cuda" else lambda: None
+
+                # from PIL and back, then staying on the device
+                start = time.perf_counter()
+                outputs = utils.unstack_images(upscalers.resize(utils.stack_images(images, device), mode, width, height), "RGB")
+                batched_time = time.perf_counter() - start
+                start = time.perf_counter()
+                upscalers.resize(pixels, mode, width, height)
+                synchronize()
+                tensor_time = time.perf_counter() - start
+
+                error = max(np.abs(np.asarray(a).astype(np.int32) - np.asarray(b)).max() for a, b in zip(outputs, reference))
+                print(f"{mode.value:<9} {f'{width}x{height}':>11} {device.type:>7} {pil_time:>8.4f}s {batched_time:>8.4f}s {tensor_time:>8.4f}s {pil_time/tensor_time:>7.2f}x {error:>9}")
+
+def legacy_prepare_mask(mask, blur, expand):
+    import PIL.ImageFilter
+    if expand:
+        mask = mask.filter(PIL.ImageFilter.MaxFilter(int(2*expand + 1)))
+    if blur:
+        mask = mask.filter(PIL.ImageFilter.GaussianBlur(blur))
+    return mask
+
+def legacy_blur_areas(areas, blur, expand):
+    import PIL.ImageChops
+    import PIL.ImageFilter
+    out = []
+    for o in areas:
+        blurred = []
+        for a in o:
+            b = a.copy()
+            if expand:
+                b = b.filter(PIL.ImageFilter.MaxFilter(int(2*expand + 1)))
+            if blur:
+                b = b.filter(PIL.ImageFilter.MaxFilter(int(blur*2 + 1)))
+                b = b.filter(PIL.ImageFilter.GaussianBlur(blur))
+            blurred += [PIL.ImageChops.lighter(a, b)]
+        out += [blurred]
+    return out
+
+def legacy_preprocess_areas(areas, width, height):
+    w, h = width - width % 8, height - height % 8
+    return [[torch.cat([utils.TO_TENSOR(a.resize((w // 8, h // 8), resample=PIL.Image.LANCZOS)).to(torch.float32)]*4)[None, :] for a in o] for o in areas]
+
+def legacy_preprocess_masks(masks):
+    def process(mask):
+        w, h = mask.size
+        mask = mask.resize(((w - w % 8) // 8, (h - h % 8) // 8), resample=PIL.Image.LANCZOS)
+        return (1 - utils.TO_TENSOR(mask).to(torch.float32))[None, :]
+    return torch.cat([process(m) for m in masks])
+
+def benchmark_masks(args):
+    def timed(function, *inputs):
+        start = time.perf_counter()
+        output = function(*inputs)
+        return output, time.perf_counter() - start
+
+    def random_masks(size, count):
+        # blobs rather than noise, like painted masks
+        masks = []
+        for i in range(count):
+            rng = np.random.default_rng(i)
+            mask = np.zeros((size, size), dtype=np.uint8)
+            for _ in range(4):
+                x, y, r = rng.integers(0, size, 2).tolist() + [int(rng.integers(size // 16, size // 4))]
+                mask[max(0, y - r):y + r, max(0, x - r):x + r] = 255
+            masks += [PIL.Image.fromarray(mask, "L")]
+        return masks
+
+    print(f"{'stage':<10} {'size':>6} {'blur':>5} {'expand':>7} {'legacy':>9} {'tensor':>9} {'speedup':>8} {'identical':>10}")
+    for size in [512, 1024, 2048]:
+        masks = random_masks(size, args.batch)
+        for blur, expand in [(4, 0), (0, 4), (0, 16), (8, 16)]:
+            legacy, legacy_time = timed(lambda: [legacy_prepare_mask(m, blur, expand) for m in masks])
+            output, tensor_time = timed(utils.prepare_masks, masks, blur, expand)
+            identical = all(np.array_equal(np.asarray(a), np.asarray(b)) for a, b in zip(legacy, output))
+            print(f"{'mask':<10} {size:>6} {blur:>5} {expand:>7} {legacy_time:>8.4f}s {tensor_time:>8.4f}s {legacy_time/tensor_time:>7.2f}x {str(identical):>10}")
+
+            areas = [masks[:2], masks[2:]]
+            legacy, legacy_time = timed(legacy_blur_areas, areas, blur, expand)
+            output, tensor_time = timed(utils.blur_areas, areas, blur, expand)
+            identical = all(np.array_equal(np.asarray(a), np.asarray(b)) for o, p in zip(legacy, output) for a, b in zip(o, p))
+            print(f"{'area':<10} {size:>6} {blur:>5} {expand:>7} {legacy_time:>8.4f}s {tensor_time:>8.4f}s {legacy_time/tensor_time:>7.2f}x {str(identical):>10}")
+
+        legacy, legacy_time = timed(legacy_preprocess_masks, masks)
+        output, tensor_time = timed(utils.preprocess_masks, masks)
+        print(f"{'latent':<10} {size:>6} {'-':>5} {'-':>7} {legacy_time:>8.4f}s {tensor_time:>8.4f}s {legacy_time/tensor_time:>7.2f}x {str(torch.equal(legacy, output)):>10}")
+        legacy, legacy_time = timed(legacy_preprocess_areas, areas, size, size)
+        output, tensor_time = timed(utils.preprocess_areas, areas, size, size)
+        identical = all(torch.equal(a, b) for o, p in zip(legacy, output) for a, b in zip(o, p))
+        print(f"{'latent area':<10} {size:>6} {'-':>5} {'-':>7} {legacy_time:>8.4f}s {tensor_time:>8.4f}s {legacy_time/tensor_time:>7.2f}x {str(identical):>10}")
+
+BENCHMARKS = {
+    "cfg": benchmark_cfg,
+    "deepcache": benchmark_deepcache,
+    "brownian": benchmark_brownian,
+    "solvers": benchmark_solvers,
+    "adaptive": benchmark_adaptive,
+    "regional": benchmark_regional,
+    "tiled": benchmark_tiled,
+    "tiles": benchmark_tiles,
+    "tilemask": benchmark_tilemask,
+    "vae": benchmark_vae,
+    "vaeprecision": benchmark_vaeprecision,
+    "stages": benchmark_stages,
+    "encode": benchmark_encode,
+    "stream": benchmark_stream,
+    "previews": benchmark_previews,
+    "handles": benchmark_handles,
+    "encodecache": benchmark_encodecache,
+    "inputs": benchmark_inputs,
+    "detailer": benchmark_detailer,
+    "sr": benchmark_sr,
+    "resize": benchmark_resize,
+    "masks": benchmark_masks,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='sd-inference-server benchmarks')
+    parser.add_argument('benchmark', type=str, choices=list(BENCHMARKS.keys()), help='benchmark to run')
+    parser.add_argument('--steps', type=int, help='sampling steps', default=20)
+    parser.add_argument('--batch', type=int, help='batch size', default=4)
+    parser.add_argument('--size', type=int, help='image size in pixels', default=256)
+    parser.add_argument('--tile', type=int, help='tile size in pixels', default=128)
+    parser.add_argument('--positives', type=int, help='positive prompts per batch item', default=1)
+    parser.add_argument('--negatives', type=int, help='negative prompts per batch item', default=1)
+    parser.add_argument('--samplers', type=str, nargs='+', help='samplers to run', default=["Euler a", "DPM++ 2M Karras"])
+    args = parser.parse_args()
+
+    torch.set_num_threads(max(1, torch.get_num_threads()))
+    BENCHMARKS[args.benchmark](args)
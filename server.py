@@ -1,5 +1,6 @@
 import threading
 import traceback
+import functools
 import queue
 import os
 import torch
@@ -28,6 +29,8 @@ import random
 
 DEFAULT_PASSWORD = "qDiffusion"
 FRAGMENT_SIZE = 1048576
+# bytes of decoded request images allowed to wait in the queue
+QUEUE_MEMORY = 2 * 1024 * 1024 * 1024
 UPLOAD_IDS = {}
 
 def log_traceback(label):
@@ -189,14 +192,17 @@ def do_download(request, folder, id, callback):
     thread.start()
 
 class Inference(threading.Thread):
-    def __init__(self, wrapper, read_only, public, callback):
+    def __init__(self, wrapper, read_only, public, callback, backlog=None):
         super().__init__(daemon=True)
         
         self.wrapper = wrapper
         wrapper.callback = self.got_response
 
         self.callback = callback
+        self.backlog = backlog
         self.requests = queue.Queue()
+        self.queued_memory = 0
+        self.memory_lock = threading.Lock()
         self.current = None
 
         self.read_only = read_only
@@ -205,6 +211,15 @@ class Inference(threading.Thread):
 
         self.stay_alive = True
 
+    def admit(self, client, id, request, memory):
+        # decoded images waiting in the queue are bounded, a request that fits nothing is still let into an empty queue
+        with self.memory_lock:
+            if self.queued_memory and self.queued_memory + memory > QUEUE_MEMORY:
+                return False
+            self.queued_memory += memory
+            self.requests.put((client, id, request, memory))
+        return True
+
     def got_response(self, response, id=None):
         if id == None:
             id = self.current
@@ -213,9 +228,17 @@ class Inference(threading.Thread):
     def run(self):
         while self.stay_alive:
             try:
-                client, self.current, request = self.requests.get(False)
+                client, self.current, request, memory = self.requests.get(False)
+                with self.memory_lock:
+                    self.queued_memory -= memory
                 convert_all_paths(request)
 
+                # finishing stages keep reporting to the request they came from
+                self.wrapper.callback = functools.partial(self.got_response, id=self.current)
+                self.wrapper.backlog = functools.partial(self.backlog, self.current) if self.backlog else None
+                if not request["type"] in {"txt2img", "img2img", "ping"}:
+                    self.wrapper.wait_stages()
+
                 read_only = self.read_only and client != self.owner
                 if read_only and request["type"] in {"convert", "manage", "download", "chunk"}:
                     raise Exception("Read-only")
@@ -342,7 +365,7 @@ class Server():
         self.owner = None if owner else "disabled"
         self.public = public
 
-        self.inference = Inference(wrapper, read_only, public, callback=self.on_response)
+        self.inference = Inference(wrapper, read_only, public, callback=self.on_response, backlog=self.get_backlog)
         self.server = websockets.sync.server.serve(self.handle_connection, host=host, port=int(port), max_size=None)
         self.serve = threading.Thread(target=self.serve_forever, daemon=True)
 
@@ -457,8 +480,17 @@ class Server():
                             self.inference.fetch(request["data"]["id"], request_id, self.clients[client_id])
                             continue
 
+                        # images are decoded here, corrupt ones never reach the queue
+                        try:
+                            memory = wrapper.prepare_inputs(request.get("data") or {})
+                        except ValueError as e:
+                            self.send_response(client_id, request_id, {"type":"error", "data":{"message": str(e)}})
+                            continue
+
                         remaining = self.inference.requests.unfinished_tasks
-                        self.inference.requests.put((client_id, request_id, request))
+                        if not self.inference.admit(client_id, request_id, request, memory):
+                            self.send_response(client_id, request_id, {"type":"error", "data":{"message": "Server is busy"}})
+                            continue
                         self.clients[client_id].put((-1, {"type":"ack", "data":{"id": request_id, "queue": remaining}}))
                     else:
                         self.clients[client_id].put((-1, {"type":"error", "data":{"message": error}}))
@@ -492,6 +524,12 @@ class Server():
             response["monitor"] = True
             self.clients[self.owner].put((id, response))
 
+    def get_backlog(self, id):
+        client = self.requests.get(id)
+        if client in self.clients:
+            return self.clients[client].qsize()
+        return 0
+
     def on_response(self, id, response):
         if self.stopping:
             return False
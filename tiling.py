@@ -0,0 +1,113 @@
+import math
+import types
+import torch
+
+def get_window_starts(length, size, overlap):
+    if length <= size:
+        return [0]
+    count = math.ceil((length - overlap) / (size - overlap))
+    return [round(i * (length - size) / (count - 1)) for i in range(count)]
+
+def get_window_weight(height, width, overlap, device, dtype):
+    # linear feather towards the window edges, every pixel keeps a nonzero weight
+    def ramp(length):
+        i = torch.arange(length, dtype=torch.float32)
+        return (torch.minimum(i + 1, length - i) / (overlap + 1)).clamp(max=1)
+    return (ramp(height)[:, None] * ramp(width)[None, :]).to(device, dtype)
+
+class TiledUNET:
+    # MultiDiffusion, every call splits the latents into overlapping windows, runs them through
+    # the wrapped UNET in batches and blends the predictions back with feathered weights
+    def __init__(self, unet, size, overlap, batch):
+        self.unet = unet
+        self.size = size
+        self.overlap = overlap
+        self.batch = max(1, batch)
+        self.feature_cache = None
+        self.windows = {}
+
+    def get_windows(self, height, width, device, dtype):
+        key = (height, width, device, dtype)
+        if not key in self.windows:
+            h, w = min(self.size, height), min(self.size, width)
+            overlap = min(self.overlap, h - 1, w - 1)
+            ys = get_window_starts(height, h, overlap)
+            xs = get_window_starts(width, w, overlap)
+            weight = get_window_weight(h, w, overlap, device, dtype)
+
+            total = torch.zeros((height, width), device=device, dtype=dtype)
+            positions = [(y, x, y + h, x + w) for y in ys for x in xs]
+            for y1, x1, y2, x2 in positions:
+                total[y1:y2, x1:x2] += weight
+            self.windows[key] = (positions, weight, total)
+        return self.windows[key]
+
+    def get_window_kwargs(self, kwargs, group):
+        # repeat the per row inputs once per window, rows are ordered window first
+        g = len(group)
+        out = dict(kwargs)
+        if kwargs.get("added_cond_kwargs"):
+            out["added_cond_kwargs"] = {k: v.repeat(g, *[1]*(v.ndim-1)) for k, v in kwargs["added_cond_kwargs"].items()}
+        if kwargs.get("added_cross_kwargs"):
+            cross = {}
+            for k, v in kwargs["added_cross_kwargs"].items():
+                if k == "regional_masks":
+                    cross[k] = [[m[y1:y2, x1:x2] for m in masks] for y1, x1, y2, x2 in group for masks in v]
+                else:
+                    cross[k] = v * g
+            out["added_cross_kwargs"] = cross
+        return out
+
+    def get_window_controlnet(self, cond, rows, width, group):
+        if cond == None:
+            return None
+        out = []
+        for s, guess, stop, c in cond:
+            scale = c.shape[-1] // width
+            crops = []
+            for y1, x1, y2, x2 in group:
+                crop = c[:, :, y1*scale:y2*scale, x1*scale:x2*scale]
+                crops += [crop.repeat_interleave(rows // crop.shape[0], dim=0)]
+            out += [(s, guess, stop, torch.cat(crops))]
+        return out
+
+    def __call__(self, latents, timestep, encoder_hidden_states, **kwargs):
+        rows, _, height, width = latents.shape
+        positions, weight, total = self.get_windows(height, width, latents.device, latents.dtype)
+
+        if len(positions) == 1:
+            return self.unet(latents, timestep, encoder_hidden_states=encoder_hidden_states, **kwargs)
+
+        controlnet_cond = getattr(self.unet, "controlnet_cond", None)
+
+        output = None
+        try:
+            for i in range(0, len(positions), self.batch):
+                group = positions[i:i+self.batch]
+                g = len(group)
+
+                window_latents = torch.cat([latents[:, :, y1:y2, x1:x2] for y1, x1, y2, x2 in group])
+                window_timestep = timestep.repeat(g) if timestep.ndim and timestep.numel() > 1 else timestep
+                window_kwargs = self.get_window_kwargs(kwargs, group)
+
+                if controlnet_cond != None:
+                    self.unet.controlnet_cond = self.get_window_controlnet(controlnet_cond, rows, width, group)
+
+                pred = self.unet(window_latents, window_timestep,
+                                 encoder_hidden_states=encoder_hidden_states.repeat(g, 1, 1), **window_kwargs).sample
+
+                if output == None:
+                    output = pred.new_zeros((rows, pred.shape[1], height, width))
+                for j, (y1, x1, y2, x2) in enumerate(group):
+                    output[:, :, y1:y2, x1:x2] += pred[j*rows:(j+1)*rows] * weight
+        finally:
+            if controlnet_cond != None:
+                self.unet.controlnet_cond = controlnet_cond
+
+        return types.SimpleNamespace(sample=output / total)
+
+    def to(self, *args):
+        self.unet.to(*args)
+
+    def __getattr__(self, name):
+        return getattr(self.unet, name)
@@ -1,5 +1,6 @@
 import torch
 import utils
+import tiling
 
 import torchvision.transforms as transforms
 import torchvision.transforms.functional
@@ -8,6 +9,9 @@ from spandrel import ImageModelDescriptor, ModelLoader
 
 TILE_SIZE = 192
 TILE_OVERLAP = 8
+TILE_MEMORY = 1024
+TILE_WEIGHTS = {}
+TILE_CACHE = 8
 
 def upscale_single(input, mode, width, height):    
     if type(input) == torch.Tensor:
@@ -37,35 +41,92 @@ def upscale_single(input, mode, width, height):
     input = torchvision.transforms.functional.crop(input, dy, dx, height, width)
     return input
 
+def get_cover_size(w, h, width, height):
+    # same sizing as upscale_single, the shorter side is scaled to cover the target then center cropped
+    rw, rh = width / w, height / h
+    if abs(rw-rh) < 0.01:
+        z = min(width, height)
+    elif rw > rh:
+        z = width
+    else:
+        z = height
+    if w <= h:
+        return z, int(z * h / w)
+    return int(z * w / h), z
+
+def resize(input, mode, width, height):
+    # batched resize and center crop of a (B, C, H, W) tensor, antialiased like PIL
+    h, w = input.shape[-2:]
+    rw, rh = get_cover_size(w, h, width, height)
+    dx, dy = int((rw-width)*0.5), int((rh-height)*0.5)
+    return utils.resize_tensor(input, mode, (rw, rh), (dx, dy, width, height))
+
 def upscale(inputs, mode, width, height):
+    # a stacked tensor is resized in one go where it lives, PIL images go through PIL one by one
+    if type(inputs) == torch.Tensor:
+        return resize(inputs, mode, width, height)
     return [upscale_single(inputs[i], mode, width, height) for i in range(len(inputs))]
 
 def upscale_super_resolution(images, model, width, height):
-    images = [i for i in images]
+    outputs = [None] * len(images)
+
+    # images of the same size upscale together and stay on the device between passes
+    groups = {}
+    for i, image in enumerate(images):
+        groups.setdefault(image.size, []).append(i)
 
     with torch.inference_mode():
-        for i, image in enumerate(images):
-            last = -1
+        for indices in groups.values():
+            img = torch.stack([utils.TO_TENSOR(images[i]) for i in indices])
+            img = img[:, [2, 1, 0]] # RGB to BGR
+            img = img.to(model.device, model.dtype)
             while True:
-                last = image.size[0]
-                img = utils.TO_TENSOR(image).unsqueeze(0)
-                img = img[:, [2, 1, 0]] # RGB to BGR
-                img = img.to(model.device, model.dtype)
-                out = upscale_tiled(img, model, TILE_SIZE, TILE_OVERLAP, model.scale)
-                out = out.clamp_(0, 1)
-                out = out[:, [2, 1, 0]] # BGR to RGB
-                image = utils.FROM_TENSOR(out.squeeze(0))
-                if last >= image.size[0] or (image.size[0] >= width and image.size[1] >= height):
+                last = img.shape[-1]
+                img = upscale_tiled(img, model, TILE_SIZE, TILE_OVERLAP, model.scale, get_tile_batch(model, TILE_SIZE))
+                img = img.clamp_(0, 1)
+                if last >= img.shape[-1] or (img.shape[-1] >= width and img.shape[-2] >= height):
                     break
 
-            if last >= image.size[0] and (width != image.size[0] or height != image.size[1]):
-                raise RuntimeError(f"SR model isnt upscaling ({last} to {image.size[0]})")
+            if last >= img.shape[-1] and (width != img.shape[-1] or height != img.shape[-2]):
+                raise RuntimeError(f"SR model isnt upscaling ({last} to {img.shape[-1]})")
 
-            images[i] = upscale_single(image, transforms.InterpolationMode.LANCZOS, width, height)
+            img = img[:, [2, 1, 0]].float().cpu() # BGR to RGB
+            for k, i in enumerate(indices):
+                outputs[i] = upscale_single(utils.FROM_TENSOR(img[k]), transforms.InterpolationMode.LANCZOS, width, height)
     
-    return images
+    return outputs
+
+def get_tile_batch(model, tile_size):
+    if not "cuda" in str(model.device):
+        return 1
+    # rough peak activation cost of an SR model per output pixel
+    cost = TILE_MEMORY * (torch.finfo(model.dtype).bits // 8) * (tile_size * model.scale) ** 2
+    return max(1, min(16, int(utils.get_free_memory(model.device) * 0.5 // cost)))
+
+def get_tile_weight(size, overlap, device, dtype):
+    # only the tile sized weight is kept, the full resolution total is rebuilt per call
+    key = (size, overlap, device, dtype)
+    if not key in TILE_WEIGHTS:
+        if len(TILE_WEIGHTS) >= TILE_CACHE:
+            TILE_WEIGHTS.clear()
+        TILE_WEIGHTS[key] = tiling.get_window_weight(size, size, overlap, device, dtype)
+    return TILE_WEIGHTS[key]
+
+def get_tile_windows(h, w, tile_size, tile_overlap, scale, device, dtype):
+    tile_overlap = min(tile_overlap, tile_size - 1)
+    stride = tile_size - tile_overlap
+    h_idx_list = list(range(0, h - tile_size, stride)) + [h - tile_size]
+    w_idx_list = list(range(0, w - tile_size, stride)) + [w - tile_size]
+    positions = [(h_idx, w_idx) for h_idx in h_idx_list for w_idx in w_idx_list]
+
+    size = tile_size * scale
+    weight = get_tile_weight(size, tile_overlap * scale, device, dtype)
+    total = torch.zeros((h * scale, w * scale), device=device, dtype=dtype)
+    for h_idx, w_idx in positions:
+        total[h_idx * scale : h_idx * scale + size, w_idx * scale : w_idx * scale + size] += weight
+    return positions, weight, total
 
-def upscale_tiled(img, model, tile_size, tile_overlap, scale):
+def upscale_tiled(img, model, tile_size, tile_overlap, scale, batch=1):
     device = model.device
     b, c, h, w = img.size()
     tile_size = min(tile_size, h, w)
@@ -73,21 +134,21 @@ def upscale_tiled(img, model, tile_size, tile_overlap, scale):
     if tile_size <= 0:
         return model(img)
 
-    stride = tile_size - tile_overlap
-    h_idx_list = list(range(0, h - tile_size, stride)) + [h - tile_size]
-    w_idx_list = list(range(0, w - tile_size, stride)) + [w - tile_size]
+    img = img.to(device)
+    positions, weight, total = get_tile_windows(h, w, tile_size, tile_overlap, scale, device, img.dtype)
     result = torch.zeros(b, c, h * scale, w * scale, device=device, dtype=img.dtype)
-    weights = torch.zeros_like(result)
-    
-    for h_idx in h_idx_list:
-        for w_idx in w_idx_list:
-            in_patch = img[..., h_idx : h_idx + tile_size, w_idx : w_idx + tile_size].to(device=device)
-            out_patch = model(in_patch)
-            result[..., h_idx * scale : (h_idx + tile_size) * scale, w_idx * scale : (w_idx + tile_size) * scale,].add_(out_patch)
-            out_patch_mask = torch.ones_like(out_patch)
-            weights[..., h_idx * scale : (h_idx + tile_size) * scale, w_idx * scale : (w_idx + tile_size) * scale,].add_(out_patch_mask)
-
-    output = result.div_(weights)
+    size = tile_size * scale
+
+    # tiles from every image go through the model together, feathered towards their edges
+    tiles = [(i, h_idx, w_idx) for i in range(b) for h_idx, w_idx in positions]
+    for k in range(0, len(tiles), max(1, batch)):
+        group = tiles[k:k+batch]
+        in_patch = torch.cat([img[i:i+1, :, h_idx : h_idx + tile_size, w_idx : w_idx + tile_size] for i, h_idx, w_idx in group])
+        out_patch = model(in_patch)
+        for j, (i, h_idx, w_idx) in enumerate(group):
+            result[i, :, h_idx * scale : h_idx * scale + size, w_idx * scale : w_idx * scale + size].add_(out_patch[j] * weight)
+
+    output = result.div_(total)
 
     return output
 
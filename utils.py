@@ -1,17 +1,23 @@
 import PIL
 import PIL.Image
 import PIL.ImageFilter
-import PIL.ImageChops
 
 import torch
 import torchvision.transforms as transforms
 import requests
 import tqdm
 import os
+import io
 import time
 import pickle
 import re
 import math
+import concurrent.futures
+import collections
+import hashlib
+import itertools
+import secrets
+import threading
 
 import numpy as np
 
@@ -26,6 +32,7 @@ TO_TENSOR = transforms.ToTensor()
 FROM_TENSOR = transforms.ToPILImage()
 
 MAPPINGS = {}
+TILE_MASKS = {}
 
 def preprocess_images(images):
     def process(image):
@@ -39,49 +46,206 @@ def postprocess_images(images):
         return FROM_TENSOR(image)
     return [process(i) for i in images]
 
-def blur_areas(areas, blur, expand):
+def lanczos(x):
+    return torch.sinc(x) * torch.sinc(x / 3)
+
+def cubic(x, a=-0.5):
+    x = x.abs()
+    return torch.where(x < 1, ((a + 2) * x - (a + 3)) * x * x + 1, ((a * x - 5 * a) * x + 8 * a) * x - 4 * a)
+
+def triangle(x):
+    return (1 - x.abs()).clamp(min=0)
+
+# kernels and their radius, matching the PIL filters
+RESIZE_KERNELS = {
+    transforms.InterpolationMode.LANCZOS: (lanczos, 3),
+    transforms.InterpolationMode.BICUBIC: (cubic, 2),
+    transforms.InterpolationMode.BILINEAR: (triangle, 1),
+}
+RESIZE_MODES = {"RGB", "RGBA", "L"}
+RESIZE_MATRICES = {}
+RESIZE_CACHE = 32
+
+def get_resize_matrix(length, size, start, count, mode, device, dtype):
+    # (count, length) antialiased resampling from length to size, for the count outputs from start.
+    # 8 bit inputs use PIL's 22 bit fixed point coefficients, float64 keeps those sums exact
+    key = (length, size, start, count, mode, device, dtype)
+    if not key in RESIZE_MATRICES:
+        scale = length / size
+        outputs = torch.arange(start, start + count)
+        if mode == transforms.InterpolationMode.NEAREST:
+            # PIL steps through the source incrementally, the accumulated rounding decides some picks
+            steps = torch.full((size,), scale, dtype=torch.float64)
+            steps[0] = 0.5 * scale
+            picks = steps.cumsum(0).floor().long().clamp(0, length - 1)
+            matrix = torch.nn.functional.one_hot(picks[outputs.clamp(0, size - 1)], length).double()
+        else:
+            kernel, radius = RESIZE_KERNELS[mode]
+            support = max(scale, 1.0)
+            centers = (outputs.double() + 0.5) * scale
+            x = (torch.arange(length, dtype=torch.float64)[None, :] + 0.5 - centers[:, None]) / support
+            matrix = kernel(x) * ((x >= -radius) & (x < radius))
+            matrix = matrix / matrix.sum(1, keepdim=True).clamp(min=1e-8)
+            if dtype == torch.float64:
+                matrix = matrix.sign() * (matrix.abs() * (1 << 22) + 0.5).floor() / (1 << 22)
+        # outputs outside the resized image are padding, like a crop past the edge
+        matrix = matrix * ((outputs >= 0) & (outputs < size))[:, None]
+        if len(RESIZE_MATRICES) >= RESIZE_CACHE:
+            RESIZE_MATRICES.clear()
+        RESIZE_MATRICES[key] = matrix.to(device, dtype)
+    return RESIZE_MATRICES[key]
+
+def resize_tensor(input, mode, size, crop=None):
+    # antialiased resize of a (B, C, H, W) tensor to size, optionally keeping only the (x, y, width, height) crop
+    h, w = input.shape[-2:]
+    rw, rh = size
+    dx, dy, width, height = crop or (0, 0, rw, rh)
+
+    exact = not input.dtype.is_floating_point
+    dtype = torch.float64 if exact and input.device.type == "cpu" else torch.float32
+    output = input.to(dtype) if exact else input
+    if (h, w) != (height, width) or (dx, dy) != (0, 0):
+        # horizontal then vertical, 8 bit inputs are rounded in between like PIL does
+        output = output @ get_resize_matrix(w, rw, dx, width, mode, input.device, output.dtype).T
+        if exact:
+            output = output.add_(0.5).floor_().clamp_(0, 255)
+        output = get_resize_matrix(h, rh, dy, height, mode, input.device, output.dtype) @ output
+
+    if exact:
+        output = output.add_(0.5).floor_().clamp_(0, 255).to(input.dtype)
+    return output
+
+def stack_images(images, device="cpu"):
+    # same sized PIL images as a (B, C, H, W) uint8 tensor
+    array = np.stack([np.asarray(i) for i in images])
+    if array.ndim == 3:
+        array = array[..., None]
+    return torch.from_numpy(array).to(device).permute(0, 3, 1, 2)
+
+def unstack_images(input, mode):
+    array = input.permute(0, 2, 3, 1).cpu().numpy()
+    if mode == "L":
+        array = array[..., 0]
+    return [PIL.Image.fromarray(a, mode) for a in array]
+
+def prefer_pil(device):
+    # PIL's resampling and blurs are linear time C code, on the CPU they beat the tensor versions
+    return device == None or torch.device(device).type == "cpu"
+
+def resize_images(images, mode, size, device=None):
+    # same sized PIL images resized into one (B, C, H, W) uint8 tensor
+    if prefer_pil(device):
+        return stack_images([i.resize(size, resample=transforms.functional.pil_modes_mapping[mode]) for i in images])
+    return resize_tensor(stack_images(images, device), mode, size)
+
+def max_filter(input, size, dim):
+    # running max of nonnegative values, the window doubles every pass so the cost grows with log(size)
+    length, radius = input.shape[dim], size // 2
+    pad = (radius, radius) if dim == -1 else (0, 0, radius, radius)
+    output = torch.nn.functional.pad(input, pad, value=0)
+    width = 1
+    while width * 2 <= size:
+        count = output.shape[dim] - width
+        output = torch.maximum(output.narrow(dim, 0, count), output.narrow(dim, width, count))
+        width *= 2
+    return torch.maximum(output.narrow(dim, 0, length), output.narrow(dim, size - width, length))
+
+def dilate_masks(masks, size):
+    # square MaxFilter as two separable passes
+    return max_filter(max_filter(masks, size, -1), size, -2)
+
+def get_box_radius(radius, passes=3):
+    # the extended box radius PIL substitutes for a gaussian, computed in single precision like PIL
+    f = np.float32
+    sigma2 = f(radius) * f(radius) / f(passes)
+    L = f(np.sqrt(f(12.0) * sigma2 + f(1.0)))
+    l = f(np.floor((L - f(1.0)) / f(2.0)))
+    a = (f(2) * l + f(1)) * (l * (l + f(1)) - f(3) * sigma2)
+    a = a / (f(6) * (sigma2 - (l + f(1)) * (l + f(1))))
+    return l + a
+
+def box_blur(input, radius, dim):
+    # one extended box pass in PIL's 24 bit fixed point, edges repeat
+    length, r = input.shape[dim], int(radius)
+    ww = int(np.float32(1 << 24) / (np.float32(radius) * np.float32(2) + np.float32(1)))
+    fw = ((1 << 24) - (r * 2 + 1) * ww) // 2
+    pad = (r + 1, r + 1, 0, 0) if dim == -1 else (0, 0, r + 1, r + 1)
+    padded = torch.nn.functional.pad(input.flatten(0, -3), pad, mode="replicate")
+    sums = padded.cumsum(dim)
+    window = sums.narrow(dim, 2 * r + 1, length) - sums.narrow(dim, 0, length)
+    edges = padded.narrow(dim, 0, length) + padded.narrow(dim, 2 * r + 2, length)
+    output = window.mul_(ww).add_(edges.mul_(fw)).add_(1 << 23).div_(1 << 24).floor_()
+    return output.view(input.shape)
+
+def blur_masks(masks, blur, passes=3):
+    # matches PIL GaussianBlur, which is three extended box blurs per axis
+    radius = get_box_radius(blur, passes)
+    output = masks.double()
+    for dim in [-1, -2]:
+        for _ in range(passes):
+            output = box_blur(output, radius, dim)
+    return output.to(masks.dtype)
+
+def gaussian_blur(masks, blur):
+    if masks.device.type == "cpu":
+        mode = {1: "L", 3: "RGB", 4: "RGBA"}[masks.shape[1]]
+        return stack_images([m.filter(PIL.ImageFilter.GaussianBlur(blur)) for m in unstack_images(masks, mode)])
+    return blur_masks(masks, blur)
+
+def filter_masks(masks, blur, expand):
+    # (B, C, H, W) uint8 masks through the expand MaxFilter and the blur
+    if expand:
+        masks = dilate_masks(masks, int(2*expand + 1))
+    if blur:
+        masks = gaussian_blur(masks, blur)
+    return masks
+
+def group_images(images):
+    # indices of the images by size and mode, for processing them in batches
+    groups = {}
+    for i, image in enumerate(images):
+        groups.setdefault((image.size, image.mode), []).append(i)
+    return groups.values()
+
+def blur_areas(areas, blur, expand, device=None):
     if not areas:
         return []
-    out = []
-    for i in range(len(areas)):
-        o = []
-        for j in range(len(areas[i])):
-            a = areas[i][j]
-            if expand or blur:
-                b = a.copy()
-                if expand:
-                    b = b.filter(PIL.ImageFilter.MaxFilter(int(2*expand + 1)))
-                if blur:
-                    b = b.filter(PIL.ImageFilter.MaxFilter(int(blur*2 + 1)))
-                    b = b.filter(PIL.ImageFilter.GaussianBlur(blur))
-                a = PIL.ImageChops.lighter(a, b)
-            o += [a]
-        out += [o]
-    return out
-
-def preprocess_areas(areas, width, height):
+    flat = [a for o in areas for a in o]
+    if expand or blur:
+        for indices in group_images(flat):
+            a = stack_images([flat[k] for k in indices], "cpu" if prefer_pil(device) else device)
+            b = dilate_masks(a, int(2*expand + 1)) if expand else a
+            if blur:
+                b = gaussian_blur(dilate_masks(b, int(blur*2 + 1)), blur)
+            for k, image in zip(indices, unstack_images(torch.maximum(a, b), flat[indices[0]].mode)):
+                flat[k] = image
+    flat = iter(flat)
+    return [[next(flat) for _ in o] for o in areas]
+
+def preprocess_areas(areas, width, height, device=None):
     if not areas:
         return []
-    out = []
-    for i in range(len(areas)):
-        o = []
-        for j in range(len(areas[i])):
-            w, h = width, height
-            w, h = w - w % 8, h - h % 8
-            a = areas[i][j].resize((w // 8, h // 8), resample=PIL.Image.LANCZOS)
-            a = TO_TENSOR(a).to(torch.float32)
-            o += [torch.cat([a]*4)[None, :]]
-        out += [o]
-    return out
-
-def preprocess_masks(masks):
-    def process(mask):
-        w, h = mask.size
+    w, h = width, height
+    w, h = w - w % 8, h - h % 8
+    flat = [a for o in areas for a in o]
+    for indices in group_images(flat):
+        a = resize_images([flat[k] for k in indices], transforms.InterpolationMode.LANCZOS, (w // 8, h // 8), device)
+        a = a.to(torch.float32) / 255
+        for k in range(len(indices)):
+            flat[indices[k]] = torch.cat([a[k]]*4)[None, :]
+    flat = iter(flat)
+    return [[next(flat) for _ in o] for o in areas]
+
+def preprocess_masks(masks, device=None):
+    outputs = [None] * len(masks)
+    for indices in group_images(masks):
+        w, h = masks[indices[0]].size
         w, h = w - w % 8, h - h % 8
-        mask = mask.resize((w // 8, h // 8), resample=PIL.Image.LANCZOS)
-        mask = 1 - TO_TENSOR(mask).to(torch.float32)
-        return mask[None, :]
-    return torch.cat([process(m) for m in masks])
+        mask = resize_images([masks[i] for i in indices], transforms.InterpolationMode.LANCZOS, (w // 8, h // 8), device)
+        mask = 1 - mask.to(torch.float32) / 255
+        for i, m in zip(indices, mask):
+            outputs[i] = m[None, :]
+    return torch.cat(outputs)
 
 def encode_inpainting(images, masks, vae, seeds):
     if masks != None:
@@ -105,52 +269,251 @@ def encode_inpainting(images, masks, vae, seeds):
 
     return latents, masks
 
-def encode_images(vae, seeds, images):
+# client selectable encodings, PIL format and save options
+IMAGE_FORMATS = {
+    "PNG": ("PNG", {}),
+    "PNG (fast)": ("PNG", {"compress_level": 1}),
+    "WebP (lossless)": ("WEBP", {"lossless": True, "quality": 0, "method": 0}),
+    "WebP": ("WEBP", {"quality": 80}),
+    "JPEG": ("JPEG", {"quality": 80}),
+}
+# PIL releases the GIL while compressing, so threads encode in parallel
+IMAGE_ENCODER = concurrent.futures.ThreadPoolExecutor(min(8, os.cpu_count() or 1))
+
+def get_image_type(format):
+    return IMAGE_FORMATS[format][0]
+
+def save_image(image, format, thumbnail=None):
+    if thumbnail:
+        image = image.copy()
+        image.thumbnail((thumbnail, thumbnail), PIL.Image.Resampling.LANCZOS)
+    name, options = IMAGE_FORMATS[format]
+    if name == "JPEG" and image.mode != "RGB" or name == "WEBP" and not image.mode in {"RGB", "RGBA"}:
+        image = image.convert("RGB")
+    bytesio = io.BytesIO()
+    image.save(bytesio, format=name, **options)
+    return bytesio.getvalue()
+
+def save_images_async(images, format, thumbnail=None):
+    # futures in the same order as the images, missing images stay None
+    return [IMAGE_ENCODER.submit(save_image, i, format, thumbnail) if i != None else None for i in images]
+
+def save_images(images, format, thumbnail=None):
+    return [f.result() if f != None else None for f in save_images_async(images, format, thumbnail)]
+
+# measured peak VAE memory per image pixel, per byte of the VAE dtype, refined after every run
+VAE_MEMORY = {"encode": 2048, "decode": 4096}
+# overrides the free memory as the VAE budget, in bytes
+VAE_BUDGET = None
+VAE_WORKER = concurrent.futures.ThreadPoolExecutor(1)
+# finishing stages decode on another thread, VAE calls and the FP32 casts must not interleave
+VAE_LOCK = threading.RLock()
+# images processed, and images that had to be redone in FP32
+VAE_STATS = {"encode": 0, "decode": 0, "encode_fallback": 0, "decode_fallback": 0, "encode_cached": 0}
+# distinguishes loaded VAE instances in the encode cache keys
+VAE_TOKENS = itertools.count()
+
+def get_vae_batch(vae, op, count, height, width):
+    # images per micro batch, 0 when a single image does not fit
+    if VAE_BUDGET != None:
+        budget = VAE_BUDGET
+    elif "cuda" in str(vae.device):
+        budget = get_free_memory(vae.device) * 0.8
+    else:
+        return count
+    cost = VAE_MEMORY[op] * height * width * (torch.finfo(vae.dtype).bits // 8)
+    return min(count, int(budget // cost))
+
+def get_vae_batches(vae, op, count, height, width, tiled=False):
+    # tiled forces tiling for every batch, otherwise only a single image that does not fit is tiled
+    batch = get_vae_batch(vae, op, count, height, width)
+    tiled = tiled or batch == 0
+    batch = max(batch, 1)
+    return [(i, min(i + batch, count), tiled) for i in range(0, count, batch)]
+
+def run_vae(vae, op, function, x, tiled, measure=True):
+    with VAE_LOCK:
+        measure = measure and not tiled and "cuda" in str(vae.device)
+        if measure:
+            torch.cuda.reset_peak_memory_stats(vae.device)
+            base = torch.cuda.memory_allocated(vae.device)
+
+        use_tiling = vae.use_tiling
+        vae.use_tiling = use_tiling or tiled
+        try:
+            out = function(x)
+        finally:
+            vae.use_tiling = use_tiling
+
+        if measure:
+            pixels = x.shape[0] * x.shape[2] * x.shape[3] * (64 if op == "decode" else 1)
+            measured = (torch.cuda.max_memory_allocated(vae.device) - base) / (pixels * (torch.finfo(vae.dtype).bits // 8))
+            # grow straight away, shrink slowly
+            VAE_MEMORY[op] = max(measured, (VAE_MEMORY[op] + measured) / 2)
+        return out
+
+def get_vae_fallback(vae, outputs):
+    # indices of the images that overflowed a reduced precision VAE
+    if not getattr(vae, "precision_fallback", False) or vae.dtype == torch.float32:
+        return None
+    bad = torch.zeros(outputs[0].shape[0], dtype=torch.bool, device=outputs[0].device)
+    for o in outputs:
+        bad |= ~torch.isfinite(o.flatten(1)).all(dim=1)
+    if not bad.any():
+        return None
+    return bad.nonzero()[:, 0]
+
+def run_vae_fp32(vae, op, function, x, tiled):
+    with VAE_LOCK:
+        dtype = vae.dtype
+        vae.to(torch.float32)
+        try:
+            return run_vae(vae, op, function, x.float(), tiled, measure=False)
+        finally:
+            vae.to(dtype)
+
+def get_encode_key(vae, image, tiled=False):
+    # the pixels already reflect the crop and the target size, the size keeps equal bytes of other shapes apart
+    if getattr(vae, "cache_token", None) == None:
+        vae.cache_token = next(VAE_TOKENS)
+    digest = hashlib.blake2b(image.tobytes(), digest_size=16).hexdigest()
+    return (digest, image.mode, image.size, vae.cache_token, str(vae.dtype), vae.use_tiling or tiled)
+
+def encode_images(vae, seeds, images, tiled=False):
+    keys = [None] * len(images)
     if type(images) != torch.Tensor:
+        keys = [get_encode_key(vae, i, tiled) for i in images]
         images = preprocess_images(images).to(vae.device, vae.dtype)
     
     noise = singular_noise(seeds, images.shape[3] // 8, images.shape[2] // 8, vae.device).to(vae.dtype)
 
-    dists = vae.encode(images)
-    mean = torch.stack([dists.mean[i%len(images)] for i in range(len(seeds))])
-    std = torch.stack([dists.std[i%len(images)] for i in range(len(seeds))])
+    def encode(x):
+        if vae.use_tiling:
+            return vae.tiled_encode(x).latent_dist
+        return vae.encode(x)
+
+    # cached distributions are reused, only the missing images go through the VAE
+    means, stds = [None] * len(images), [None] * len(images)
+    for i, key in enumerate(keys):
+        if key != None and (entry := ENCODE_CACHE.get(key)) != None:
+            dist = entry[0].to(vae.device)
+            means[i], stds[i] = dist[0:1], dist[1:2]
+            VAE_STATS["encode_cached"] += 1
+    missing = [i for i in range(len(images)) if means[i] == None]
+
+    for start, end, batch_tiled in get_vae_batches(vae, "encode", len(missing), images.shape[2], images.shape[3], tiled):
+        dists = run_vae(vae, "encode", encode, images[missing[start:end]], batch_tiled)
+        mean, std = dists.mean, dists.std
+        VAE_STATS["encode"] += end - start
+        if (index := get_vae_fallback(vae, [mean, std])) != None:
+            VAE_STATS["encode_fallback"] += len(index)
+            dists = run_vae_fp32(vae, "encode", encode, images[missing[start:end]][index], batch_tiled)
+            mean, std = mean.clone(), std.clone()
+            mean[index], std[index] = dists.mean.to(mean.dtype), dists.std.to(std.dtype)
+        for j, i in enumerate(missing[start:end]):
+            means[i], stds[i] = mean[j:j+1], std[j:j+1]
+            if keys[i] != None:
+                ENCODE_CACHE.put(torch.cat([means[i], stds[i]]), None, keys[i])
+    means, stds = torch.cat(means), torch.cat(stds)
+
+    mean = torch.stack([means[i%len(images)] for i in range(len(seeds))])
+    std = torch.stack([stds[i%len(images)] for i in range(len(seeds))])
 
     latents = (mean + std * noise) * vae.scaling_factor
     
     return latents
 
-def encode_images_disjointed(vae, seeds, images):
-    latents = []
-    for i, seed in enumerate(seeds):
-        latents += [encode_images(vae, [seed], [images[i%len(images)]])]
+def encode_images_disjointed(vae, seeds, images, tiled=False):
+    # images of the same size are encoded together
+    groups = {}
+    for i in range(len(seeds)):
+        groups.setdefault(images[i%len(images)].size, []).append(i)
+
+    latents = [None] * len(seeds)
+    for indices in groups.values():
+        encoded = encode_images(vae, [seeds[i] for i in indices], [images[i%len(images)] for i in indices], tiled)
+        for k, i in enumerate(indices):
+            latents[i] = encoded[k:k+1]
     return latents
     
-def decode_images(vae, latents):
+def decode_batches(vae, latents, tiled=False):
+    # (start, images) for every micro batch, as (B, C, H, W) uint8 on the VAE device
+    source = latents
     latents = latents.clone().detach().to(vae.device, vae.dtype) / vae.scaling_factor
-    images = vae.decode(latents).sample
-    return postprocess_images(images)
 
-def get_latents(vae, seeds, images):
+    decode = lambda x: vae.decode(x).sample
+    for start, end, batch_tiled in get_vae_batches(vae, "decode", len(latents), latents.shape[2] * 8, latents.shape[3] * 8, tiled):
+        images = run_vae(vae, "decode", decode, latents[start:end], batch_tiled)
+        VAE_STATS["decode"] += end - start
+        if (index := get_vae_fallback(vae, [images])) != None:
+            VAE_STATS["decode_fallback"] += len(index)
+            images = images.float()
+            fallback = source[start:end][index.to(source.device)].to(vae.device, torch.float32) / vae.scaling_factor
+            images[index] = run_vae_fp32(vae, "decode", decode, fallback, batch_tiled)
+        yield start, (images / 2 + 0.5).clamp(0, 1).mul(255).byte()
+
+def decode_pixels(vae, latents):
+    # decoded images that stay a tensor on the device, for consumers that never need PIL
+    return torch.cat([images for _, images in decode_batches(vae, latents)])
+
+def decode_images(vae, latents, on_decoded=None, tiled=False):
+    # on_decoded(start, images) sees every micro batch in order as soon as it is converted
+    def postprocess(images, ready):
+        if ready != None:
+            ready.synchronize()
+        return [FROM_TENSOR(i) for i in images]
+
+    # the PIL conversion of one micro batch runs while the next one decodes
+    pending, decoded = [], []
+    for start, images in decode_batches(vae, latents, tiled):
+        ready = None
+        if images.is_cuda:
+            images = images.to("cpu", non_blocking=True)
+            ready = torch.cuda.Event()
+            ready.record()
+        else:
+            images = images.cpu()
+        pending += [(start, VAE_WORKER.submit(postprocess, images, ready))]
+        while on_decoded and pending and pending[0][1].done():
+            on_decoded(pending[0][0], pending[0][1].result())
+            decoded += pending.pop(0)[1].result()
+
+    for start, p in pending:
+        if on_decoded:
+            on_decoded(start, p.result())
+        decoded += p.result()
+    return decoded
+
+def get_latents(vae, seeds, images, tiled=False):
     if type(images) == torch.Tensor:
         return images.to(vae.device)
     elif type(images) == list:
         if all([images[0].size == i.size for i in images]):
-            return encode_images(vae, seeds, images)
+            return encode_images(vae, seeds, images, tiled)
         else:
-            return encode_images_disjointed(vae, seeds, images)
+            return encode_images_disjointed(vae, seeds, images, tiled)
 
 def get_masks(device, masks):
     if type(masks) == torch.Tensor:
         return masks      
     elif type(masks) == list:
-        return preprocess_masks(masks).to(device)
+        return preprocess_masks(masks, device).to(device)
     
-def prepare_mask(mask, blur, expand):
-    if expand:
-        mask = mask.filter(PIL.ImageFilter.MaxFilter(int(2*expand + 1)))
-    if blur:
-        mask = mask.filter(PIL.ImageFilter.GaussianBlur(blur))
-    return mask
+def prepare_mask(mask, blur, expand, device=None):
+    return prepare_masks([mask], blur, expand, device)[0]
+
+def prepare_masks(masks, blur, expand, device=None):
+    # missing masks stay None, the rest are filtered in batches of equal size
+    outputs = list(masks)
+    if not expand and not blur:
+        return outputs
+    present = [i for i in range(len(masks)) if masks[i] != None]
+    for indices in group_images([masks[i] for i in present]):
+        indices = [present[k] for k in indices]
+        filtered = filter_masks(stack_images([masks[i] for i in indices], "cpu" if prefer_pil(device) else device), blur, expand)
+        for i, mask in zip(indices, unstack_images(filtered, masks[indices[0]].mode)):
+            outputs[i] = mask
+    return outputs
 
 def apply_inpainting(images, originals, masks, extents):
     outputs = [None] * len(images)
@@ -255,6 +618,57 @@ def cast_state_dict(state_dict, dtype, device='cpu'):
             state_dict[k] = tmp.to(device, dtype=dtype)
     return state_dict
 
+class LatentCache():
+    # final latents behind opaque handles, least recently used go first once over the memory limit
+    def __init__(self, limit):
+        self.limit = limit
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get_limit(self):
+        # never hold more than a small share of the RAM still available
+        try:
+            available = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+            return min(self.limit, available // 16)
+        except (ValueError, OSError, AttributeError):
+            return self.limit
+
+    def put(self, latents, info, id=None):
+        latents = latents.detach().to("cpu", copy=True)
+        with self.lock:
+            if id == None:
+                # handles act as capabilities, so they must not be guessable
+                id = secrets.token_urlsafe(16)
+            if id in self.entries:
+                self.size -= self.entries[id][0].numel() * self.entries[id][0].element_size()
+            self.entries[id] = (latents, info)
+            self.size += latents.numel() * latents.element_size()
+            self.trim()
+        return id
+
+    def get(self, id):
+        with self.lock:
+            if not id in self.entries:
+                return None
+            self.entries.move_to_end(id)
+            return self.entries[id]
+
+    def trim(self):
+        limit = self.get_limit()
+        while self.size > limit and self.entries:
+            _, (latents, _) = self.entries.popitem(last=False)
+            self.size -= latents.numel() * latents.element_size()
+
+    def get_stats(self):
+        with self.lock:
+            self.trim()
+            return {"count": len(self.entries), "bytes": self.size}
+
+# bytes of encoded image distributions kept for repeated img2img inputs
+ENCODE_CACHE_LIMIT = 256 * 1024 * 1024
+ENCODE_CACHE = LatentCache(ENCODE_CACHE_LIMIT)
+
 class NoiseSchedule():
     def __init__(self, seeds, subseeds, width, height, device, dtype):
         self.seeds = seeds
@@ -262,51 +676,49 @@ class NoiseSchedule():
         self.shape = (4, int(height), int(width))
         self.device = device
         self.dtype = dtype
-        self.steps = 0
         self.index = 0
 
-        self.noise = []
+        self.rng_device = device
+        if DIRECTML_AVAILABLE and self.rng_device == torch_directml.device():
+            self.rng_device = torch.device("cpu")
+
+        self.generators = []
+        self.position = 0
+        self.noise = None
 
         self.reset()
     
     def reset(self):
-        self.noise = []
         self.index = 0
-        self.allocate(32)
-    
-    def allocate(self, steps):
-        self.steps = steps
-        self.generate()
+        self.restart()
+
+    def restart(self):
+        # one persistent generator per seed, each produces that seed's noise sequence in order
+        self.generators = [torch.Generator(self.rng_device).manual_seed(seed) for seed in self.seeds]
+        self.position = 0
+        self.noise = None
 
     def generate(self):
-        rng_device = self.device
-        if DIRECTML_AVAILABLE and rng_device == torch_directml.device():
-            rng_device = torch.device("cpu")
-
-        generator = torch.Generator(rng_device)
-        noises = []
-        for i in range(len(self.seeds)):
-            seed = self.seeds[i]
-            generator.manual_seed(seed)
-            noises += [[]]
-
-            for _ in range(self.steps+1):
-                noise = torch.randn(self.shape, generator=generator, device=rng_device).to(self.device, self.dtype)
-                noises[i] += [noise]
-
-        for i in range(len(self.subseeds)):
-            seed, strength = self.subseeds[i]
-            generator.manual_seed(seed)
-            subnoise = torch.randn(self.shape, generator=generator, device=rng_device).to(self.device, self.dtype)
-            noises[i][0] = slerp_noise(strength, noises[i][0], subnoise)
-
-        self.noise = [torch.stack(n) for n in zip(*noises)]
+        noises = [torch.randn(self.shape, generator=g, device=self.rng_device).to(self.device, self.dtype) for g in self.generators]
+
+        if self.position == 0:
+            generator = torch.Generator(self.rng_device)
+            for i in range(len(self.subseeds)):
+                seed, strength = self.subseeds[i]
+                generator.manual_seed(seed)
+                subnoise = torch.randn(self.shape, generator=generator, device=self.rng_device).to(self.device, self.dtype)
+                noises[i] = slerp_noise(strength, noises[i], subnoise)
+
+        self.noise = torch.stack(noises)
+        self.position += 1
     
     def __getitem__(self, i):
-        if i >= len(self.noise):
-            self.steps *= 2
+        # noise is only kept for the latest index, going backwards replays the generators
+        if i < self.position - 1:
+            self.restart()
+        while self.position <= i:
             self.generate()
-        return self.noise[i]
+        return self.noise
 
     def __call__(self, advance=True):
         noise = self[self.index]
@@ -541,33 +953,34 @@ def lora_mapping(key):
     
     return key + "." + suffix
     
+def get_free_memory(device):
+    stats = torch.cuda.memory_stats(device)
+    mem_free_cuda, _ = torch.cuda.mem_get_info(device)
+    mem_free_torch = stats['reserved_bytes.all.current'] - stats['active_bytes.all.current']
+    return mem_free_cuda + mem_free_torch
+
 def get_tile_mask(size, radius):
     width, height = size
     width, height = int(width), int(height)
-
-    radius_x, radius_y = radius
-    radius_x, radius_y = int(radius_x), int(radius_y)
-
-    mask = np.ones((height, width), dtype=np.float32)
-
     radius_x, radius_y = radius
 
-    for i in range(height//2):
-        for j in range(width//2):
-            weight_x, weight_y = 1, 1
-            if i < radius_y:
-                weight_y = (i / radius_y)
-            if j < radius_x:
-                weight_x = (j / radius_x)        
-            weight = min(weight_x, weight_y) ** 2
-            if weight == 1:
-                continue
-            mask[i, j] = weight
-            mask[i, width-j-1] = weight
-            mask[height-i-1, j] = weight
-            mask[height-i-1, width-j-1] = weight
+    key = (width, height, radius_x, radius_y)
+    if not key in TILE_MASKS:
+        # weights for one quadrant, mirrored into the others
+        def ramp(length, r):
+            i = np.arange(length // 2, dtype=np.float64)
+            return np.where(i < r, i / (r or 1), 1.0)
+        quadrant = np.minimum(ramp(height, radius_y)[:, None], ramp(width, radius_x)[None, :]) ** 2
+
+        mask = np.ones((height, width), dtype=np.float32)
+        h, w = quadrant.shape
+        mask[:h, :w] = quadrant
+        mask[:h, width-w:] = quadrant[:, ::-1]
+        mask[height-h:, :w] = quadrant[::-1, :]
+        mask[height-h:, width-w:] = quadrant[::-1, ::-1]
+        TILE_MASKS[key] = np.uint8(mask*255)
     
-    return PIL.Image.fromarray(np.uint8(mask*255), mode="L")
+    return PIL.Image.fromarray(TILE_MASKS[key], mode="L")
 
 def get_tiles(images, tile_size, upscale):
     base_size = int(tile_size)
@@ -634,7 +1047,6 @@ def assemble_tiles(original_images, tile_images, tile_positions, tile_masks):
     assembled = []
     for img, tiles, positions, mask in data:
         img_width, img_height = img.size
-        img_tensor = TO_TENSOR(img)
         mask_tensor = TO_TENSOR(mask)
 
         inv_mask = torch.zeros((1, img_height, img_width))
@@ -647,17 +1059,16 @@ def assemble_tiles(original_images, tile_images, tile_positions, tile_masks):
             over_mask[:,y1:y2,x1:x2] += mask_tensor + inv_mask[:,y1:y2,x1:x2]
         over_mask = 1 / over_mask.clamp(1,None)
 
-        output = torch.zeros_like(img_tensor)
+        output = torch.zeros((3, img_height, img_width))
 
-        for i, ((x1, y1, x2, y2), tile) in enumerate(zip(positions, tiles)):
+        for (x1, y1, x2, y2), tile in zip(positions, tiles):
             w, h = x2-x1, y2-y1
-            tile = tile.resize((w,h))
-            tile_tensor = TO_TENSOR(tile)
+            if tile.size != (w, h):
+                tile = tile.resize((w,h))
+            tile_tensor = torch.from_numpy(np.array(tile)).permute(2, 0, 1).float().div_(255)
             mask = (mask_tensor + inv_mask[:,y1:y2,x1:x2]) * over_mask[:,y1:y2,x1:x2]
-            #masked = torch.cat([tile_tensor, mask])
-            #FROM_TENSOR(masked).save(f"{i}.png")
             output[:,y1:y2,x1:x2] += tile_tensor * mask
         
-        assembled += [FROM_TENSOR(output)]#.save(f"out.png")
+        assembled += [FROM_TENSOR(output)]
 
     return assembled
\ No newline at end of file
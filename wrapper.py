@@ -4,11 +4,13 @@ import PIL
 import PIL.Image
 import random
 import io
+import time
 import os
 import safetensors.torch
 import shutil
 import tomesd
 import contextlib
+import concurrent.futures
 import numpy as np
 
 DIRECTML_AVAILABLE = False
@@ -34,6 +36,7 @@ import inference
 import convert
 import attention
 import controlnet
+import tiling
 import preview
 import segmentation
 import merge
@@ -43,15 +46,17 @@ import model_metadata
 DEFAULTS = {
     "strength": 0.75, "sampler": "Euler a", "clip_skip": 1, "eta": 1,
     "hr_upscaler": "Latent (nearest)", "hr_strength": 0.7, "img2img_upscaler": "Lanczos", "mask_blur": 4,
-    "attention": "Default", "vram_mode": "Default"
+    "attention": "Default", "vram_mode": "Default", "area_mode": "Composition", "tile_mode": "Pixel",
+    "vae_precision": "Auto", "image_format": "PNG", "preview_format": "JPEG",
+    "preview_rate": 4, "preview_budget": 0.2, "preview_size": 512
 }
 
 TYPES = {
-    int: ["width", "height", "steps", "seed", "batch_size", "clip_skip", "mask_blur", "hr_steps", "padding"],
-    float: ["scale", "eta", "hr_factor", "hr_eta", "hr_scale"],
+    int: ["width", "height", "steps", "seed", "batch_size", "clip_skip", "mask_blur", "hr_steps", "padding", "cfg_interval", "deepcache_interval", "deepcache_depth", "adaptive_patience", "tile_batch", "preview_size"],
+    float: ["scale", "eta", "hr_factor", "hr_eta", "hr_scale", "cfg_truncation", "deepcache_start", "deepcache_end", "adaptive_tolerance", "preview_rate", "preview_budget"],
 }
 
-STATIC = ["storage", "device", "device_names", "callback", "last_models_modified", "last_models_config", "dataset", "public", "temporary"]
+STATIC = ["storage", "device", "device_names", "callback", "last_models_modified", "last_models_config", "dataset", "public", "temporary", "stages", "side_streams", "stage_config", "previews", "backlog", "latent_cache"]
 
 SAMPLER_CLASSES = {
     "Euler": samplers_k.Euler,
@@ -63,6 +68,10 @@ SAMPLER_CLASSES = {
     "DPM++ SDE": samplers_k.DPM_SDE,
     "DPM++ 2M SDE": samplers_k.DPM_2M_SDE,
     "DPM++ 3M SDE": samplers_k.DPM_3M_SDE,
+    "DPM++ 3M": samplers_k.DPM_3M,
+    "UniPC": samplers_k.UniPC,
+    "UniPC BH1": samplers_k.UniPC_BH1,
+    "DEIS": samplers_k.DEIS,
     "LCM": samplers_k.LCM,
 
     "Euler Karras": samplers_k.Euler_Karras,
@@ -72,6 +81,10 @@ SAMPLER_CLASSES = {
     "DPM++ SDE Karras": samplers_k.DPM_SDE_Karras,
     "DPM++ 2M SDE Karras": samplers_k.DPM_2M_SDE_Karras,
     "DPM++ 3M SDE Karras": samplers_k.DPM_3M_SDE_Karras,
+    "DPM++ 3M Karras": samplers_k.DPM_3M_Karras,
+    "UniPC Karras": samplers_k.UniPC_Karras,
+    "UniPC BH1 Karras": samplers_k.UniPC_BH1_Karras,
+    "DEIS Karras": samplers_k.DEIS_Karras,
     "LCM Karras": samplers_k.LCM_Karras,
 
     "Euler Exponential": samplers_k.Euler_Exponential,
@@ -81,6 +94,10 @@ SAMPLER_CLASSES = {
     "DPM++ SDE Exponential": samplers_k.DPM_SDE_Exponential,
     "DPM++ 2M SDE Exponential": samplers_k.DPM_2M_SDE_Exponential,
     "DPM++ 3M SDE Exponential": samplers_k.DPM_3M_SDE_Exponential,
+    "DPM++ 3M Exponential": samplers_k.DPM_3M_Exponential,
+    "UniPC Exponential": samplers_k.UniPC_Exponential,
+    "UniPC BH1 Exponential": samplers_k.UniPC_BH1_Exponential,
+    "DEIS Exponential": samplers_k.DEIS_Exponential,
     "LCM Exponential": samplers_k.LCM_Exponential,
 
     "Euler Uniform": samplers_k.Euler_Uniform,
@@ -90,12 +107,30 @@ SAMPLER_CLASSES = {
     "DPM++ SDE Uniform": samplers_k.DPM_SDE_Uniform,
     "DPM++ 2M SDE Uniform": samplers_k.DPM_2M_SDE_Uniform,
     "DPM++ 3M SDE Uniform": samplers_k.DPM_3M_SDE_Uniform,
+    "DPM++ 3M Uniform": samplers_k.DPM_3M_Uniform,
+    "UniPC Uniform": samplers_k.UniPC_Uniform,
+    "UniPC BH1 Uniform": samplers_k.UniPC_BH1_Uniform,
+    "DEIS Uniform": samplers_k.DEIS_Uniform,
     "LCM Uniform": samplers_k.LCM_Uniform,
 
+    "Euler AYS": samplers_k.Euler_AYS,
+    "Euler a AYS": samplers_k.Euler_a_AYS,
+    "DPM++ 2M AYS": samplers_k.DPM_2M_AYS,
+    "DPM++ 2S a AYS": samplers_k.DPM_2S_a_AYS,
+    "DPM++ SDE AYS": samplers_k.DPM_SDE_AYS,
+    "DPM++ 2M SDE AYS": samplers_k.DPM_2M_SDE_AYS,
+    "DPM++ 3M SDE AYS": samplers_k.DPM_3M_SDE_AYS,
+    "DPM++ 3M AYS": samplers_k.DPM_3M_AYS,
+    "UniPC AYS": samplers_k.UniPC_AYS,
+    "UniPC BH1 AYS": samplers_k.UniPC_BH1_AYS,
+    "DEIS AYS": samplers_k.DEIS_AYS,
+    "LCM AYS": samplers_k.LCM_AYS,
+
     "Euler a CFG++": samplers_k.Euler_a_CFG_PP,
     "Euler a CFG++ Karras": samplers_k.Euler_a_CFG_PP_Karras,
     "Euler a CFG++ Exponential": samplers_k.Euler_a_CFG_PP_Exponential,
     "Euler a CFG++ Uniform": samplers_k.Euler_a_CFG_PP_Uniform,
+    "Euler a CFG++ AYS": samplers_k.Euler_a_CFG_PP_AYS,
 }
 
 UPSCALERS_LATENT = {
@@ -121,6 +156,23 @@ CROSS_ATTENTION = {
     "XFormers": attention.use_xformers_attention
 }
 
+AREA_MODES = ["Composition", "Attention"]
+
+TILE_MODES = ["Pixel", "Latent"]
+
+VAE_PRECISIONS = ["Auto", "FP16", "BF16", "FP32"]
+
+TILE_MEMORY = 96 * 1024
+
+# decodes request images as soon as they arrive, PIL releases the GIL while decoding
+INPUT_DECODER = concurrent.futures.ThreadPoolExecutor(min(8, os.cpu_count() or 1))
+
+# bytes of final latents kept for latent handles
+LATENT_CACHE_LIMIT = 512 * 1024 * 1024
+
+# queued messages for the client beyond which new previews are skipped
+PREVIEW_BACKLOG = 2
+
 FP32_DEVICES = ["1660", "1650", "1630", "T500", "T550", "T600", "MX550", "MX450", "CMP 30HX"]
 
 def format_float(x):
@@ -129,6 +181,48 @@ def format_float(x):
 def model_name(x):
     return x.rsplit('.',1)[0].rsplit(os.path.sep,1)[-1]
 
+def decode_input(data, kind):
+    try:
+        image = PIL.Image.open(io.BytesIO(data))
+        image.load()
+    except (OSError, ValueError, PIL.Image.DecompressionBombError) as e:
+        raise ValueError(f"invalid {kind}: {e}")
+
+    if kind == "image":
+        if image.mode == 'RGBA':
+            image = PIL.Image.alpha_composite(PIL.Image.new('RGBA',image.size,(0,0,0)), image)
+            image = image.convert("RGB")
+        if image.mode != 'RGB':
+            image = image.convert("RGB")
+    else:
+        if image.mode == 'RGBA':
+            image = image.split()[-1]
+        else:
+            image = image.convert("L")
+    return image
+
+def prepare_inputs(data):
+    # decodes every image payload of a request in parallel and in place, returns the bytes of the decoded images
+    jobs = []
+    def submit(values, kind):
+        for i in range(len(values or [])):
+            if type(values[i]) == bytes or type(values[i]) == bytearray:
+                jobs.append((values, i, INPUT_DECODER.submit(decode_input, values[i], kind)))
+    submit(data.get("image"), "image")
+    submit(data.get("cn_image"), "image")
+    submit(data.get("mask"), "mask")
+    for area in data.get("area") or []:
+        submit(area, "mask")
+
+    memory = 0
+    for values, i, future in jobs:
+        values[i] = future.result()
+        memory += values[i].width * values[i].height * len(values[i].getbands())
+    return memory
+
+def get_latent_space(vae):
+    return "SDXL" if "SDXL" in vae.model_type else "SD"
+
 class AbortError(RuntimeError):
     pass
 
@@ -159,6 +253,17 @@ class GenerationParameters():
         self.callback = None
         self.temporary = {}
 
+        # finishing stages (decode, encode, send) run in order on one worker, overlapped with the next request
+        self.stages = concurrent.futures.ThreadPoolExecutor(1)
+        self.side_streams = {}
+        self.stage_config = None
+
+        # one preview renders at a time, backlog reports the messages still queued for the client
+        self.previews = concurrent.futures.ThreadPoolExecutor(1)
+        self.backlog = None
+
+        self.latent_cache = utils.LatentCache(LATENT_CACHE_LIMIT)
+
     def switch_public(self):
         self.public = True
 
@@ -182,25 +287,67 @@ class GenerationParameters():
 
         if "n" in progress:
             self.current_step += 1
+
+        if "saved" in progress:
+            self.saved_steps += progress["saved"]
+            self.total_steps -= progress["saved"]
+            total = self.total_steps
+            remaining = (total - step) / rate if rate and total else 0
         
         progress = {"current": step, "total": total, "rate": rate, "remaining": remaining, "unit": "it/s"}
+        if self.saved_steps:
+            progress["saved"] = self.saved_steps
         
-        interval = int(self.preview_interval or 0)
-        if latents != None and self.show_preview and step % interval == 0:
-            if self.show_preview == "Full":
-                images = preview.full_preview(latents, self.vae)
-            elif self.show_preview == "Medium":
-                images = preview.model_preview(latents, self.vae)
-            else:
-                images = preview.cheap_preview(latents, self.vae)
-            for i in range(len(images)):
-                bytesio = io.BytesIO()
-                images[i].save(bytesio, format='JPEG', quality=80)
-                images[i] = bytesio.getvalue()
-            progress["previews"] = images
+        if latents != None and self.show_preview:
+            if previews := self.get_previews(step, latents):
+                progress["previews"], progress["previews_type"] = previews
 
         self.set_progress(progress)
 
+    def get_previews(self, step, latents):
+        # previews render on a side thread from the latest predictions and ride along with a later progress message,
+        # new ones only start within the rate and time budget and never while the client is backlogged
+        previews = None
+        if self.preview_future and self.preview_future.done():
+            previews, cost = self.preview_future.result()
+            self.preview_future = None
+            self.preview_next = self.preview_started + max(1 / self.preview_rate, cost / self.preview_budget)
+
+        interval = int(self.preview_interval or 1)
+        if self.preview_future or step % interval or time.monotonic() < (self.preview_next or 0):
+            return previews
+        if self.backlog and self.backlog() > PREVIEW_BACKLOG:
+            return previews
+
+        mode, vae, size, device = self.show_preview, self.vae, self.preview_size, latents.device
+        _, preview_format = self.get_formats()
+        latents = latents.clone()
+        ready = None
+        if device.type == "cuda":
+            ready = torch.cuda.Event()
+            ready.record(torch.cuda.current_stream(device))
+
+        def render():
+            start = time.monotonic()
+            with torch.inference_mode(), self.get_side_context("preview", device, ready):
+                if mode == "Full":
+                    # decoding at the preview size is far cheaper than decoding in full and shrinking after
+                    scale = size / (max(latents.shape[-2:]) * 8)
+                    previews = latents
+                    if scale < 0.5:
+                        previews = torch.nn.functional.interpolate(latents.float(), scale_factor=scale, mode="bilinear", antialias=True).to(latents.dtype)
+                    images = preview.full_preview(previews, vae)
+                elif mode == "Medium":
+                    images = preview.model_preview(latents, vae)
+                else:
+                    images = preview.cheap_preview(latents, vae)
+            data = utils.save_images(images, preview_format, thumbnail=size)
+            return (data, utils.get_image_type(preview_format)), time.monotonic() - start
+
+        self.preview_started = time.monotonic()
+        self.preview_future = self.previews.submit(render)
+        return previews
+
     def on_download(self, progress):
         if not progress["rate"]:
             self.set_status("Downloading")
@@ -263,66 +410,171 @@ class GenerationParameters():
             if not self.callback({"type": "training_progress", "data": progress}):
                 raise AbortError("Aborted")
 
+    def get_formats(self):
+        return self.image_format or DEFAULTS["image_format"], self.preview_format or DEFAULTS["preview_format"]
+
     def on_artifact(self, name, images):
         if self.callback:
+            image_format, _ = self.get_formats()
+            image_type = utils.get_image_type(image_format)
             if type(images[0]) == list:
+                artifacts = []
                 for j in range(max([len(i) for i in images])):
-                    images_data = []
-                    for i in range(len(images)):
-                        if j < len(images[i]):
-                            bytesio = io.BytesIO()
-                            images[i][j].save(bytesio, format='PNG')
-                            images_data += [bytesio.getvalue()]
-                        else:
-                            images_data += [None]
-                    self.callback({"type": "artifact", "data": {"name": f"{name} {j+1}", "images": images_data, "type": "PNG"}})
+                    row = [images[i][j] if j < len(images[i]) else None for i in range(len(images))]
+                    artifacts += [(f"{name} {j+1}", utils.save_images_async(row, image_format))]
             else:
-                images_data = []
-                for i in images:
-                    if i != None:
-                        bytesio = io.BytesIO()
-                        i.save(bytesio, format='PNG')
-                        images_data += [bytesio.getvalue()]
-                    else:
-                        images_data += [None]
-                self.callback({"type": "artifact", "data": {"name": name, "images": images_data, "type": "PNG"}})
-        
+                artifacts = [(name, utils.save_images_async(images, image_format))]
+
+            callback = self.callback
+            def send():
+                for artifact_name, futures in artifacts:
+                    images_data = [f.result() if f != None else None for f in futures]
+                    callback({"type": "artifact", "data": {"name": artifact_name, "images": images_data, "type": image_type}})
+
+            # queued behind earlier stages so artifacts and results keep their order
+            if self.use_overlap():
+                self.run_stage(send)
+            else:
+                send()
+
+    def get_delivery(self):
+        image_format, preview_format = self.get_formats()
+        return {"delay_fetch": self.delay_fetch, "stream": self.stream_results and not self.delay_fetch,
+                "image_format": image_format, "preview_format": preview_format}
+
     def on_complete(self, images, metadata):
-        if self.callback:
-            self.set_status("Fetching")
+        delivery = self.get_delivery()
+        if self.use_overlap():
+            callback = self.callback
+            self.run_stage(lambda: self.deliver(images, metadata, callback, delivery))
+        else:
+            self.deliver(images, metadata, self.callback, delivery)
 
-            if self.delay_fetch:
+    def deliver(self, images, metadata, callback, delivery, streamed=0):
+        # streamed images were already sent as they were decoded
+        image_format, preview_format = delivery["image_format"], delivery["preview_format"]
+        if callback:
+            if not streamed and not callback({"type": "status", "data": {"message": "Fetching", "reset": True}}):
+                self.storage.do_gc()
+                raise AbortError("Aborted")
+
+            if delivery["delay_fetch"]:
                 id = random.randrange(2147483646)
-                self.temporary[id] = (images, metadata)
-                images_data = []
-                for i in images:
-                    bytesio = io.BytesIO()
-                    im = i.copy()
-                    im.thumbnail((256,256), PIL.Image.Resampling.LANCZOS)
-                    im.save(bytesio, format="JPEG")
-                    images_data += [bytesio.getvalue()]
-                self.callback({"type": "temporary", "data": {"id": id, "images": images_data, "metadata": metadata, "type": "JPEG"}})
+                self.temporary[id] = (images, metadata, image_format, delivery.get("latent_ids"))
+                images_data = utils.save_images(images, preview_format, thumbnail=256)
+                data = {"id": id, "images": images_data, "metadata": metadata, "type": utils.get_image_type(preview_format)}
+                callback({"type": "temporary", "data": self.add_handles(data, delivery)})
+            elif delivery["stream"]:
+                self.send_results(images[streamed:], metadata, streamed, callback, delivery)
+                data = {"count": len(images), "metadata": metadata, "type": utils.get_image_type(image_format)}
+                callback({"type": "result_done", "data": self.add_handles(data, delivery)})
             else:
-                images_data = []
-                for i in images:
-                    bytesio = io.BytesIO()
-                    i.save(bytesio, format="PNG")
-                    images_data += [bytesio.getvalue()]
-                self.callback({"type": "result", "data": {"images": images_data, "metadata": metadata, "type": "PNG"}})
+                images_data = utils.save_images(images, image_format)
+                data = {"images": images_data, "metadata": metadata, "type": utils.get_image_type(image_format)}
+                callback({"type": "result", "data": self.add_handles(data, delivery)})
         self.storage.do_gc()
 
+    def add_handles(self, data, delivery):
+        if delivery.get("latent_ids"):
+            data["latent_ids"] = delivery["latent_ids"]
+        return data
+
+    def send_results(self, images, metadata, start, callback, delivery):
+        # one result_image message per image, each sent as soon as it is encoded
+        image_format, latent_ids = delivery["image_format"], delivery.get("latent_ids")
+        image_type = utils.get_image_type(image_format)
+        for i, future in enumerate(utils.save_images_async(images, image_format)):
+            index = start + i
+            data = {"index": index, "image": future.result(), "metadata": metadata[index], "type": image_type}
+            if latent_ids:
+                data["latent_id"] = latent_ids[index]
+            if not callback({"type": "result_image", "data": data}):
+                self.storage.do_gc()
+                raise AbortError("Aborted")
+
+    def use_overlap(self):
+        # Minimal swaps models in and out around every stage and public servers clear VRAM after each request
+        return self.vram_mode != "Minimal" and not self.public
+
+    def get_stage_config(self):
+        return [self.model, self.unet, self.clip, self.vae, self.device_name, self.precision, self.vae_precision,
+                self.attention, self.tiling_mode, self.vram_mode]
+
+    def sync_stages(self):
+        # a pending stage still holds the previous VAE, wait before anything could move, cast or evict it
+        config = self.get_stage_config()
+        if config != self.stage_config or self.hr_model or self.merge_checkpoint_recipe:
+            self.wait_stages()
+        self.stage_config = config
+
+    def run_stage(self, function):
+        callback, device = self.callback, self.device
+        ready = None
+        if device.type == "cuda":
+            ready = torch.cuda.Event()
+            ready.record(torch.cuda.current_stream(device))
+
+        def stage():
+            try:
+                with torch.inference_mode(), self.get_side_context("stage", device, ready):
+                    function()
+            except AbortError:
+                pass
+            except Exception as e:
+                if callback:
+                    callback({"type": "error", "data": {"message": str(e)}})
+
+        self.stages.submit(stage)
+
+    def get_side_context(self, name, device, ready):
+        # the side stream waits for the sampling work queued before the handoff
+        if ready == None:
+            return contextlib.nullcontext()
+        if not (name, device) in self.side_streams:
+            self.side_streams[(name, device)] = torch.cuda.Stream(device)
+        stream = self.side_streams[(name, device)]
+        stream.wait_event(ready)
+        return torch.cuda.stream(stream)
+
+    def wait_stages(self):
+        self.stages.submit(lambda: None).result()
+
+    def finish(self, latents, metadata, postprocess=None):
+        # decode and deliver on the stage worker, the next request can start sampling meanwhile
+        vae, callback, delivery = self.vae, self.callback, self.get_delivery()
+        keep_latents = self.keep_latents
+        def stage():
+            if keep_latents:
+                space = get_latent_space(vae)
+                delivery["latent_ids"] = [self.latent_cache.put(latents[i:i+1], space) for i in range(len(latents))]
+            streamed = []
+            on_decoded = None
+            if callback and delivery["stream"] and not postprocess:
+                if not callback({"type": "status", "data": {"message": "Fetching", "reset": True}}):
+                    raise AbortError("Aborted")
+                def on_decoded(start, images):
+                    self.send_results(images, metadata, start, callback, delivery)
+                    streamed.extend(images)
+            images = utils.decode_images(vae, latents, on_decoded)
+            if postprocess:
+                images = postprocess(images)
+            self.deliver(images, metadata, callback, delivery, len(streamed))
+            return images
+
+        if not self.use_overlap():
+            images = stage()
+            self.need_models(unet=False, vae=False, clip=False)
+            return images
+        self.run_stage(stage)
+
     def fetch(self, id):
         if id in self.temporary:
-            images, metadata = self.temporary[id]
+            images, metadata, image_format, latent_ids = self.temporary[id]
             del self.temporary[id]
 
-            images_data = []
-            for i in images:
-                bytesio = io.BytesIO()
-                i.save(bytesio, format="PNG")
-                images_data += [bytesio.getvalue()]
-            
-            return {"type": "result", "data": {"images": images_data, "metadata": metadata, "type": "PNG"}}
+            images_data = utils.save_images(images, image_format)
+            data = {"images": images_data, "metadata": metadata, "type": utils.get_image_type(image_format)}
+            return {"type": "result", "data": self.add_handles(data, {"latent_ids": latent_ids})}
         return None
 
     def reset(self):
@@ -334,33 +586,8 @@ class GenerationParameters():
         return None
 
     def set(self, **kwargs):
+        prepare_inputs(kwargs)
         for key, value in kwargs.items():
-            if key == "image" or key == "cn_image":
-                for i in range(len(value)):
-                    if type(value[i]) == bytes or type(value[i]) == bytearray:
-                        value[i] = PIL.Image.open(io.BytesIO(value[i]))
-                        if value[i].mode == 'RGBA':
-                            value[i] = PIL.Image.alpha_composite(PIL.Image.new('RGBA',value[i].size,(0,0,0)), value[i])
-                            value[i] = value[i].convert("RGB")
-                        if value[i].mode != 'RGB':
-                            value[i] = value[i].convert("RGB")
-            if key == "mask":
-                for i in range(len(value)):
-                    if type(value[i]) == bytes or type(value[i]) == bytearray:
-                        value[i] = PIL.Image.open(io.BytesIO(value[i]))
-                        if value[i].mode == 'RGBA':
-                            value[i] = value[i].split()[-1]
-                        else:
-                            value[i] = value[i].convert("L")
-            if key == "area":
-                for i in range(len(value)):
-                    for j in range(len(value[i])):
-                        if type(value[i][j]) == bytes or type(value) == bytearray:
-                            value[i][j] = PIL.Image.open(io.BytesIO(value[i][j]))
-                            if value[i][j].mode == 'RGBA':
-                                value[i][j] = value[i][j].split()[-1]
-                            else:
-                                value[i][j] = value[i][j].convert("L")
             if key in STATIC:
                 continue
             setattr(self, key, value)
@@ -422,17 +649,23 @@ class GenerationParameters():
 
         if self.vae_precision == "FP32":
             self.storage.vae_dtype = torch.float32
+        elif self.vae_precision == "BF16":
+            self.storage.vae_dtype = torch.bfloat16
         else:
             self.storage.vae_dtype = torch.float16
 
     def configure_vae(self):
         if not self.vae:
             return
-        self.vae.enable_slicing()
-        if self.tiling_mode == "Enabled":
-            self.vae.enable_tiling()
-        else:
-            self.vae.disable_tiling()
+        # an overlapped stage may be inside run_vae, which restores the tiling it found when it finishes
+        with utils.VAE_LOCK:
+            self.vae.enable_slicing()
+            # Auto runs in FP16 and redoes any image that overflows in FP32
+            self.vae.precision_fallback = self.vae_precision == "Auto"
+            if self.tiling_mode == "Enabled":
+                self.vae.enable_tiling()
+            else:
+                self.vae.disable_tiling()
 
     def need_models(self, unet, vae, clip):
         if self.vram_mode != "Minimal":
@@ -481,17 +714,68 @@ class GenerationParameters():
         if not self.sampler in SAMPLER_CLASSES:
             raise ValueError(f"unknown sampler: {self.sampler}")
 
+        if not self.area_mode in AREA_MODES:
+            raise ValueError(f"unknown area mode: {self.area_mode}")
+
+        if not self.vae_precision in VAE_PRECISIONS:
+            raise ValueError(f"unknown VAE precision: {self.vae_precision}")
+
+        if not self.image_format in utils.IMAGE_FORMATS:
+            raise ValueError(f"unknown image format: {self.image_format}")
+
+        if not self.preview_format in utils.IMAGE_FORMATS:
+            raise ValueError(f"unknown preview format: {self.preview_format}")
+
+        if not self.tile_mode in TILE_MODES:
+            raise ValueError(f"unknown tile mode: {self.tile_mode}")
+
+        if self.tile_batch and self.tile_batch < 1:
+            raise ValueError("Tile batch must be at least 1")
+
         if (self.width or self.height) and not (self.width and self.height):
             raise ValueError("width and height must both be set")
         
+        if self.preview_rate <= 0:
+            raise ValueError("Preview rate must be positive")
+
+        if not (0 < self.preview_budget <= 1):
+            raise ValueError("Preview budget must be between 0 and 1")
+
+        if self.preview_size < 16:
+            raise ValueError("Preview size must be at least 16")
+
         if self.vram_mode == "Minimal" and self.show_preview == "Full":
             raise ValueError("Full preview is incompatible with minimal VRAM")
+
+        if self.cfg_truncation and not 0 < self.cfg_truncation <= 1:
+            raise ValueError("CFG truncation must be between 0 and 1")
+
+        if self.cfg_interval and self.cfg_interval < 1:
+            raise ValueError("CFG interval must be at least 1")
+
+        if self.deepcache_interval and self.deepcache_interval < 1:
+            raise ValueError("DeepCache interval must be at least 1")
+
+        if self.deepcache_depth and self.deepcache_depth < 1:
+            raise ValueError("DeepCache depth must be at least 1")
+
+        if (self.deepcache_start or 0) < 0 or (self.deepcache_end or 1) > 1 or (self.deepcache_start or 0) >= (self.deepcache_end or 1):
+            raise ValueError("DeepCache start and end must be ordered between 0 and 1")
+
+        if self.adaptive_tolerance and self.adaptive_tolerance < 0:
+            raise ValueError("Adaptive tolerance must be positive")
+
+        if self.adaptive_patience and self.adaptive_patience < 1:
+            raise ValueError("Adaptive patience must be at least 1")
         
         if self.public:
             self.device_name = "Default"
             self.vram_mode = "Default"
             if self.merge_lora_recipe or self.merge_checkpoint_recipe:
                 raise Exception("Merging is disabled")
+            # the latent cache is shared by every client, handles are not scoped to a connection
+            if self.keep_latents or self.latent_id:
+                raise Exception("Latent handles are disabled")
         
         if self.prediction_type:
             self.prediction_type = self.prediction_type.lower()
@@ -505,6 +789,8 @@ class GenerationParameters():
             self.storage.set_ram_limit(1)
 
     def set_device(self):
+        self.sync_stages()
+
         device = torch.device("cuda")
 
         if self.public:
@@ -546,6 +832,12 @@ class GenerationParameters():
         if mode in UPSCALERS_LATENT:
             return upscalers.upscale_single(latents, UPSCALERS_LATENT[mode], width//8, height//8)
 
+        if mode in UPSCALERS_PIXEL and self.device.type != "cpu":
+            # stays a tensor on the device from the decode all the way into the encode
+            pixels = upscalers.upscale(utils.decode_pixels(self.vae, latents), UPSCALERS_PIXEL[mode], width, height)
+            self.set_status("Encoding")
+            return utils.encode_images(self.vae, seeds, pixels.to(self.vae.dtype) / 127.5 - 1)
+
         images = utils.decode_images(self.vae, latents)
         if mode in UPSCALERS_PIXEL:
             images = upscalers.upscale(images, UPSCALERS_PIXEL[mode], width, height) 
@@ -587,6 +879,24 @@ class GenerationParameters():
         
         return seeds, subseeds
     
+    def get_handle_latents(self):
+        if not self.latent_id:
+            return None
+        latents = []
+        for id in self.latent_id if type(self.latent_id) == list else [self.latent_id]:
+            if (entry := self.latent_cache.get(id)) == None:
+                raise ValueError(f"unknown or expired latent handle: {id}")
+            if entry[1] != get_latent_space(self.vae):
+                raise ValueError(f"latent handle from an incompatible model: {id}")
+            latents += [entry[0]]
+        return latents
+
+    def decode_handles(self, latents):
+        # pixels are needed after all, decode here rather than round trip through the client
+        self.set_status("Decoding")
+        self.need_models(unet=False, vae=True, clip=False)
+        self.image = [utils.decode_images(self.vae, l)[0] for l in latents]
+
     def get_batch_size(self):
         batch_size = max(self.batch_size or 1, 1)
         for i in [self.prompt, self.negative_prompt, self.seeds, self.subseeds, self.image, self.mask, self.area]:
@@ -594,6 +904,16 @@ class GenerationParameters():
                 batch_size = max(batch_size, len(i))
         return batch_size
     
+    def get_tile_batch(self, tile_size, rows):
+        if self.tile_batch:
+            return self.tile_batch
+        if not "cuda" in str(self.device):
+            return 4
+        # rough peak activation cost of the UNET per latent pixel, per row
+        element_size = torch.finfo(self.storage.dtype).bits // 8
+        cost = TILE_MEMORY * element_size * rows * (tile_size // 8) ** 2
+        return max(1, min(16, int(utils.get_free_memory(self.device) * 0.5 // cost)))
+
     def get_sampler(self, sampler_name, denoiser, eta, zsnr_mode):
         denoiser.set_cfg_pp(False)
         sampler = SAMPLER_CLASSES[sampler_name](denoiser, eta)
@@ -618,6 +938,8 @@ class GenerationParameters():
                 inputs += ["controlnet"]
             if self.area:
                 inputs += ["subprompt"]
+                if self.area_mode != DEFAULTS["area_mode"]:
+                    m["area_mode"] = self.area_mode
             if inputs:
                 m["inputs"] = inputs
 
@@ -650,9 +972,22 @@ class GenerationParameters():
                 m["steps"] = self.steps
                 m["scale"] = format_float(self.scale)
                 m["sampler"] = self.sampler
+                if self.sampler.endswith(" AYS"):
+                    m["schedule"] = "AYS " + (self.unet.model_type if self.unet.model_type in samplers_k.AYS_SCHEDULES else "SDv1")
                 m["clip_skip"] = self.clip_skip
                 if self.cfg_rescale:
                     m["cfg_rescale"] = format_float(self.cfg_rescale)
+                if self.cfg_truncation and self.cfg_truncation < 1:
+                    m["cfg_truncation"] = format_float(self.cfg_truncation)
+                if self.cfg_interval and self.cfg_interval > 1:
+                    m["cfg_interval"] = self.cfg_interval
+                if self.deepcache_interval and self.deepcache_interval > 1:
+                    m["deepcache_interval"] = self.deepcache_interval
+                    m["deepcache_depth"] = self.deepcache_depth or 1
+                    if self.deepcache_start:
+                        m["deepcache_start"] = format_float(self.deepcache_start)
+                    if self.deepcache_end and self.deepcache_end < 1:
+                        m["deepcache_end"] = format_float(self.deepcache_end)
                 if self.prediction_type:
                     m["prediction_type"] = self.prediction_type.capitalize()
 
@@ -805,6 +1140,7 @@ class GenerationParameters():
     
         self.set_status("Parsing")
         conditioning = prompts.BatchedConditioningSchedules(self.prompt, self.steps, self.clip_skip)
+        conditioning.set_area_mode(self.area_mode)
         initial_networks = conditioning.get_initial_networks() if self.network_mode == "Static" else ({},{})
         all_networks, allowed_networks = conditioning.get_all_networks((self.hr_steps or self.steps) if self.hr_factor else None)
 
@@ -839,6 +1175,7 @@ class GenerationParameters():
         
         self.current_step = 0
         self.total_steps = self.steps
+        self.saved_steps = 0
 
         if self.hr_factor:
             self.hr_steps = self.hr_steps or self.steps
@@ -852,10 +1189,10 @@ class GenerationParameters():
         metadata = self.get_metadata("txt2img", self.width, self.height, batch_size, self.prompt, seeds, subseeds)
 
         if self.area:
-            area = utils.blur_areas(self.area, self.mask_blur, self.mask_expand)
+            area = utils.blur_areas(self.area, self.mask_blur, self.mask_expand, device)
             if self.keep_artifacts:
                 self.on_artifact("Area", area)
-            area = utils.preprocess_areas(area, self.width, self.height)
+            area = utils.preprocess_areas(area, self.width, self.height, device)
         else:
             area = []
         
@@ -870,6 +1207,8 @@ class GenerationParameters():
 
         self.set_status("Preparing")
         denoiser = guidance.GuidedDenoiser(self.unet, device, conditioning, self.scale, self.cfg_rescale or 0.0, self.prediction_type)
+        denoiser.set_cfg_skipping(self.cfg_truncation, self.cfg_interval)
+        denoiser.set_feature_cache(self.deepcache_interval, self.deepcache_depth, self.deepcache_start, self.deepcache_end)
         noise = utils.NoiseSchedule(seeds, subseeds, self.width // 8, self.height // 8, device, self.unet.dtype)
         sampler = self.get_sampler(self.sampler, denoiser, self.eta, self.zsnr_mode)
 
@@ -883,20 +1222,26 @@ class GenerationParameters():
 
         self.set_status("Generating")
         with self.get_autocast_context(self.autocast, device):
-            latents = inference.txt2img(denoiser, sampler, noise, self.steps, self.on_step)
+            latents = inference.txt2img(denoiser, sampler, noise, self.steps, self.on_step, self.adaptive_tolerance, self.adaptive_patience or 3)
+
+        if self.saved_steps:
+            for m in metadata:
+                m["adaptive_tolerance"] = format_float(self.adaptive_tolerance)
+                m["steps_saved"] = self.saved_steps
 
         self.need_models(unet=False, vae=True, clip=False)
 
         if not self.hr_factor:
             self.set_status("Decoding")
-            images = utils.decode_images(self.vae, latents)
+            if not self.detailers:
+                return self.finish(latents, metadata)
 
-            if self.detailers:
-                if self.keep_artifacts:
-                    self.on_artifact("Original", images)
-                for i in range(len(self.detailers)):
-                    self.set_status("Detailing")
-                    images = self.detailing(i, images, conditioning, seeds, subseeds, device)
+            images = utils.decode_images(self.vae, latents)
+            if self.keep_artifacts:
+                self.on_artifact("Original", images)
+            for i in range(len(self.detailers)):
+                self.set_status("Detailing")
+                images = self.detailing(i, images, conditioning, seeds, subseeds, device)
 
             self.on_complete(images, metadata)
             self.need_models(unet=False, vae=False, clip=False)
@@ -947,8 +1292,8 @@ class GenerationParameters():
             self.attach_networks(hr_all_networks, allowed_networks, device)
 
         if self.area:
-            area = utils.blur_areas(self.area, self.mask_blur, self.mask_expand)
-            area = utils.preprocess_areas(self.area, width, height)
+            area = utils.blur_areas(self.area, self.mask_blur, self.mask_expand, device)
+            area = utils.preprocess_areas(self.area, width, height, device)
 
         self.set_status("Encoding")
         self.need_models(unet=False, vae=False, clip=True)
@@ -994,6 +1339,9 @@ class GenerationParameters():
 
         self.set_status("Decoding")
         self.need_models(unet=False, vae=True, clip=False)
+        if not self.detailers:
+            return self.finish(latents, metadata)
+
         images = utils.decode_images(self.vae, latents)
 
         if self.detailers:
@@ -1023,69 +1371,120 @@ class GenerationParameters():
         prompt = params["prompt"]
         upscaler = "Lanczos"
 
-        og_pos, og_neg = "", ""
-        try:
-            og_pos = self.prompt[0][0][0]
-            og_neg = self.prompt[0][1][0]
-        except:
-            pass
-        prompt = prompt.replace("PROMPT", og_pos)
-        detailer_prompt = [([prompt], [og_neg])]
+        def get_prompt(index):
+            og_pos, og_neg = "", ""
+            try:
+                og_pos = self.prompt[index][0][0]
+                og_neg = self.prompt[index][1][0]
+            except:
+                pass
+            return ([prompt.replace("PROMPT", og_pos)], [og_neg])
 
         width, height = resolution, resolution
-
         actual_steps = int(self.steps * strength) + 1
-        conditioning = prompts.BatchedConditioningSchedules(detailer_prompt, actual_steps, self.clip_skip)
-        
-        self.need_models(unet=True, vae=True, clip=True)
-        conditioning.encode(self.clip, [])
-        
-        denoiser = guidance.GuidedDenoiser(self.unet, device, conditioning, self.scale, self.cfg_rescale or 0.0, self.prediction_type)
-        noise = utils.NoiseSchedule(seeds, subseeds, width // 8, height // 8, device, self.unet.dtype)
-        sampler = self.get_sampler(self.sampler, denoiser, self.eta, self.zsnr_mode)
 
         detailer = self.storage.get_detailer(name, device)
-        
-        detected, artifact = detailer.predict_masks(images[0], threshold, box_mode)
+
+        # one detection call for the whole batch, every region of every image becomes a row of its own
+        detections = detailer.predict_masks_batch(images, threshold, box_mode)
         if self.keep_artifacts:
-            self.on_artifact(f"Detection {detailer_index}", [artifact])
+            self.on_artifact(f"Detection {detailer_index}", [artifact for _, artifact in detections])
 
-        for cls, mask in detected:
-            images = [images[0].copy()]
-            masks = [mask]
+        regions = [(i, j, mask) for i, (detected, _) in enumerate(detections) for j, (_, mask) in enumerate(detected)]
+        if not regions:
+            return images
 
-            extents = utils.get_extents(images, masks, padding, width, height)
+        masks, extents = [], []
+        for i, _, mask in regions:
+            extent = utils.get_extents([images[i]], [mask], padding, width, height)[0]
+            masks += [utils.prepare_mask(self.prepare_images([mask], [extent], width, height)[0], mask_blur, mask_expand, device)]
+            extents += [extent]
+        region_seeds = [seeds[i % len(seeds)] + j for i, j, _ in regions]
+        region_subseeds = [subseeds[i % len(subseeds)] for i, _, _ in regions]
+        region_prompts = [i % len(self.prompt) if self.prompt else 0 for i, _, _ in regions]
+
+        # a region must see the results of earlier regions it overlaps, so it goes in a later wave than them
+        def overlaps(a, b):
+            return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+        waves = [0] * len(regions)
+        for r in range(len(regions)):
+            for q in range(r):
+                if regions[q][0] == regions[r][0] and overlaps(extents[q], extents[r]):
+                    waves[r] = max(waves[r], waves[q] + 1)
+
+        region_batch = self.get_tile_batch(resolution, 2)
+        groups = []
+        for w in range(max(waves) + 1):
+            wave = [r for r in range(len(regions)) if waves[r] == w]
+            groups += [(w, wave[k:k + region_batch]) for k in range(0, len(wave), region_batch)]
 
-            original_images = images
-            images = utils.apply_extents(images, extents)
-            masks = self.prepare_images(masks, extents, width, height)
-            masks = [utils.prepare_mask(mask, mask_blur, mask_expand) for mask in masks]
+        self.need_models(unet=True, vae=True, clip=True)
 
-            upscaled_images = self.upscale_images(images, upscaler, width, height)
+        # groups with the same prompts share their encoded conditioning
+        denoisers = {}
+        for _, group in groups:
+            key = tuple(region_prompts[r] for r in group)
+            if key in denoisers:
+                continue
+            group_conditioning = prompts.BatchedConditioningSchedules([get_prompt(p) for p in key], actual_steps, self.clip_skip)
+            group_conditioning.encode(self.clip, [])
+            denoiser = guidance.GuidedDenoiser(self.unet, device, group_conditioning, self.scale, self.cfg_rescale or 0.0, self.prediction_type)
+            denoiser.set_cfg_skipping(self.cfg_truncation, self.cfg_interval)
+            denoiser.set_feature_cache(self.deepcache_interval, self.deepcache_depth, self.deepcache_start, self.deepcache_end)
+            denoisers[key] = denoiser
 
-            latents = utils.get_latents(self.vae, seeds, upscaled_images)
-            original_latents = latents
-                
-            mask_latents = utils.get_masks(device, masks)
+        self.current_step = 0
+        self.total_steps = actual_steps * len(groups)
 
-            denoiser.reset()
-            denoiser.set_mask(mask_latents, original_latents)
+        images = list(images)
+        for w in range(max(waves) + 1):
+            wave = [r for r in range(len(regions)) if waves[r] == w]
 
-            self.current_step = 0
-            self.total_steps = int(self.steps * strength) + 1
+            crops = {}
+            for r in wave:
+                crop = utils.apply_extents([images[regions[r][0]]], [extents[r]])[0]
+                crops[r] = self.upscale_images([crop], upscaler, width, height)[0]
 
-            with self.get_autocast_context(self.autocast, device):
-                latents = inference.img2img(latents, denoiser, sampler, noise, self.steps, False, strength, self.on_step)
-            
-            images = utils.decode_images(self.vae, latents)
+            outputs = {}
+            for group in [g for v, g in groups if v == w]:
+                denoiser = denoisers[tuple(region_prompts[r] for r in group)]
+                sampler = self.get_sampler(self.sampler, denoiser, self.eta, self.zsnr_mode)
+                group_seeds = [region_seeds[r] for r in group]
+
+                latents = utils.get_latents(self.vae, group_seeds, [crops[r] for r in group])
+                mask_latents = utils.get_masks(device, [masks[r] for r in group])
+
+                denoiser.reset()
+                denoiser.set_mask(mask_latents, latents)
+                noise = utils.NoiseSchedule(group_seeds, [region_subseeds[r] for r in group], width // 8, height // 8, device, self.unet.dtype)
+
+                with self.get_autocast_context(self.autocast, device):
+                    latents = inference.img2img(latents, denoiser, sampler, noise, self.steps, False, strength, self.on_step)
 
-            images, masked = utils.apply_inpainting(images, original_images, masks, extents)
+                for k, image in enumerate(utils.decode_images(self.vae, latents)):
+                    outputs[group[k]] = image
+
+            # regions of one wave never overlap within an image, so the images are pasted in parallel
+            def paste(i):
+                image = images[i]
+                for r in wave:
+                    if regions[r][0] == i:
+                        image = utils.apply_inpainting([outputs[r]], [image], [masks[r]], [extents[r]])[0][0]
+                return image
+
+            pasted = sorted(set(regions[r][0] for r in wave))
+            with concurrent.futures.ThreadPoolExecutor(min(len(pasted), 8)) as pool:
+                for i, image in zip(pasted, pool.map(paste, pasted)):
+                    images[i] = image
 
         return images
 
     @torch.inference_mode()
     def img2img(self):
         if self.tile_size:
+            if self.tile_mode == "Latent":
+                return self.latent_tiled_img2img()
             return self.tiled_img2img()
         
         self.set_status("Configuring")
@@ -1096,6 +1495,7 @@ class GenerationParameters():
 
         actual_steps = int(self.steps * self.strength) + 1
         conditioning = prompts.BatchedConditioningSchedules(self.prompt, actual_steps, self.clip_skip)
+        conditioning.set_area_mode(self.area_mode)
         initial_networks = conditioning.get_initial_networks() if self.network_mode == "Static" else ({},{})
         all_networks, allowed_networks = conditioning.get_all_networks()
 
@@ -1107,6 +1507,15 @@ class GenerationParameters():
 
         self.attach_tome()
 
+        if (handles := self.get_handle_latents()) != None:
+            # the cached latents replace the encode, unless the pixels of the input are needed
+            sizes = {(l.shape[3] * 8, l.shape[2] * 8) for l in handles}
+            if self.mask or self.unet.inpainting or self.keep_artifacts or len(sizes) > 1 or (self.width and not (self.width, self.height) in sizes):
+                self.decode_handles(handles)
+                handles = None
+            else:
+                self.image = [PIL.Image.new("RGB", (l.shape[3] * 8, l.shape[2] * 8)) for l in handles]
+
         self.need_models(unet=True, vae=False, clip=True)
         
         self.set_status("Preparing")
@@ -1132,8 +1541,8 @@ class GenerationParameters():
         images = utils.apply_extents(images, extents)
         masks = self.prepare_images(masks, extents, width, height)
         if masks:
-            original_masks = [None if mask == None else utils.prepare_mask(mask, 0, 0) for mask in masks]
-            masks = [None if mask == None else utils.prepare_mask(mask, self.mask_blur, self.mask_expand) for mask in masks]
+            original_masks = utils.prepare_masks(masks, 0, 0, device)
+            masks = utils.prepare_masks(masks, self.mask_blur, self.mask_expand, self.device)
 
         seeds, subseeds = self.get_seeds(batch_size)
         metadata = self.get_metadata("img2img",  width, height, batch_size, self.prompt, seeds, subseeds)
@@ -1156,10 +1565,10 @@ class GenerationParameters():
             for i in range(len(self.area)):
                 if self.mask and self.mask[i] != None:
                     self.area[i] = self.prepare_images(self.area[i], [extents[i]]*len(self.area[i]), width, height)
-            self.area = utils.blur_areas(self.area, self.mask_blur, self.mask_expand)
+            self.area = utils.blur_areas(self.area, self.mask_blur, self.mask_expand, device)
             if self.keep_artifacts:
                 self.on_artifact("Area", self.area)
-            self.area = utils.preprocess_areas(self.area, width, height)
+            self.area = utils.preprocess_areas(self.area, width, height, device)
         else:
             self.area = []
 
@@ -1175,17 +1584,22 @@ class GenerationParameters():
         conditioning.encode(self.clip, self.area)
 
         denoiser = guidance.GuidedDenoiser(self.unet, device, conditioning, self.scale, self.cfg_rescale or 0.0, self.prediction_type)
+        denoiser.set_cfg_skipping(self.cfg_truncation, self.cfg_interval)
+        denoiser.set_feature_cache(self.deepcache_interval, self.deepcache_depth, self.deepcache_start, self.deepcache_end)
         noise = utils.NoiseSchedule(seeds, subseeds, width // 8, height // 8, device, self.unet.dtype)
         sampler = self.get_sampler(self.sampler, denoiser, self.eta, self.zsnr_mode)
 
         self.set_status("Upscaling")
         self.need_models(unet=False, vae=True, clip=False)
-        upscaled_images = self.upscale_images(images, self.img2img_upscaler, width, height)
+        upscaled_images = images if handles != None else self.upscale_images(images, self.img2img_upscaler, width, height)
         if self.keep_artifacts:
             self.on_artifact("Input", upscaled_images)
 
-        self.set_status("Encoding")
-        latents = utils.get_latents(self.vae, seeds, upscaled_images)
+        if handles != None:
+            latents = torch.cat([handles[i % len(handles)] for i in range(batch_size)]).to(self.vae.device, self.vae.dtype)
+        else:
+            self.set_status("Encoding")
+            latents = utils.get_latents(self.vae, seeds, upscaled_images)
         original_latents = latents
 
         if masks:
@@ -1215,15 +1629,24 @@ class GenerationParameters():
         
         self.need_models(unet=False, vae=True, clip=False)
         
+        if not self.mask:
+            return self.finish(latents, metadata)
+
+        if not self.keep_artifacts:
+            mask = self.mask
+            def postprocess(images):
+                outputs, _ = utils.apply_inpainting(images, original_images, masks, extents)
+                return [outputs[i] if mask[i] else images[i] for i in range(len(images))]
+            return self.finish(latents, metadata, postprocess)
+
         images = utils.decode_images(self.vae, latents)
 
         self.need_models(unet=False, vae=False, clip=False)
 
-        if self.mask:
-            outputs, masked = utils.apply_inpainting(images, original_images, masks, extents)
-            if self.keep_artifacts:
-                self.on_artifact("Output", [masked[i] if self.mask[i] else None for i in range(len(masked))])
-            images = [outputs[i] if self.mask[i] else images[i] for i in range(len(images))]
+        outputs, masked = utils.apply_inpainting(images, original_images, masks, extents)
+        if self.keep_artifacts:
+            self.on_artifact("Output", [masked[i] if self.mask[i] else None for i in range(len(masked))])
+        images = [outputs[i] if self.mask[i] else images[i] for i in range(len(images))]
 
         self.on_complete(images, metadata)
         return images
@@ -1243,6 +1666,7 @@ class GenerationParameters():
         
         actual_steps = int(self.steps * self.strength) + 1
         conditioning = prompts.BatchedConditioningSchedules(self.prompt, actual_steps, self.clip_skip)
+        conditioning.set_area_mode(self.area_mode)
         initial_networks = conditioning.get_initial_networks() if self.network_mode == "Static" else ({},{})
         all_networks, allowed_networks = conditioning.get_all_networks()
 
@@ -1260,6 +1684,9 @@ class GenerationParameters():
 
         self.attach_tome()
 
+        if (handles := self.get_handle_latents()) != None:
+            self.decode_handles(handles)
+
         self.need_models(unet=True, vae=False, clip=True)
         
         self.set_status("Preparing")
@@ -1278,50 +1705,71 @@ class GenerationParameters():
         self.set_network_strength(*initial_networks)
         self.attach_networks(all_networks, allowed_networks, device)
 
-        self.set_status("Encoding")
-        self.need_models(unet=False, vae=False, clip=True)
-        conditioning.encode(self.clip, [])
-
-        denoiser = guidance.GuidedDenoiser(self.unet, device, conditioning, self.scale, self.cfg_rescale or 0.0, self.prediction_type)
-        sampler = self.get_sampler(self.sampler, denoiser, self.eta, self.zsnr_mode)
-
         self.set_status("Upscaling")
         self.need_models(unet=False, vae=True, clip=False)
         upscaled_images = self.upscale_images(images, self.img2img_upscaler, width, height)
 
         tile_images, tile_positions, tile_masks = utils.get_tiles(upscaled_images, tile_size, tile_upscale)
 
+        # tiles of the same image are sampled together, in groups that fit the memory budget
+        prompt_rows = max(len(p) + len(n) for p, n in self.prompt)
+        tile_batch = self.get_tile_batch(tile_size, prompt_rows * (2 if tile_strength else 1))
+        groups = []
+        for i in range(len(tile_images)):
+            for j in range(0, len(tile_images[i]), tile_batch):
+                groups += [(i, list(range(j, min(j + tile_batch, len(tile_images[i])))))]
+
         self.set_status("Encoding")
+        self.need_models(unet=False, vae=False, clip=True)
+
+        denoisers = {}
+        for i, group in groups:
+            key = (i % len(self.prompt), len(group))
+            if key in denoisers:
+                continue
+            group_conditioning = prompts.BatchedConditioningSchedules([self.prompt[key[0]]] * key[1], actual_steps, self.clip_skip)
+            group_conditioning.encode(self.clip, [])
+            denoiser = guidance.GuidedDenoiser(self.unet, device, group_conditioning, self.scale, self.cfg_rescale or 0.0, self.prediction_type)
+            denoiser.set_cfg_skipping(self.cfg_truncation, self.cfg_interval)
+            denoiser.set_feature_cache(self.deepcache_interval, self.deepcache_depth, self.deepcache_start, self.deepcache_end)
+            denoisers[key] = denoiser
+
+        self.need_models(unet=False, vae=True, clip=False)
 
         tile_latents = []
-        for i in range(len(tile_images)):
-            tile_latents += [[]]
-            for j in range(len(tile_images[i])):
-                tile_latents[i] += [utils.get_latents(self.vae, [seeds[i]], [tile_images[i][j]])[0]]
+        for i, group in groups:
+            tile_latents += [utils.get_latents(self.vae, [seeds[i]] * len(group), [tile_images[i][j] for j in group])]
+
+        tile_conds = []
+        if tile_strength:
+            for i, group in groups:
+                tile_conds += [torch.cat([controlnet.annotate(tile_images[i][j], None, None, None)[0] for j in group])]
 
         self.set_status("Generating")
 
         self.need_models(unet=True, vae=False, clip=False)
 
         self.current_step = 0
-        self.total_steps = (int(self.steps * self.strength) + 1) * sum([len(a) for a in tile_latents])
+        self.total_steps = actual_steps * len(groups)
 
         with self.get_autocast_context(self.autocast, device):
-            for i in range(len(tile_latents)):  
-                noise = utils.NoiseSchedule([seeds[i]], [subseeds[i]], tile_size // 8, tile_size // 8, device, self.unet.dtype)
-                for j in range(len(tile_latents[i])):
-                    if tile_strength:
-                        cond, _, _ = controlnet.annotate(tile_images[i][j], None, None, None)
-                        self.unet.set_controlnet_conditioning([(tile_strength,tile_guess,1.0,cond)], device)
-                    tile_latents[i][j] = inference.img2img(tile_latents[i][j], denoiser, sampler, noise, self.steps, False, self.strength, self.on_step)
+            for g, (i, group) in enumerate(groups):
+                denoiser = denoisers[(i % len(self.prompt), len(group))]
+                sampler = self.get_sampler(self.sampler, denoiser, self.eta, self.zsnr_mode)
+                # every tile needs its own noise, so each is offset from the image seed by its index
+                noise = utils.NoiseSchedule([seeds[i] + j for j in group], [subseeds[i]] * len(group), tile_size // 8, tile_size // 8, device, self.unet.dtype)
+                if tile_strength:
+                    self.unet.set_controlnet_conditioning([(tile_strength,tile_guess,1.0,tile_conds[g])], device)
+                tile_latents[g] = inference.img2img(tile_latents[g], denoiser, sampler, noise, self.steps, False, self.strength, self.on_step)
 
         self.set_status("Decoding")
         
         self.need_models(unet=False, vae=True, clip=False)
         
-        for i in range(len(tile_latents)):
-            for j in range(len(tile_latents[i])):
-                tile_images[i][j] = utils.decode_images(self.vae, tile_latents[i][j])[0]
+        for g, (i, group) in enumerate(groups):
+            decoded = utils.decode_images(self.vae, tile_latents[g])
+            for k, j in enumerate(group):
+                tile_images[i][j] = decoded[k]
 
         assembled = utils.assemble_tiles(upscaled_images, tile_images, tile_positions, tile_masks)
 
@@ -1329,6 +1777,114 @@ class GenerationParameters():
 
         self.on_complete(assembled, metadata)
         return images
+
+    def latent_tiled_img2img(self):
+        tile_size = self.tile_size
+        tile_strength = self.tile_strength
+        tile_guess = self.tile_guess
+
+        self.set_status("Configuring")
+        self.check_parameters()
+        self.clear_annotators()
+
+        # the windows are separate UNET calls, a feature cache would mix features between them
+        if self.deepcache_interval and self.deepcache_interval > 1:
+            raise ValueError("DeepCache is incompatible with latent tiling")
+
+        self.set_status("Parsing")
+        
+        actual_steps = int(self.steps * self.strength) + 1
+        conditioning = prompts.BatchedConditioningSchedules(self.prompt, actual_steps, self.clip_skip)
+        conditioning.set_area_mode(self.area_mode)
+        initial_networks = conditioning.get_initial_networks() if self.network_mode == "Static" else ({},{})
+        all_networks, allowed_networks = conditioning.get_all_networks()
+
+        self.set_status("Loading")
+        self.set_device()
+        self.set_precision()
+        self.set_attention()
+
+        if tile_strength:
+            self.cn = ["Tile"]
+        else:
+            self.cn = None
+        
+        self.load_models(*initial_networks)
+
+        self.attach_tome()
+
+        if (handles := self.get_handle_latents()) != None:
+            self.decode_handles(handles)
+
+        self.need_models(unet=True, vae=False, clip=True)
+        
+        self.set_status("Preparing")
+        batch_size = self.get_batch_size()
+        device = self.device
+        images = self.image
+        width, height = self.width, self.height
+
+        seeds, subseeds = self.get_seeds(batch_size)
+        metadata = self.get_metadata("img2img",  width, height, batch_size, self.prompt, seeds, subseeds)
+
+        if tile_strength:
+            self.unet = controlnet.ControlledUNET(self.unet, self.cn)
+
+        self.set_status("Attaching")
+        self.set_network_strength(*initial_networks)
+        self.attach_networks(all_networks, allowed_networks, device)
+
+        self.set_status("Encoding")
+        self.need_models(unet=False, vae=False, clip=True)
+
+        # the windows are blended every step, so the sampler sees the whole latent at once
+        window = tile_size // 8
+        tiled_unet = tiling.TiledUNET(self.unet, window, window // 4, self.tile_batch or 4)
+
+        # images are sampled one at a time, so each needs a batch of one with its own prompt
+        denoisers = {}
+        for p in range(len(self.prompt)):
+            image_conditioning = prompts.BatchedConditioningSchedules([self.prompt[p]], actual_steps, self.clip_skip)
+            image_conditioning.set_area_mode(self.area_mode)
+            image_conditioning.encode(self.clip, [])
+            denoiser = guidance.GuidedDenoiser(tiled_unet, device, image_conditioning, self.scale, self.cfg_rescale or 0.0, self.prediction_type)
+            denoiser.set_cfg_skipping(self.cfg_truncation, self.cfg_interval)
+            denoisers[p] = denoiser
+
+        self.set_status("Upscaling")
+        self.need_models(unet=False, vae=True, clip=False)
+        upscaled_images = self.upscale_images(images, self.img2img_upscaler, width, height)
+
+        self.set_status("Encoding")
+        latents = [utils.get_latents(self.vae, [seeds[i]], [upscaled_images[i]], tiled=True) for i in range(len(upscaled_images))]
+
+        self.set_status("Generating")
+
+        self.need_models(unet=True, vae=False, clip=False)
+
+        self.current_step = 0
+        self.total_steps = actual_steps * len(latents)
+
+        with self.get_autocast_context(self.autocast, device):
+            for i in range(len(latents)):
+                if tile_strength:
+                    cond, _, _ = controlnet.annotate(upscaled_images[i], None, None, None)
+                    self.unet.set_controlnet_conditioning([(tile_strength,tile_guess,1.0,cond)], device)
+                denoiser = denoisers[i % len(self.prompt)]
+                sampler = self.get_sampler(self.sampler, denoiser, self.eta, self.zsnr_mode)
+                noise = utils.NoiseSchedule([seeds[i]], [subseeds[i]], latents[i].shape[-1], latents[i].shape[-2], device, self.unet.dtype)
+                latents[i] = inference.img2img(latents[i], denoiser, sampler, noise, self.steps, False, self.strength, self.on_step)
+
+        self.set_status("Decoding")
+        
+        self.need_models(unet=False, vae=True, clip=False)
+
+        images = [utils.decode_images(self.vae, l, tiled=True)[0] for l in latents]
+
+        self.need_models(unet=False, vae=False, clip=False)
+
+        self.on_complete(images, metadata)
+        return images
     
     @torch.inference_mode()
     def upscale(self):
@@ -1370,7 +1926,7 @@ class GenerationParameters():
             images = utils.apply_extents(images, extents)
             masks = utils.apply_extents(masks, extents)
             masks = upscalers.upscale(masks, transforms.InterpolationMode.LANCZOS, width, height)
-            masks = [utils.prepare_mask(mask, self.mask_blur, self.mask_expand) for mask in masks]
+            masks = utils.prepare_masks(masks, self.mask_blur, self.mask_expand, self.device)
 
         self.set_status("Upscaling")
         if not self.upscale_model:
@@ -1425,6 +1981,13 @@ class GenerationParameters():
 
         available = attention.get_available() 
         data["attention"] = [k for k,v in CROSS_ATTENTION.items() if v in available]
+        data["area_mode"] = AREA_MODES
+        data["tile_mode"] = TILE_MODES
+        data["vae_precision"] = VAE_PRECISIONS
+        data["vae_stats"] = dict(utils.VAE_STATS)
+        data["image_format"] = list(utils.IMAGE_FORMATS.keys())
+        data["preview_format"] = list(utils.IMAGE_FORMATS.keys())
+        data["latent_cache"] = self.latent_cache.get_stats()
 
         data["TI"] = list(self.storage.embeddings_files.keys())
         data["device"] = self.device_names